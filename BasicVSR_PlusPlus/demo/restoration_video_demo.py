@@ -1,6 +1,7 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import argparse
 import os
+import sys
 import glob
 
 import cv2
@@ -50,6 +51,9 @@ def parse_args():
                         help='Frame rate for output video (default: 30)')
     parser.add_argument('--save-video', action='store_true',
                         help='Also save output as video file')
+    parser.add_argument('--flow-cache-dir', type=str, default=None,
+                        help='Folder of the on-disk SPyNet flow cache, '
+                             'reused by later runs on the same frames')
     args = parser.parse_args()
     
     # Auto-set max_seq_len for CUDA to avoid OOM
@@ -134,6 +138,16 @@ def main():
         print(f"Total memory: {torch.cuda.get_device_properties(device).total_memory / 1024**3:.2f} GB")
 
     model = init_model(args.config, args.checkpoint, device=device)
+
+    flow_cache = None
+    if args.flow_cache_dir is not None:
+        # Optical_Flow_SpyNet/pytorch-spynet/flow_cache.py
+        sys.path.insert(0, os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), '..', '..',
+            'Optical_Flow_SpyNet', 'pytorch-spynet'))
+        from flow_cache import FlowCache
+        flow_cache = FlowCache(args.flow_cache_dir)
+        model.generator.flow_provider = flow_cache
     
     # Clear cache after model loading
     if device.type == 'cuda':
@@ -143,6 +157,8 @@ def main():
     output = restoration_video_inference(model, args.input_dir,
                                          args.window_size, args.start_idx,
                                          args.filename_tmpl, args.max_seq_len)
+    if flow_cache is not None:
+        print(flow_cache.report())
     
     # Clear cache after inference
     if device.type == 'cuda':
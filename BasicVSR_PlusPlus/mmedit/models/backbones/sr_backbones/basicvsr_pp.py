@@ -1,4 +1,6 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+import functools
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -62,6 +64,12 @@ class BasicVSRPlusPlus(nn.Module):
         # optical flow
         self.spynet = SPyNet(pretrained=spynet_pretrained)
 
+        # optional callable (spynet, ref, supp) -> flows used in place of
+        # spynet(ref, supp) in compute_flow, e.g. an on-disk flow cache;
+        # a provider with bidirectional(spynet, lqs) -> (flows to next,
+        # flows to previous) computes both directions in one call
+        self.flow_provider = None
+
         # feature extraction module
         if is_low_res_input:
             self.feat_extract = ResidualBlocksWithInputConv(3, mid_channels, 5)
@@ -143,12 +151,22 @@ class BasicVSRPlusPlus(nn.Module):
         lqs_1 = lqs[:, :-1, :, :, :].reshape(-1, c, h, w)
         lqs_2 = lqs[:, 1:, :, :, :].reshape(-1, c, h, w)
 
-        flows_backward = self.spynet(lqs_1, lqs_2).view(n, t - 1, 2, h, w)
+        if self.flow_provider is not None:
+            spynet = functools.partial(self.flow_provider, self.spynet)
+        else:
+            spynet = self.spynet
 
         if self.is_mirror_extended:  # flows_forward = flows_backward.flip(1)
+            flows_backward = spynet(lqs_1, lqs_2).view(n, t - 1, 2, h, w)
             flows_forward = None
+        elif hasattr(self.flow_provider, 'bidirectional'):
+            flows_backward, flows_forward = self.flow_provider.bidirectional(
+                self.spynet, lqs)
+            flows_backward = flows_backward.view(n, t - 1, 2, h, w)
+            flows_forward = flows_forward.view(n, t - 1, 2, h, w)
         else:
-            flows_forward = self.spynet(lqs_2, lqs_1).view(n, t - 1, 2, h, w)
+            flows_backward = spynet(lqs_1, lqs_2).view(n, t - 1, 2, h, w)
+            flows_forward = spynet(lqs_2, lqs_1).view(n, t - 1, 2, h, w)
 
         if self.cpu_cache:
             flows_backward = flows_backward.cpu()
@@ -50,6 +50,47 @@ def test_basicvsr_plusplus():
     output = model(input_tensor)
     assert output.shape == (1, 5, 3, 256, 256)
 
+    # flows from a flow provider
+    calls = []
+
+    def flow_provider(spynet, ref, supp):
+        calls.append(ref.shape)
+        return spynet(ref, supp)
+
+    model = BasicVSRPlusPlus(
+        mid_channels=64,
+        num_blocks=7,
+        is_low_res_input=True,
+        spynet_pretrained=None,
+        cpu_cache_length=100)
+    input_tensor = torch.rand(1, 5, 3, 64, 64)
+    with torch.no_grad():
+        output = model(input_tensor)
+        model.flow_provider = flow_provider
+        output_provider = model(input_tensor)
+    assert calls == [(4, 3, 64, 64), (4, 3, 64, 64)]
+    assert torch.allclose(output, output_provider)
+
+    # both directions in one call when the provider supports it
+    class BidirectionalProvider:
+
+        def __call__(self, spynet, ref, supp):
+            calls.append(ref.shape)
+            return spynet(ref, supp)
+
+        def bidirectional(self, spynet, lqs):
+            calls.append(lqs.shape)
+            lqs_1 = lqs[:, :-1].flatten(0, 1)
+            lqs_2 = lqs[:, 1:].flatten(0, 1)
+            return spynet(lqs_1, lqs_2), spynet(lqs_2, lqs_1)
+
+    calls.clear()
+    with torch.no_grad():
+        model.flow_provider = BidirectionalProvider()
+        output_provider = model(input_tensor)
+    assert calls == [(1, 5, 3, 64, 64)]
+    assert torch.allclose(output, output_provider)
+
     # gpu
     if torch.cuda.is_available():
         model = BasicVSRPlusPlus(
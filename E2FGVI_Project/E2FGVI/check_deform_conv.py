@@ -0,0 +1,140 @@
+"""
+Check the deformable convolution compatibility layer against the DCNv2
+formula and benchmark it at E2FGVI feature sizes.
+
+    python check_deform_conv.py [--iters 10] [--threads 0]
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from model.modules.deform_conv_compat import (tv_deform_conv2d,
+                                              modulated_deform_conv2d_im2col)
+
+
+def tv_impl(x, offset, mask, weight, bias, stride, padding, dilation, groups,
+            deform_groups):
+    return tv_deform_conv2d(x, offset, weight, bias, stride=stride,
+                            padding=padding, dilation=dilation, mask=mask)
+
+
+def bilinear(x, py, px):
+    """Sample x (c, h, w) at float positions py/px (n,), zero outside."""
+    c, h, w = x.shape
+    y0, x0 = torch.floor(py).long(), torch.floor(px).long()
+    out = x.new_zeros(c, py.numel())
+    for dy in (0, 1):
+        for dx in (0, 1):
+            yi, xi = y0 + dy, x0 + dx
+            wt = (1 - (py - yi).abs()) * (1 - (px - xi).abs())
+            valid = (yi >= 0) & (yi < h) & (xi >= 0) & (xi < w)
+            vals = x[:, yi.clamp(0, h - 1), xi.clamp(0, w - 1)]
+            out += vals * (wt * valid)
+    return out
+
+
+def reference(x, offset, mask, weight, bias, stride, padding, dilation,
+              groups, deform_groups):
+    """y(p) = sum_k w_k * x(p + p_k + dp_k) * dm_k, written out tap by tap."""
+    b, c, h, w = x.shape
+    out_c, _, kh, kw = weight.shape
+    out_h = (h + 2 * padding - dilation * (kh - 1) - 1) // stride + 1
+    out_w = (w + 2 * padding - dilation * (kw - 1) - 1) // stride + 1
+    gy, gx = torch.meshgrid(torch.arange(out_h, dtype=x.dtype),
+                            torch.arange(out_w, dtype=x.dtype),
+                            indexing='ij')
+    cg, dg_c = c // groups, c // deform_groups
+    out = x.new_zeros(b, out_c, out_h * out_w)
+    for n in range(b):
+        for i in range(kh):
+            for j in range(kw):
+                k = i * kw + j
+                cols = []
+                for g in range(deform_groups):
+                    dy = offset[n, 2 * (g * kh * kw + k)].flatten()
+                    dx = offset[n, 2 * (g * kh * kw + k) + 1].flatten()
+                    m = mask[n, g * kh * kw + k].flatten()
+                    py = gy.flatten() * stride - padding + i * dilation + dy
+                    px = gx.flatten() * stride - padding + j * dilation + dx
+                    cols.append(
+                        bilinear(x[n, g * dg_c:(g + 1) * dg_c], py, px) * m)
+                cols = torch.cat(cols)
+                for g in range(groups):
+                    og = out_c // groups
+                    out[n, g * og:(g + 1) * og] += weight[
+                        g * og:(g + 1) * og, :, i, j] @ cols[g * cg:(g + 1) *
+                                                             cg]
+    out = out.view(b, out_c, out_h, out_w)
+    return out + bias.view(1, -1, 1, 1)
+
+
+def make_inputs(b, c, out_c, h, w, groups, deform_groups, k=3, scale=3.0):
+    x = torch.randn(b, c, h, w)
+    offset = torch.randn(b, 2 * deform_groups * k * k, h, w) * scale
+    mask = torch.rand(b, deform_groups * k * k, h, w)
+    weight = torch.randn(out_c, c // groups, k, k) * 0.1
+    bias = torch.randn(out_c)
+    return x, offset, mask, weight, bias
+
+
+def check_equivalence():
+    torch.manual_seed(0)
+    cases = [
+        # b, c, out_c, h, w, stride, padding, dilation, groups, deform_groups
+        (2, 8, 4, 7, 9, 1, 1, 1, 1, 1),
+        (1, 16, 8, 6, 5, 1, 1, 1, 2, 4),
+        (1, 8, 6, 9, 8, 2, 2, 2, 1, 2),
+    ]
+    impls = [('im2col', modulated_deform_conv2d_im2col)]
+    if tv_deform_conv2d is not None:
+        impls.append(('torchvision', tv_impl))
+    ok = True
+    for b, c, out_c, h, w, s, p, d, g, dg in cases:
+        x, offset, mask, weight, bias = make_inputs(b, c, out_c, h, w, g, dg)
+        out_h = (h + 2 * p - d * 2 - 1) // s + 1
+        out_w = (w + 2 * p - d * 2 - 1) // s + 1
+        offset = offset[:, :, :out_h, :out_w].contiguous()
+        mask = mask[:, :, :out_h, :out_w].contiguous()
+        ref = reference(x, offset, mask, weight, bias, s, p, d, g, dg)
+        for name, fn in impls:
+            out = fn(x, offset, mask, weight, bias, s, p, d, g, dg)
+            err = (out - ref).abs().max().item()
+            ok = ok and err < 1e-4
+            print(f'[{name:11}] case c={c} s={s} p={p} d={d} g={g} '
+                  f'dg={dg}: max abs err {err:.2e}')
+    print('Equivalence check ' + ('passed' if ok else 'FAILED'))
+    return ok
+
+
+def benchmark(iters):
+    # SecondOrderDeformableAlignment in BidirectionalPropagation:
+    # 2 * 128 -> 128 channels, 16 deform groups, 1/4 of a 432x240 frame
+    torch.manual_seed(0)
+    x, offset, mask, weight, bias = make_inputs(1, 256, 128, 60, 108, 1, 16)
+    impls = [('im2col', modulated_deform_conv2d_im2col)]
+    if tv_deform_conv2d is not None:
+        impls.append(('torchvision', tv_impl))
+    impls.append(('conv2d (no deform)',
+                  lambda x, o, m, wt, bs, *a: F.conv2d(x, wt, bs, padding=1)))
+    with torch.no_grad():
+        for name, fn in impls:
+            fn(x, offset, mask, weight, bias, 1, 1, 1, 1, 16)
+            start = time.time()
+            for _ in range(iters):
+                fn(x, offset, mask, weight, bias, 1, 1, 1, 1, 16)
+            elapsed = (time.time() - start) / iters
+            print(f'[{name:18}] {elapsed * 1000:8.2f} ms/call, '
+                  f'{1 / elapsed:7.2f} calls/s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Deform conv compat check')
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=0)
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    check_equivalence()
+    benchmark(args.iters)
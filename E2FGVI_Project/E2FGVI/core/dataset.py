@@ -9,7 +9,8 @@ import numpy as np
 import torch
 import torchvision.transforms as transforms
 
-from core.utils import (TrainZipReader, TestZipReader,
+from core.utils import (TrainZipReader, TestZipReader, LRUCache,
+                        get_packed_root, open_packed_frames, unpack_masks,
                         create_random_shape_with_random_motion, Stack,
                         ToTorchFormatTensor, GroupRandomHorizontalFlip)
 
@@ -30,6 +31,9 @@ class TrainDataset(torch.utils.data.Dataset):
         if debug:
             self.video_names = self.video_names[:100]
 
+        # optional per-worker cache of decoded frames
+        TrainZipReader.set_cache_size(args.get('frame_cache_size', 0))
+
         self._to_tensors = transforms.Compose([
             Stack(),
             ToTorchFormatTensor(),
@@ -63,8 +67,16 @@ class TrainDataset(torch.utils.data.Dataset):
                                             self.num_ref_frames)
 
         # read video frames
+        frame_tensors = self._load_frames(video_name, selected_index)
+        masks = [all_masks[idx] for idx in selected_index]
+
+        # to tensors
+        mask_tensors = self._to_tensors(masks)
+        return frame_tensors, mask_tensors, video_name
+
+    def _load_frames(self, video_name, selected_index):
+        """Randomly flipped frames as a (t, 3, h, w) tensor in [-1, 1]."""
         frames = []
-        masks = []
         for idx in selected_index:
             video_path = os.path.join(self.args['data_root'],
                                       self.args['name'], 'JPEGImages',
@@ -72,13 +84,10 @@ class TrainDataset(torch.utils.data.Dataset):
             img = TrainZipReader.imread(video_path, idx).convert('RGB')
             img = img.resize(self.size)
             frames.append(img)
-            masks.append(all_masks[idx])
 
         # normalizate, to tensors
         frames = GroupRandomHorizontalFlip()(frames)
-        frame_tensors = self._to_tensors(frames) * 2.0 - 1.0
-        mask_tensors = self._to_tensors(masks)
-        return frame_tensors, mask_tensors, video_name
+        return self._to_tensors(frames) * 2.0 - 1.0
 
 
 class TestDataset(torch.utils.data.Dataset):
@@ -135,3 +144,63 @@ class TestDataset(torch.utils.data.Dataset):
         frame_tensors = self._to_tensors(frames) * 2.0 - 1.0
         mask_tensors = self._to_tensors(masks)
         return frame_tensors, mask_tensors, video_name, frames_PIL
+
+
+class PackedTrainDataset(TrainDataset):
+    """TrainDataset reading the packed store written by pack_dataset.py.
+
+    Frames are stored decoded and resized, so an item is a gather from a
+    memory-mapped array instead of one JPEG decode and resize per frame.
+    The memory maps of recently used videos are kept open (at most
+    `packed_cache_size` per worker, default 64).
+    """
+    def __init__(self, args: dict, debug=False):
+        super(PackedTrainDataset, self).__init__(args, debug)
+        self.packed_root = get_packed_root(args['data_root'], args['name'],
+                                           self.size)
+        self.videos = LRUCache(args.get('packed_cache_size', 64))
+
+    def _open_video(self, video_name):
+        frames = self.videos.get(video_name)
+        if frames is None:
+            frames = open_packed_frames(
+                os.path.join(self.packed_root, 'JPEGImages',
+                             f'{video_name}.npy'), self.size)
+            self.videos.put(video_name, frames)
+        return frames
+
+    def _load_frames(self, video_name, selected_index):
+        frames = self._open_video(video_name)[selected_index]
+        if random.random() < 0.5:
+            frames = frames[:, :, ::-1]
+        frames = torch.from_numpy(np.ascontiguousarray(frames))
+        return frames.permute(0, 3, 1, 2).float().div(255) * 2.0 - 1.0
+
+
+class PackedTestDataset(TestDataset):
+    """TestDataset reading the packed store written by pack_dataset.py.
+
+    Masks are stored dilated and bit-packed, so they are only unpacked.
+    """
+    def __init__(self, args):
+        super(PackedTestDataset, self).__init__(args)
+        self.packed_root = get_packed_root(args.data_root, args.dataset,
+                                           self.size)
+
+    def load_item(self, index):
+        video_name = self.video_names[index]
+        frames = open_packed_frames(
+            os.path.join(self.packed_root, 'JPEGImages', f'{video_name}.npy'),
+            self.size)
+        masks = unpack_masks(
+            np.load(os.path.join(self.packed_root, 'test_masks',
+                                 f'{video_name}.npy'),
+                    mmap_mode='r'), self.w)
+
+        # to tensors
+        frames = np.array(frames)
+        frames_PIL = list(frames)
+        frame_tensors = torch.from_numpy(frames).permute(
+            0, 3, 1, 2).float().div(255) * 2.0 - 1.0
+        mask_tensors = torch.from_numpy(masks).float().unsqueeze(1)
+        return frame_tensors, mask_tensors, video_name, frames_PIL
@@ -13,7 +13,7 @@ from torch.utils.tensorboard import SummaryWriter
 
 from core.lr_scheduler import MultiStepRestartLR, CosineAnnealingRestartLR
 from core.loss import AdversarialLoss
-from core.dataset import TrainDataset
+from core.dataset import TrainDataset, PackedTrainDataset
 from model.modules.flow_comp import FlowCompletionLoss
 
 
@@ -27,7 +27,12 @@ class Trainer:
         self.spynet_lr = config['trainer'].get('spynet_lr', 1.0)
 
         # setup data set and data loader
-        self.train_dataset = TrainDataset(config['train_data_loader'])
+        # "packed": true reads the store written by pack_dataset.py
+        if config['train_data_loader'].get('packed', False):
+            self.train_dataset = PackedTrainDataset(
+                config['train_data_loader'])
+        else:
+            self.train_dataset = TrainDataset(config['train_data_loader'])
 
         self.train_sampler = None
         self.train_args = config['trainer']
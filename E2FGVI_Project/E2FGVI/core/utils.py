@@ -5,6 +5,7 @@ import random
 import numpy as np
 from PIL import Image, ImageOps
 import zipfile
+from collections import OrderedDict
 
 import torch
 import matplotlib
@@ -29,55 +30,76 @@ def read_dirnames_under_root(root_dir):
     return dirnames
 
 
-class TrainZipReader(object):
+class ZipReader(object):
+    """Reads frames by index from zip archives of images.
+
+    Every archive is opened once per process together with its sorted name
+    index. Handles remember the pid that opened them, so DataLoader workers
+    forked after the parent touched an archive reopen it instead of sharing
+    (and seeking) the parent's file descriptor. Decoded frames can be kept
+    in an optional LRU cache, see set_cache_size.
+    """
+    file_dict = dict()
+    frame_cache = None
+
+    @classmethod
+    def set_cache_size(cls, capacity):
+        """Cache up to `capacity` decoded frames per process, 0 disables."""
+        cls.frame_cache = LRUCache(capacity) if capacity > 0 else None
+
+    @classmethod
+    def build_file_dict(cls, path):
+        pid = os.getpid()
+        entry = cls.file_dict.get(path)
+        if entry is None or entry[0] != pid:
+            if entry is not None:
+                # inherited from the parent, only closes our copy of the fd
+                entry[1].close()
+            file_handle = zipfile.ZipFile(path, 'r')
+            entry = (pid, file_handle, sorted(file_handle.namelist()))
+            cls.file_dict[path] = entry
+        return entry[1], entry[2]
+
+    @classmethod
+    def imread(cls, path, idx):
+        cache = cls.frame_cache
+        if cache is not None:
+            im = cache.get((path, idx))
+            if im is not None:
+                return im
+        zfile, filelist = cls.build_file_dict(path)
+        im = cls.decode(zfile.read(filelist[idx]))
+        if cache is not None:
+            cache.put((path, idx), im)
+        return im
+
+    @staticmethod
+    def decode(data):
+        raise NotImplementedError
+
+
+class TrainZipReader(ZipReader):
     file_dict = dict()
+    frame_cache = None
 
     def __init__(self):
         super(TrainZipReader, self).__init__()
 
     @staticmethod
-    def build_file_dict(path):
-        file_dict = TrainZipReader.file_dict
-        if path in file_dict:
-            return file_dict[path]
-        else:
-            file_handle = zipfile.ZipFile(path, 'r')
-            file_dict[path] = file_handle
-            return file_dict[path]
-
-    @staticmethod
-    def imread(path, idx):
-        zfile = TrainZipReader.build_file_dict(path)
-        filelist = zfile.namelist()
-        filelist.sort()
-        data = zfile.read(filelist[idx])
-        #
+    def decode(data):
         im = Image.open(io.BytesIO(data))
         return im
 
 
-class TestZipReader(object):
+class TestZipReader(ZipReader):
     file_dict = dict()
+    frame_cache = None
 
     def __init__(self):
         super(TestZipReader, self).__init__()
 
     @staticmethod
-    def build_file_dict(path):
-        file_dict = TestZipReader.file_dict
-        if path in file_dict:
-            return file_dict[path]
-        else:
-            file_handle = zipfile.ZipFile(path, 'r')
-            file_dict[path] = file_handle
-            return file_dict[path]
-
-    @staticmethod
-    def imread(path, idx):
-        zfile = TestZipReader.build_file_dict(path)
-        filelist = zfile.namelist()
-        filelist.sort()
-        data = zfile.read(filelist[idx])
+    def decode(data):
         file_bytes = np.asarray(bytearray(data), dtype=np.uint8)
         im = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
         im = Image.fromarray(cv2.cvtColor(im, cv2.COLOR_BGR2RGB))
@@ -85,6 +107,242 @@ class TestZipReader(object):
         return im
 
 
+# ###########################################################################
+# Video IO
+# ###########################################################################
+
+
+class VideoFrameReader(object):
+    """Lazily decodes RGB frames from an mp4 file or a directory of images.
+
+    Frames are only decoded when iterated, so callers can keep a bounded
+    number of them in memory instead of the whole clip.
+
+    Args:
+        path (str): Path of an .mp4 video or a directory of frames.
+        size (tuple[int] | None): Output (w, h). Frames keep their original
+            size when it is None.
+    """
+    def __init__(self, path, size=None):
+        super(VideoFrameReader, self).__init__()
+        self.path = path
+        self.use_mp4 = path.endswith('.mp4')
+        if not self.use_mp4:
+            self.frame_paths = [
+                os.path.join(path, name) for name in sorted(os.listdir(path))
+            ]
+        self._length = None
+        self.size = size
+        if self.size is None:
+            _, first_frame = next(self.iter_frames([0]))
+            self.size = (first_frame.shape[1], first_frame.shape[0])
+
+    def __len__(self):
+        if self._length is None:
+            if self.use_mp4:
+                # grab() skips the color conversion, only demuxes/decodes
+                vidcap = cv2.VideoCapture(self.path)
+                count = 0
+                while vidcap.grab():
+                    count += 1
+                vidcap.release()
+                self._length = count
+            else:
+                self._length = len(self.frame_paths)
+        return self._length
+
+    def _to_frame(self, image):
+        image = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        if self.size is not None and image.size != tuple(self.size):
+            image = image.resize(self.size)
+        return np.array(image).astype(np.uint8)
+
+    def iter_frames(self, indices=None):
+        """Yield (idx, frame) pairs in increasing order of idx.
+
+        Args:
+            indices (list[int] | None): Only decode these frames. All frames
+                are yielded when it is None.
+        """
+        wanted = None if indices is None else set(indices)
+        if self.use_mp4:
+            last = None if wanted is None else max(wanted, default=-1)
+            vidcap = cv2.VideoCapture(self.path)
+            idx = 0
+            while (last is None or idx <= last) and vidcap.grab():
+                if wanted is None or idx in wanted:
+                    success, image = vidcap.retrieve()
+                    if not success:
+                        break
+                    yield idx, self._to_frame(image)
+                idx += 1
+            vidcap.release()
+        else:
+            # image folders allow random access, so only read what is asked
+            ids = range(len(self.frame_paths)) if wanted is None else sorted(
+                i for i in wanted if 0 <= i < len(self.frame_paths))
+            for idx in ids:
+                yield idx, self._to_frame(cv2.imread(self.frame_paths[idx]))
+
+
+class LRUCache(object):
+    """A bounded mapping that evicts the least recently used entry.
+
+    Args:
+        capacity (int): Maximum number of entries kept.
+    """
+    def __init__(self, capacity):
+        super(LRUCache, self).__init__()
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+
+class WindowBlender(object):
+    """Blends overlapping sliding window results into final frames.
+
+    Every frame covered by an unfinished window owns a slot in a weighted
+    running sum and a weight buffer, both allocated once on the device and
+    only grown when more frames are in flight than slots exist. A whole
+    window is accumulated with one index_add_, and a frame leaves the device
+    only once, when it is finalized.
+
+    Args:
+        h (int): Frame height.
+        w (int): Frame width.
+        device (torch.device): Device of the accumulation buffers.
+        weighting (str): 'uniform' averages all windows covering a frame,
+            'center' weights them by the distance to the window center.
+            Default: 'uniform'.
+        radius (int): Neighbor stride of the windows, used by 'center'.
+        capacity (int): Initial number of slots. Default: 16.
+    """
+    def __init__(self,
+                 h,
+                 w,
+                 device,
+                 weighting='uniform',
+                 radius=None,
+                 capacity=16):
+        super(WindowBlender, self).__init__()
+        if weighting not in ['uniform', 'center']:
+            raise NotImplementedError(f'Weighting {weighting} is not supported.')
+        if weighting == 'center' and radius is None:
+            raise ValueError('center weighting needs the window radius')
+        self.weighting = weighting
+        self.radius = radius
+        self.sum = torch.zeros(capacity, 3, h, w, device=device)
+        self.weight = torch.zeros(capacity, 1, 1, 1, device=device)
+        self.slots = {}
+        self.free_slots = list(range(capacity))[::-1]
+
+    def _grow(self):
+        capacity = self.sum.size(0)
+        self.sum = torch.cat([self.sum, torch.zeros_like(self.sum)])
+        self.weight = torch.cat([self.weight, torch.zeros_like(self.weight)])
+        self.free_slots = list(range(capacity, 2 * capacity))[::-1]
+
+    def _get_slot(self, idx):
+        if idx not in self.slots:
+            if not self.free_slots:
+                self._grow()
+            self.slots[idx] = self.free_slots.pop()
+        return self.slots[idx]
+
+    def add(self, frame_ids, frames, center=None):
+        """Accumulate one window.
+
+        Args:
+            frame_ids (list[int]): Frame index of every window frame.
+            frames (Tensor): Window results with shape (t, 3, h, w).
+            center (int): Index of the window center, used by 'center'.
+        """
+        slots = torch.tensor([self._get_slot(i) for i in frame_ids],
+                             device=self.sum.device)
+        if self.weighting == 'uniform':
+            weights = torch.ones(len(frame_ids), 1, 1, 1, device=self.sum.device)
+        else:
+            dist = torch.tensor([abs(i - center) for i in frame_ids],
+                                dtype=torch.float32,
+                                device=self.sum.device)
+            weights = (1 - dist / (self.radius + 1)).view(-1, 1, 1, 1)
+        self.sum.index_add_(0, slots, frames.to(self.sum.dtype) * weights)
+        self.weight.index_add_(0, slots, weights)
+
+    def pop(self, idx, out=None, scale=255):
+        """Finalize frame idx and free its slot.
+
+        Args:
+            idx (int): Frame index.
+            out (np.ndarray | None): Optional (h, w, 3) uint8 array the
+                frame is written into, avoiding a new host allocation.
+            scale (float): Multiplier applied before rounding to uint8.
+        Returns:
+            np.ndarray: The blended frame as (h, w, 3) uint8.
+        """
+        slot = self.slots.pop(idx)
+        frame = self.sum[slot].div_(self.weight[slot]).mul_(scale).round_()
+        frame = frame.clamp_(0, 255).permute(1, 2, 0).to(torch.uint8)
+        if out is None:
+            out = frame.cpu().numpy()
+        else:
+            torch.from_numpy(out).copy_(frame)
+        self.sum[slot].zero_()
+        self.weight[slot].zero_()
+        self.free_slots.append(slot)
+        return out
+
+
+# ###########################################################################
+# Packed frame store
+# ###########################################################################
+
+
+def get_packed_root(data_root, name, size):
+    """Directory of the packed store of a dataset at size (w, h)."""
+    return os.path.join(data_root, name, f'packed_{size[0]}x{size[1]}')
+
+
+def open_packed_frames(path, size=None):
+    """Memory-map a packed (T, h, w, 3) uint8 frame array.
+
+    Args:
+        path (str): The .npy file written by pack_dataset.py.
+        size (tuple[int] | None): Expected (w, h), checked if given.
+    """
+    frames = np.load(path, mmap_mode='r')
+    if size is not None and frames.shape[1:3] != (size[1], size[0]):
+        raise ValueError(f'{path} holds {frames.shape[2]}x{frames.shape[1]} '
+                         f'frames, expected {size[0]}x{size[1]}')
+    return frames
+
+
+def unpack_masks(packed, width):
+    """Unpack bit-packed (T, h, ceil(w / 8)) masks to (T, h, w) uint8."""
+    return np.unpackbits(packed, axis=-1, count=width)
+
+
 # ###########################################################################
 # Data augmentation
 # ###########################################################################
@@ -9,7 +9,8 @@ from PIL import Image
 import torch
 from torch.utils.data import DataLoader
 
-from core.dataset import TestDataset
+from core.dataset import TestDataset, PackedTestDataset
+from core.utils import WindowBlender
 from core.metrics import calc_psnr_and_ssim, calculate_i3d_activations, calculate_vfid, init_i3d_model
 
 # global variables
@@ -33,7 +34,10 @@ def main_worker(args):
     # set up datasets and data loader
     assert (args.dataset == 'davis') or args.dataset == 'youtube-vos', \
         f"{args.dataset} dataset is not supported"
-    test_dataset = TestDataset(args)
+    if args.packed:
+        test_dataset = PackedTestDataset(args)
+    else:
+        test_dataset = TestDataset(args)
 
     test_loader = DataLoader(test_dataset,
                              batch_size=1,
@@ -76,7 +80,13 @@ def main_worker(args):
         ori_frames = [
             ori_frames[i].squeeze().cpu().numpy() for i in range(video_length)
         ]
-        comp_frames = [None] * video_length
+        blender = WindowBlender(h,
+                                w,
+                                device,
+                                weighting=args.blend,
+                                radius=neighbor_stride)
+        comp_frames = np.empty((video_length, h, w, 3), np.uint8)
+        num_final = 0
 
         # complete holes by our model
         for f in range(0, video_length, neighbor_stride):
@@ -91,19 +101,22 @@ def main_worker(args):
                 masked_frames = selected_imgs * (1 - selected_masks)
                 pred_img, _ = model(masked_frames, len(neighbor_ids))
 
-                pred_img = (pred_img + 1) / 2
-                pred_img = pred_img.cpu().permute(0, 2, 3, 1).numpy() * 255
-                binary_masks = masks[0, neighbor_ids, :, :, :].cpu().permute(
-                    0, 2, 3, 1).numpy().astype(np.uint8)
-                for i in range(len(neighbor_ids)):
-                    idx = neighbor_ids[i]
-                    img = np.array(pred_img[i]).astype(np.uint8) * binary_masks[i] \
-                        + ori_frames[idx] * (1 - binary_masks[i])
-                    if comp_frames[idx] is None:
-                        comp_frames[idx] = img
-                    else:
-                        comp_frames[idx] = comp_frames[idx].astype(
-                            np.float32) * 0.5 + img.astype(np.float32) * 0.5
+                # composite and blend the whole window on the device
+                pred_img = (pred_img[:len(neighbor_ids)] + 1) / 2
+                local_imgs = (frames[0, neighbor_ids] + 1) / 2
+                local_masks = masks[0, neighbor_ids]
+                blender.add(neighbor_ids,
+                            pred_img * local_masks + local_imgs *
+                            (1 - local_masks),
+                            center=f)
+
+            # frames before the next window's neighbors are final
+            while num_final < min(f, video_length):
+                blender.pop(num_final, out=comp_frames[num_final])
+                num_final += 1
+        while num_final < video_length:
+            blender.pop(num_final, out=comp_frames[num_final])
+            num_final += 1
 
         # calculate metrics
         cur_video_psnr = []
@@ -172,5 +185,13 @@ if __name__ == '__main__':
     parser.add_argument('--ckpt', type=str, required=True)
     parser.add_argument('--save_results', action='store_true', default=False)
     parser.add_argument('--num_workers', default=4, type=int)
+    parser.add_argument('--packed',
+                        action='store_true',
+                        default=False,
+                        help='read the store written by pack_dataset.py')
+    parser.add_argument('--blend',
+                        choices=['uniform', 'center'],
+                        default='uniform',
+                        type=str)
     args = parser.parse_args()
     main_worker(args)
@@ -207,6 +207,12 @@ class InpaintGenerator(BaseNetwork):
         # flow completion network
         self.update_spynet = SPyNet()
 
+        # optional callable (spynet, ref, supp) -> flows standing in for
+        # update_spynet(ref, supp) at inference, e.g. the on-disk
+        # FlowCache of Optical_Flow_SpyNet/pytorch-spynet/flow_cache.py;
+        # its bidirectional(spynet, frames) method is used when it has one
+        self.flow_provider = None
+
     def forward_bidirect_flow(self, masked_local_frames):
         b, l_t, c, h, w = masked_local_frames.size()
 
@@ -223,8 +229,19 @@ class InpaintGenerator(BaseNetwork):
             -1, c, h // 4, w // 4)
         mlf_2 = masked_local_frames[:, 1:, :, :, :].reshape(
             -1, c, h // 4, w // 4)
-        pred_flows_forward = self.update_spynet(mlf_1, mlf_2)
-        pred_flows_backward = self.update_spynet(mlf_2, mlf_1)
+        if hasattr(self.flow_provider, 'bidirectional'):
+            # both directions at once, every frame is hashed a single time
+            pred_flows_forward, pred_flows_backward = \
+                self.flow_provider.bidirectional(self.update_spynet,
+                                                 masked_local_frames)
+        elif self.flow_provider is not None:
+            pred_flows_forward = self.flow_provider(self.update_spynet, mlf_1,
+                                                    mlf_2)
+            pred_flows_backward = self.flow_provider(self.update_spynet,
+                                                     mlf_2, mlf_1)
+        else:
+            pred_flows_forward = self.update_spynet(mlf_1, mlf_2)
+            pred_flows_backward = self.update_spynet(mlf_2, mlf_1)
 
         pred_flows_forward = pred_flows_forward.view(b, l_t - 1, 2, h // 4,
                                                      w // 4)
@@ -233,17 +250,42 @@ class InpaintGenerator(BaseNetwork):
 
         return pred_flows_forward, pred_flows_backward
 
-    def forward(self, masked_frames, num_local_frames):
-        l_t = num_local_frames
+    def encode(self, masked_frames):
+        """Encode every frame independently.
+        Args:
+            masked_frames (Tensor): Masked frames with shape (b, t, 3, h, w).
+        Returns:
+            Tensor: Encoder features with shape (b, t, c, h // 4, w // 4).
+        """
         b, t, ori_c, ori_h, ori_w = masked_frames.size()
+        enc_feat = self.encoder(masked_frames.view(b * t, ori_c, ori_h, ori_w))
+        _, c, h, w = enc_feat.size()
+        return enc_feat.view(b, t, c, h, w)
+
+    def forward(self,
+                masked_frames,
+                num_local_frames,
+                enc_feat=None,
+                pred_flows=None):
+        """
+        enc_feat: optional encoder features of all t frames [b, t, c, h, w]
+            (e.g. cached from previous windows). When given, the encoder is
+            skipped and only the local frames of masked_frames are read.
+        pred_flows: optional precomputed (forward, backward) flows of the
+            local frames, each [b, l_t - 1, 2, h // 4, w // 4], as returned
+            by forward_bidirect_flow.
+        """
+        l_t = num_local_frames
 
         # normalization before feeding into the flow completion module
-        masked_local_frames = (masked_frames[:, :l_t, ...] + 1) / 2
-        pred_flows = self.forward_bidirect_flow(masked_local_frames)
+        if pred_flows is None:
+            masked_local_frames = (masked_frames[:, :l_t, ...] + 1) / 2
+            pred_flows = self.forward_bidirect_flow(masked_local_frames)
 
         # extracting features and performing the feature propagation on local features
-        enc_feat = self.encoder(masked_frames.view(b * t, ori_c, ori_h, ori_w))
-        _, c, h, w = enc_feat.size()
+        if enc_feat is None:
+            enc_feat = self.encode(masked_frames)
+        b, t, c, h, w = enc_feat.size()
         local_feat = enc_feat.view(b, t, c, h, w)[:, :l_t, ...]
         ref_feat = enc_feat.view(b, t, c, h, w)[:, l_t:, ...]
         local_feat = self.feat_prop_module(local_feat, pred_flows[0],
@@ -1,102 +1,141 @@
 """
 Compatibility layer for deformable convolution operations.
-Provides fallback implementations when mmcv is not available.
+Provides pure PyTorch implementations when mmcv ops are not available.
 """
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.modules.utils import _pair
+
+try:
+    from torchvision.ops import deform_conv2d as tv_deform_conv2d
+except (ImportError, ModuleNotFoundError):
+    tv_deform_conv2d = None
 
 
 class ModulatedDeformConv2dCompat(nn.Module):
     """
-    Modulated Deformable Convolution 2d (compatible fallback implementation)
-    When mmcv._ext is not available, this provides a simpler but functional approximation.
+    Modulated Deformable Convolution 2d (DCNv2) without compiled mmcv ops.
+    Takes the same arguments and offset/mask layout as
+    mmcv.ops.ModulatedDeformConv2d.
     """
-    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, 
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0,
                  dilation=1, groups=1, bias=True, deform_groups=1):
         super(ModulatedDeformConv2dCompat, self).__init__()
         self.in_channels = in_channels
         self.out_channels = out_channels
-        self.kernel_size = kernel_size
-        self.stride = stride
-        self.padding = padding
-        self.dilation = dilation
+        self.kernel_size = _pair(kernel_size)
+        self.stride = _pair(stride)
+        self.padding = _pair(padding)
+        self.dilation = _pair(dilation)
         self.groups = groups
         self.deform_groups = deform_groups
-        
+
         # Standard conv2d weight and bias
         self.weight = nn.Parameter(
-            torch.Tensor(out_channels, in_channels // groups, kernel_size, kernel_size)
+            torch.Tensor(out_channels, in_channels // groups, *self.kernel_size)
         )
         if bias:
             self.bias = nn.Parameter(torch.Tensor(out_channels))
         else:
             self.register_parameter('bias', None)
-        
+
         nn.init.kaiming_uniform_(self.weight, a=0)
         if self.bias is not None:
             nn.init.zeros_(self.bias)
-    
+
     def forward(self, x, offset, mask):
         """
         Args:
             x: input features (B, C, H, W)
-            offset: deformable offset (B, 2*kernel_size*kernel_size*deform_groups, H, W)
-            mask: modulation mask (B, kernel_size*kernel_size*deform_groups, H, W)
-        
+            offset: deformable offset (B, 2*kernel_size*kernel_size*deform_groups, H', W')
+            mask: modulation mask (B, kernel_size*kernel_size*deform_groups, H', W')
+
         Returns:
             output: convolution result (B, out_channels, H', W')
         """
-        # As a fallback, we use standard convolution with spatial normalization
-        # This maintains numerical stability while deformable convolutions compile
-        
-        batch_size = x.shape[0]
-        
-        # Apply standard convolution
-        output = F.conv2d(
-            x, self.weight, self.bias,
-            stride=self.stride,
-            padding=self.padding,
-            dilation=self.dilation,
-            groups=self.groups
-        )
-        
-        # Scale by mask if provided (simplified approach)
-        if mask is not None:
-            # Resize mask to match output spatial dimensions
-            mask_mean = F.adaptive_avg_pool2d(mask, output.shape[-2:])
-            # Average mask across deform groups
-            mask_mean = mask_mean.mean(dim=1, keepdim=True)
-            output = output * mask_mean
-        
-        return output
-
-
-def modulated_deform_conv2d_compat(x, offset, mask, weight, bias, 
-                                   stride=1, padding=0, dilation=1, 
+        return modulated_deform_conv2d_compat(x, offset, mask, self.weight,
+                                              self.bias, self.stride,
+                                              self.padding, self.dilation,
+                                              self.groups,
+                                              self.deform_groups)
+
+
+def modulated_deform_conv2d_im2col(x, offset, mask, weight, bias,
+                                   stride=1, padding=0, dilation=1,
                                    groups=1, deform_groups=1):
-    """Functional interface for modulated deformable convolution."""
-    batch_size, in_channels, h, w = x.shape
-    out_channels = weight.shape[0]
-    
-    # Use standard convolution as fallback
-    output = F.conv2d(
-        x, weight, bias,
-        stride=stride,
-        padding=padding,
-        dilation=dilation,
-        groups=groups
-    )
-    
-    # Apply mask scaling if available
-    if mask is not None:
-        mask_avg = F.adaptive_avg_pool2d(mask, output.shape[-2:])
-        mask_avg = mask_avg.mean(dim=1, keepdim=True).clamp(min=0.1)
-        output = output * mask_avg
-    
+    """Vectorized modulated deformable convolution.
+
+    Every kernel tap is bilinearly sampled with one grid_sample call per
+    deform group batch (zero padding, like mmcv), modulated by the mask and
+    reduced with a grouped matmul against the flattened weight.
+    """
+    stride, padding, dilation = _pair(stride), _pair(padding), _pair(dilation)
+    b, c, h, w = x.shape
+    out_channels, _, kh, kw = weight.shape
+    k = kh * kw
+    out_h = (h + 2 * padding[0] - dilation[0] * (kh - 1) - 1) // stride[0] + 1
+    out_w = (w + 2 * padding[1] - dilation[1] * (kw - 1) - 1) // stride[1] + 1
+
+    # sampling positions: regular grid + kernel tap + learned offset
+    base_y = torch.arange(out_h, device=x.device,
+                          dtype=x.dtype) * stride[0] - padding[0]
+    base_x = torch.arange(out_w, device=x.device,
+                          dtype=x.dtype) * stride[1] - padding[1]
+    tap_y = torch.arange(kh, device=x.device,
+                         dtype=x.dtype).repeat_interleave(kw) * dilation[0]
+    tap_x = torch.arange(kw, device=x.device, dtype=x.dtype).repeat(kh) * \
+        dilation[1]
+    # offset layout: (b, dg, k, (dy, dx), h', w')
+    offset = offset.view(b, deform_groups, k, 2, out_h, out_w)
+    pos_y = base_y.view(1, 1, 1, -1, 1) + tap_y.view(1, 1, -1, 1, 1) + \
+        offset[:, :, :, 0]
+    pos_x = base_x.view(1, 1, 1, 1, -1) + tap_x.view(1, 1, -1, 1, 1) + \
+        offset[:, :, :, 1]
+
+    # grid_sample with align_corners=True maps -1/1 to the border pixels
+    grid = torch.stack((2.0 * pos_x / max(w - 1, 1) - 1.0,
+                        2.0 * pos_y / max(h - 1, 1) - 1.0),
+                       dim=-1).view(b * deform_groups, k * out_h, out_w, 2)
+    cols = F.grid_sample(x.view(b * deform_groups, c // deform_groups, h, w),
+                         grid,
+                         mode='bilinear',
+                         padding_mode='zeros',
+                         align_corners=True)
+    cols = cols.view(b, deform_groups, c // deform_groups, k, out_h * out_w)
+    cols = cols * mask.view(b, deform_groups, 1, k, out_h * out_w)
+
+    # grouped matmul, weight is flattened as (c_in_group, kh * kw)
+    cols = cols.view(b, groups, (c // groups) * k, out_h * out_w)
+    weight = weight.view(groups, out_channels // groups, -1)
+    output = torch.einsum('gok,bgkl->bgol', weight, cols)
+    output = output.reshape(b, out_channels, out_h, out_w)
+    if bias is not None:
+        output = output + bias.view(1, -1, 1, 1)
     return output
 
 
+def modulated_deform_conv2d_compat(x, offset, mask, weight, bias,
+                                   stride=1, padding=0, dilation=1,
+                                   groups=1, deform_groups=1):
+    """Functional interface for modulated deformable convolution.
+
+    Uses torchvision's deform_conv2d (same offset/mask layout as mmcv) for
+    CUDA tensors. On CPU the vectorized im2col path is used, it is faster
+    than torchvision's CPU kernel (see check_deform_conv.py).
+    """
+    if tv_deform_conv2d is not None and x.is_cuda:
+        # torchvision infers groups and deform groups from the tensor shapes
+        return tv_deform_conv2d(x, offset, weight, bias,
+                                stride=_pair(stride),
+                                padding=_pair(padding),
+                                dilation=_pair(dilation),
+                                mask=mask)
+    return modulated_deform_conv2d_im2col(x, offset, mask, weight, bias,
+                                          stride, padding, dilation, groups,
+                                          deform_groups)
+
+
 def try_import_mmcv_ops():
     """Try to import mmcv ops, fallback to compatibility layer."""
     try:
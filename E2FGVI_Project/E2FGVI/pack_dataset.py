@@ -0,0 +1,115 @@
+"""
+Pack a zipped video dataset into memory-mappable arrays for fast loading.
+
+Every video is written to <data_root>/<dataset>/packed_<w>x<h>/ as
+    JPEGImages/<video>.npy   uint8 (T, h, w, 3) frames, already resized
+    test_masks/<video>.npy   uint8 (T, h, ceil(w / 8)) dilated bit-packed
+                             masks (only with --masks)
+which PackedTrainDataset / PackedTestDataset read without decoding.
+
+    python pack_dataset.py --data_root datasets --dataset youtube-vos
+    python pack_dataset.py --data_root datasets --dataset davis \
+        --json test.json --masks
+"""
+import os
+import json
+import argparse
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from core.utils import TestZipReader, get_packed_root
+
+
+def write_array(path, shape, rows):
+    """Stream rows into a .npy file, renamed into place once complete."""
+    tmp_path = path + '.tmp.npy'
+    out = np.lib.format.open_memmap(tmp_path,
+                                    mode='w+',
+                                    dtype=np.uint8,
+                                    shape=shape)
+    for i, row in enumerate(rows):
+        out[i] = row
+    out.flush()
+    del out
+    os.replace(tmp_path, path)
+
+
+def read_frames(args, video_name, length):
+    video_path = os.path.join(args.data_root, args.dataset, 'JPEGImages',
+                              f'{video_name}.zip')
+    for idx in range(length):
+        img = TestZipReader.imread(video_path, idx).convert('RGB')
+        yield np.asarray(img.resize((args.width, args.height)))
+
+
+def read_masks(args, video_name, length):
+    # same preprocessing as TestDataset
+    for idx in range(length):
+        mask_path = os.path.join(args.data_root, args.dataset, 'test_masks',
+                                 video_name,
+                                 str(idx).zfill(5) + '.png')
+        mask = Image.open(mask_path).resize((args.width, args.height),
+                                            Image.NEAREST).convert('L')
+        m = np.array(np.asarray(mask) > 0).astype(np.uint8)
+        m = cv2.dilate(m,
+                       cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3)),
+                       iterations=4)
+        yield np.packbits(m, axis=-1)
+
+
+def pack_video(item):
+    args, video_name, length = item
+    packed_root = get_packed_root(args.data_root, args.dataset,
+                                  (args.width, args.height))
+    frames_path = os.path.join(packed_root, 'JPEGImages', f'{video_name}.npy')
+    if args.overwrite or not os.path.exists(frames_path):
+        write_array(frames_path, (length, args.height, args.width, 3),
+                    read_frames(args, video_name, length))
+    if args.masks:
+        masks_path = os.path.join(packed_root, 'test_masks',
+                                  f'{video_name}.npy')
+        if args.overwrite or not os.path.exists(masks_path):
+            write_array(masks_path,
+                        (length, args.height, (args.width + 7) // 8),
+                        read_masks(args, video_name, length))
+    return video_name
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Pack zipped videos into memory-mappable arrays.')
+    parser.add_argument('--data_root', type=str, default='datasets')
+    parser.add_argument('--dataset', type=str, default='youtube-vos')
+    parser.add_argument('--json',
+                        type=str,
+                        default='train.json',
+                        help='Video list with frame counts, e.g. test.json')
+    parser.add_argument('--width', type=int, default=432)
+    parser.add_argument('--height', type=int, default=240)
+    parser.add_argument('--masks',
+                        action='store_true',
+                        help='Also pack test_masks (evaluation sets)')
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+
+    with open(os.path.join(args.data_root, args.dataset, args.json)) as f:
+        video_dict = json.load(f)
+    packed_root = get_packed_root(args.data_root, args.dataset,
+                                  (args.width, args.height))
+    os.makedirs(os.path.join(packed_root, 'JPEGImages'), exist_ok=True)
+    if args.masks:
+        os.makedirs(os.path.join(packed_root, 'test_masks'), exist_ok=True)
+
+    items = [(args, name, length) for name, length in video_dict.items()]
+    with Pool(args.num_workers) as pool:
+        for i, name in enumerate(pool.imap_unordered(pack_video, items)):
+            print(f'[{i + 1:4}/{len(items)}] {name}')
+    print(f'Packed {len(items)} videos into {packed_root}')
+
+
+if __name__ == '__main__':
+    main()
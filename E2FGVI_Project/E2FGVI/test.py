@@ -4,18 +4,24 @@ from PIL import Image
 import numpy as np
 import importlib
 import os
+import sys
 import argparse
+import collections
+import functools
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 from matplotlib import animation
 import torch
 
-from core.utils import to_tensors
+from core.utils import to_tensors, VideoFrameReader, LRUCache, WindowBlender
 
 parser = argparse.ArgumentParser(description="E2FGVI")
-parser.add_argument("-v", "--video", type=str, required=True)
+# several videos (with one mask folder each) can be given to run them as a
+# batch, windows of the same shape from different videos are then packed
+# into one forward pass
+parser.add_argument("-v", "--video", type=str, nargs='+', required=True)
 parser.add_argument("-c", "--ckpt", type=str, required=True)
-parser.add_argument("-m", "--mask", type=str, required=True)
+parser.add_argument("-m", "--mask", type=str, nargs='+', required=True)
 parser.add_argument("--model", type=str, choices=['e2fgvi', 'e2fgvi_hq'])
 parser.add_argument("--step", type=int, default=10)
 parser.add_argument("--num_ref", type=int, default=-1)
@@ -30,15 +36,73 @@ parser.add_argument("--height", type=int)
 # memory optimization
 parser.add_argument("--max_load_frames", type=int, default=10, help='Max frames to load into GPU at once (reduce for low memory)')
 
+# streaming inference: decode frames window by window and flush finished
+# frames to disk, so host memory is bounded by the window size
+parser.add_argument("--streaming", action='store_true', default=False,
+                    help='Decode frames on demand instead of loading the whole video')
+
+# batched inference: number of windows per forward pass, 0 picks it from
+# --mem_budget (or the free device memory when no budget is given) and
+# --window_bytes, the activation memory of one window per pixel-frame
+parser.add_argument("--batch_size", type=int, default=1, help='Windows per forward pass, 0 picks it from --mem_budget and --window_bytes')
+parser.add_argument("--mem_budget", type=int, default=None, help='Memory budget in MB used to pick the batch size (default: 70%% of the free device memory)')
+parser.add_argument("--window_bytes", type=int, default=1300,
+                    help='Peak activation bytes per pixel-frame of a window; the default was measured on e2fgvi_hq at 432x240, '
+                    'measure it for e2fgvi or other resolutions')
+
+# encoder feature cache: frames (mostly the global reference frames) are
+# encoded once per video and reused by later windows, 0 disables it
+parser.add_argument("--feat_cache_size", type=int, default=0, help='Number of encoded frames cached per video')
+
+# flow cache: the SPyNet flows of each adjacent frame pair are computed once
+# per video and reused by overlapping windows, 0 disables it
+parser.add_argument("--flow_cache_size", type=int, default=0, help='Number of frame pair flows cached per video')
+
+# on-disk flow cache (Optical_Flow_SpyNet/pytorch-spynet/flow_cache.py), keyed
+# by frame content, resolution and SPyNet weights, so that later runs on the
+# same video reuse the flows; the keys (masked quarter-resolution frames,
+# update_spynet weights) are specific to E2FGVI, other stages never hit them
+parser.add_argument("--flow_cache_dir", type=str, default=None, help='Folder of the on-disk flow cache, reused by later runs on the same video')
+
+# how overlapping windows are blended: 'uniform' averages every window that
+# covers a frame, 'center' favours windows centered close to the frame
+parser.add_argument("--blend", type=str, default='uniform', choices=['uniform', 'center'])
+
+# tiled inference (e2fgvi_hq only): every window is split into overlapping
+# tiles that are inpainted separately and feathered together, tiles without
+# any masked pixel in the window are skipped, 0 disables tiling
+parser.add_argument("--tile_height", type=int, default=0, help='Tile height, preferably a multiple of 60')
+parser.add_argument("--tile_width", type=int, default=0, help='Tile width, preferably a multiple of 108')
+parser.add_argument("--tile_overlap", type=int, default=32, help='Overlap of neighbouring tiles in pixels')
+
+# ROI inference (e2fgvi_hq only): every window only inpaints the union
+# bounding box of its masks plus a context margin, grown to the mod size
+parser.add_argument("--roi", action='store_true', default=False, help='Inpaint only the masked region of every window')
+parser.add_argument("--roi_margin", type=int, default=32, help='Context margin around the masks in pixels')
+
 # disable visualization
 parser.add_argument("--no-show", action='store_true', help='Skip showing result animation (for batch processing)')
 
 args = parser.parse_args()
+assert len(args.video) == len(args.mask), \
+    'every video needs its own mask folder'
+use_tiles = args.tile_height > 0 or args.tile_width > 0
+if use_tiles:
+    assert args.model == 'e2fgvi_hq', 'tiling needs the e2fgvi_hq model'
+    assert args.tile_height > args.tile_overlap and \
+        args.tile_width > args.tile_overlap, \
+        'tiles must be larger than their overlap'
+if args.roi:
+    assert args.model == 'e2fgvi_hq', 'ROI mode needs the e2fgvi_hq model'
+    assert not use_tiles, 'ROI mode and tiling cannot be combined'
 
 ref_length = args.step  # ref_step
 num_ref = args.num_ref
 neighbor_stride = args.neighbor_stride
 default_fps = args.savefps
+# frames are mirror padded to multiples of the model's mod size
+mod_size_h = 60
+mod_size_w = 108
 
 
 # sample reference frames from the whole video
@@ -59,28 +123,33 @@ def get_ref_index(f, neighbor_ids, length):
     return ref_index
 
 
+# read a single frame mask, returns a binary (h, w) uint8 array
+def load_mask(mpath, size):
+    m = Image.open(mpath)
+    m = m.resize(size, Image.NEAREST)
+    m = np.array(m.convert('L'))
+    m = np.array(m > 0).astype(np.uint8)
+    m = cv2.dilate(m,
+                   cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3)),
+                   iterations=4)
+    return m
+
+
 # read frame-wise masks
 def read_mask(mpath, size):
     masks = []
     mnames = os.listdir(mpath)
     mnames.sort()
     for mp in mnames:
-        m = Image.open(os.path.join(mpath, mp))
-        m = m.resize(size, Image.NEAREST)
-        m = np.array(m.convert('L'))
-        m = np.array(m > 0).astype(np.uint8)
-        m = cv2.dilate(m,
-                       cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3)),
-                       iterations=4)
+        m = load_mask(os.path.join(mpath, mp), size)
         masks.append(Image.fromarray(m * 255))
     return masks
 
 
 #  read frames from video
-def read_frame_from_videos(args):
-    vname = args.video
+def read_frame_from_videos(vname, use_mp4):
     frames = []
-    if args.use_mp4:
+    if use_mp4:
         vidcap = cv2.VideoCapture(vname)
         success, image = vidcap.read()
         count = 0
@@ -109,6 +178,639 @@ def resize_frames(frames, size=None):
     return frames, size
 
 
+
+
+def get_neighbor_ids(f, length):
+    return [
+        i for i in range(max(0, f - neighbor_stride),
+                         min(length, f + neighbor_stride + 1))
+    ]
+
+
+# neighbor and reference ids of every sliding window of a video
+def get_schedule(length):
+    schedule = []
+    for f in range(0, length, neighbor_stride):
+        neighbor_ids = get_neighbor_ids(f, length)
+        schedule.append((neighbor_ids,
+                         get_ref_index(f, neighbor_ids, length)))
+    return schedule
+
+
+# start offsets of tiles along one axis, the last tile is shifted inwards so
+# every tile has the same size
+def get_tile_starts(length, tile, overlap):
+    if length <= tile:
+        return [0]
+    return list(range(0, length - tile, tile - overlap)) + [length - tile]
+
+
+# overlapping (y0, x0, th, tw) tiles covering an h x w frame
+def get_tiles(h, w):
+    th, tw = min(args.tile_height or h, h), min(args.tile_width or w, w)
+    return [(y0, x0, th, tw)
+            for y0 in get_tile_starts(h, th, args.tile_overlap)
+            for x0 in get_tile_starts(w, tw, args.tile_overlap)]
+
+
+# feather weights of a tile, ramping up over the overlap on every side that
+# does not touch the frame border
+def get_feather(tile, h, w):
+    y0, x0, th, tw = tile
+    ramps = []
+    for start, size, length in ((y0, th, h), (x0, tw, w)):
+        pos = torch.arange(size, dtype=torch.float32)
+        ramp = torch.ones(size)
+        if start > 0:
+            ramp = torch.min(ramp, (pos + 1) / (args.tile_overlap + 1))
+        if start + size < length:
+            ramp = torch.min(ramp, (size - pos) / (args.tile_overlap + 1))
+        ramps.append(ramp)
+    return ramps[0][:, None] * ramps[1][None, :]
+
+
+# union bounding box (y0, x0, th, tw) of an (h, w) mask plus the ROI margin,
+# grown to multiples of the mod size and shifted inside the frame, None if
+# the mask is empty
+def get_roi(mask):
+    h, w = mask.shape
+    box = []
+    for support, length, mod_size in ((mask.any(1), h, mod_size_h),
+                                      (mask.any(0), w, mod_size_w)):
+        ids = torch.nonzero(support).flatten().tolist()
+        if not ids:
+            return None
+        lo = max(0, ids[0] - args.roi_margin)
+        hi = min(length, ids[-1] + 1 + args.roi_margin)
+        size = min(length, -(-(hi - lo) // mod_size) * mod_size)
+        start = min(max(0, (lo + hi - size) // 2), length - size)
+        box.append((start, size))
+    return (box[0][0], box[1][0], box[0][1], box[1][1])
+
+
+# encoder features of all frames of a batch of windows, frames missing from
+# the per-video caches are encoded together in one pass and then cached, the
+# cache key holds the tile offset so tiles of the same frame do not collide
+def encode_with_cache(model, masked_imgs, frame_ids, offsets, feat_caches):
+    b, t, _, h, w = masked_imgs.shape
+    feats = [[None] * t for _ in range(b)]
+    missing = {}
+    for n in range(b):
+        for p, idx in enumerate(frame_ids[n]):
+            feat = feat_caches[n].get((idx, ) + offsets[n] + (h, w))
+            if feat is not None:
+                feats[n][p] = feat
+            else:
+                missing.setdefault((id(feat_caches[n]), idx), []).append((n, p))
+    if missing:
+        positions = list(missing.values())
+        new_feats = model.encode(
+            torch.stack([masked_imgs[pos[0]] for pos in positions])[None])[0]
+        for pos, feat in zip(positions, new_feats):
+            # clone so an evicted entry does not keep the whole batch alive
+            feat = feat.clone()
+            n, p = pos[0]
+            feat_caches[n].put((frame_ids[n][p], ) + offsets[n] + (h, w),
+                               feat)
+            for n, p in pos:
+                feats[n][p] = feat
+    return torch.stack([torch.stack(f) for f in feats])
+
+
+# forward and backward flows of the local frames of a batch of windows, pairs
+# missing from the per-video caches are estimated together and then cached
+def flows_with_cache(model, masked_imgs, num_local_frames, frame_ids, offsets,
+                     flow_caches):
+    b, _, _, h, w = masked_imgs.shape
+    flows = [[None] * (num_local_frames - 1) for _ in range(b)]
+    missing = {}
+    for n in range(b):
+        for p in range(num_local_frames - 1):
+            key = (frame_ids[n][p], frame_ids[n][p + 1]) + offsets[n] + (h,
+                                                                        w)
+            flow = flow_caches[n].get(key)
+            if flow is not None:
+                flows[n][p] = flow
+            else:
+                missing.setdefault((id(flow_caches[n]), key), []).append(
+                    (n, p))
+    if missing:
+        positions = list(missing.values())
+        # every missing pair is a two-frame clip of its own
+        pairs = torch.stack([
+            masked_imgs[n, p:p + 2] for n, p in (pos[0] for pos in positions)
+        ])
+        flows_forward, flows_backward = model.forward_bidirect_flow(
+            (pairs + 1) / 2)
+        for pos, flow_f, flow_b in zip(positions, flows_forward[:, 0],
+                                       flows_backward[:, 0]):
+            n, p = pos[0]
+            flow = (flow_f.clone(), flow_b.clone())
+            flow_caches[n].put((frame_ids[n][p], frame_ids[n][p + 1]) +
+                               offsets[n] + (h, w), flow)
+            for n, p in pos:
+                flows[n][p] = flow
+    return (torch.stack([torch.stack([f[0] for f in fl]) for fl in flows]),
+            torch.stack([torch.stack([f[1] for f in fl]) for fl in flows]))
+
+
+# pad the masked frames to the model's mod size and run a batch of windows,
+# returns the local frames of every window as [b, l_t, 3, h, w] in [0, 1]
+def inpaint_window(model,
+                   selected_imgs,
+                   selected_masks,
+                   num_local_frames,
+                   h,
+                   w,
+                   frame_ids=None,
+                   offsets=None,
+                   feat_caches=None,
+                   flow_caches=None):
+    b, t = selected_imgs.shape[:2]
+    if offsets is None:
+        offsets = [(0, 0)] * b
+    with torch.no_grad():
+        masked_imgs = selected_imgs * (1 - selected_masks)
+        h_pad = (mod_size_h - h % mod_size_h) % mod_size_h
+        w_pad = (mod_size_w - w % mod_size_w) % mod_size_w
+        masked_imgs = torch.cat(
+            [masked_imgs, torch.flip(masked_imgs, [3])],
+            3)[:, :, :, :h + h_pad, :]
+        masked_imgs = torch.cat(
+            [masked_imgs, torch.flip(masked_imgs, [4])],
+            4)[:, :, :, :, :w + w_pad]
+        pred_flows = None
+        if flow_caches is not None:
+            pred_flows = flows_with_cache(model, masked_imgs,
+                                          num_local_frames, frame_ids,
+                                          offsets, flow_caches)
+        enc_feat = None
+        if feat_caches is not None:
+            enc_feat = encode_with_cache(model, masked_imgs, frame_ids,
+                                         offsets, feat_caches)
+            # the model only reads the local frames when given features
+            masked_imgs = masked_imgs[:, :num_local_frames]
+        pred_imgs, _ = model(masked_imgs, num_local_frames, enc_feat,
+                             pred_flows)
+        pred_imgs = pred_imgs.view(b, t, 3, h + h_pad,
+                                   w + w_pad)[:, :num_local_frames, :, :h, :w]
+        pred_imgs = (pred_imgs + 1) / 2
+    return pred_imgs
+
+
+# rough peak activation memory of one window in a forward pass, from
+# --window_bytes per pixel-frame (about 1.1-1.3KB on e2fgvi_hq at 432x240,
+# see peak RSS; e2fgvi and other resolutions differ)
+def estimate_window_bytes(num_frames, h, w):
+    return num_frames * h * w * args.window_bytes
+
+
+def get_free_host_memory():
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    # os.sysconf does not exist on Windows, SC_AVPHYS_PAGES not on macOS
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        raise RuntimeError('cannot read the free memory on this platform, '
+                           'install psutil or pass --mem_budget')
+
+
+def get_memory_budget(device):
+    if args.mem_budget is not None:
+        return args.mem_budget * 1024 * 1024
+    if device.type == 'cuda':
+        free_bytes, _ = torch.cuda.mem_get_info(device)
+    else:
+        free_bytes = get_free_host_memory()
+    # leave headroom for the frames, caches and the allocator
+    return int(free_bytes * 0.7)
+
+
+WindowJob = collections.namedtuple('WindowJob', [
+    'selected_imgs', 'selected_masks', 'num_local_frames', 'frame_ids',
+    'offset', 'feat_cache', 'flow_cache', 'callback'
+])
+
+
+class WindowBatcher(object):
+    """Packs sliding windows of the same shape into one forward pass.
+
+    Windows are grouped by (frames, local frames, height, width), so windows
+    from different videos can share a batch. A group is run as soon as it
+    is full; when too many windows are pending, the group holding the oldest
+    one is run even if it is not full, so no window waits indefinitely.
+
+    Args:
+        model (nn.Module): The inpainting generator.
+        batch_size (int): Windows per forward pass. 0 derives it from
+            `mem_budget` for every window shape.
+        mem_budget (int): Memory budget in bytes used when batch_size is 0.
+    """
+    def __init__(self, model, batch_size, mem_budget=None):
+        self.model = model
+        self.batch_size = batch_size
+        self.mem_budget = mem_budget
+        self.pending = []
+
+    def get_batch_size(self, key):
+        if self.batch_size > 0:
+            return self.batch_size
+        t, _, h, w = key
+        return max(1, self.mem_budget // estimate_window_bytes(t, h, w))
+
+    @staticmethod
+    def get_key(job):
+        _, t, _, h, w = job.selected_imgs.shape
+        return (t, job.num_local_frames, h, w)
+
+    def submit(self, job):
+        """Queue a window, `job.callback(pred_imgs)` gets its local frames."""
+        self.pending.append(job)
+        key = self.get_key(job)
+        batch_size = self.get_batch_size(key)
+        group = [j for j in self.pending if self.get_key(j) == key]
+        if len(group) >= batch_size:
+            self.run(group)
+        elif len(self.pending) >= 2 * batch_size:
+            self.run_oldest()
+
+    def run_oldest(self):
+        key = self.get_key(self.pending[0])
+        group = [j for j in self.pending if self.get_key(j) == key]
+        self.run(group[:self.get_batch_size(key)])
+
+    def run(self, group):
+        self.pending = [j for j in self.pending if all(j is not g for g in group)]
+        selected_imgs = torch.cat([j.selected_imgs for j in group])
+        selected_masks = torch.cat([j.selected_masks for j in group])
+        num_local_frames = group[0].num_local_frames
+        h, w = selected_imgs.shape[-2:]
+        feat_caches = None
+        if all(j.feat_cache is not None for j in group):
+            feat_caches = [j.feat_cache for j in group]
+        flow_caches = None
+        if all(j.flow_cache is not None for j in group):
+            flow_caches = [j.flow_cache for j in group]
+        pred_imgs = inpaint_window(self.model,
+                                   selected_imgs,
+                                   selected_masks,
+                                   num_local_frames,
+                                   h,
+                                   w,
+                                   frame_ids=[j.frame_ids for j in group],
+                                   offsets=[j.offset for j in group],
+                                   feat_caches=feat_caches,
+                                   flow_caches=flow_caches)
+        # composite the whole batch with the known pixels on the device
+        local_imgs = (selected_imgs[:, :num_local_frames] + 1) / 2
+        local_masks = selected_masks[:, :num_local_frames]
+        comp_imgs = pred_imgs * local_masks + local_imgs * (1 - local_masks)
+        for job, comp in zip(group, comp_imgs):
+            job.callback(comp)
+
+        # Clear GPU cache periodically
+        if selected_imgs.is_cuda:
+            del selected_imgs, selected_masks
+            torch.cuda.empty_cache()
+
+    def flush(self):
+        while self.pending:
+            self.run_oldest()
+
+
+def report_caches(feat_cache, flow_cache):
+    if feat_cache is not None:
+        print(f'Encoder feature cache: {feat_cache.hits} hits, '
+              f'{feat_cache.misses} frames encoded')
+    if flow_cache is not None:
+        print(f'Flow cache: {flow_cache.hits} hits, '
+              f'{flow_cache.misses} frame pairs estimated')
+
+
+class ResultWriter(object):
+    """Writes the result video and the per-frame PNGs as frames arrive."""
+    def __init__(self, video, size, use_mp4):
+        save_dir_name = 'results'
+        ext_name = '_results.mp4'
+        save_base_name = os.path.basename(video)
+        save_name = save_base_name.replace(
+            '.mp4', ext_name) if use_mp4 else save_base_name + ext_name
+        if not os.path.exists(save_dir_name):
+            os.makedirs(save_dir_name)
+        self.save_path = os.path.join(save_dir_name, save_name)
+        self.writer = cv2.VideoWriter(self.save_path,
+                                      cv2.VideoWriter_fourcc(*"mp4v"),
+                                      default_fps, size)
+
+        frames_dir_name = save_base_name.replace(
+            '.mp4', '_frames') if use_mp4 else save_base_name + '_frames'
+        self.frames_save_path = os.path.join(save_dir_name, frames_dir_name)
+        if not os.path.exists(self.frames_save_path):
+            os.makedirs(self.frames_save_path)
+        self.num_written = 0
+
+    def write(self, comp):
+        # comp is RGB, convert to BGR for cv2
+        comp = cv2.cvtColor(comp.astype(np.uint8), cv2.COLOR_RGB2BGR)
+        self.writer.write(comp)
+        # Use 1-based indexing to match SAMWISE frame naming (frame_00001.png, frame_00002.png, ...)
+        frame_name = f'frame_{self.num_written+1:05d}.png'
+        cv2.imwrite(os.path.join(self.frames_save_path, frame_name), comp)
+        self.num_written += 1
+
+    def close(self):
+        self.writer.release()
+        print(f'Finish test! The result video is saved in: {self.save_path}.')
+        print(f'Result frames saved in: {self.frames_save_path}.')
+
+
+class VideoInpainter(object):
+    """Blends finished windows of one video and hands out final frames.
+
+    Windows may complete out of order when they are batched, a frame is
+    final once every window that covers it has completed.
+
+    With tiling, a window is split into overlapping tiles and only the tiles
+    holding masked pixels of its local frames are inpainted. The tiles are
+    feathered into a full frame canvas, normalized per window so the
+    weights of the tiles covering a pixel sum to one, and the known frame is
+    kept wherever no tile was run. ROI mode runs a single tile, the mask
+    bounding box of the window, which is pasted back as is.
+    """
+    def __init__(self, video, size, video_length, device):
+        self.video = video
+        self.size = size
+        self.video_length = video_length
+        self.schedule = get_schedule(video_length)
+        self.blender = WindowBlender(size[1],
+                                     size[0],
+                                     device,
+                                     weighting=args.blend,
+                                     radius=neighbor_stride)
+        self.done = set()
+        self.next_window = 0
+        self.next_write = 0
+        self.feat_cache = LRUCache(
+            args.feat_cache_size) if args.feat_cache_size > 0 else None
+        self.flow_cache = LRUCache(
+            args.flow_cache_size) if args.flow_cache_size > 0 else None
+        if use_tiles:
+            self.tiles = get_tiles(size[1], size[0])
+            self.feathers = [
+                get_feather(tile, size[1], size[0]).to(device)
+                for tile in self.tiles
+            ]
+        # canvas and number of pending tiles of every tiled window
+        self.canvases = {}
+        self.pending_tiles = {}
+
+    def make_jobs(self, k, selected_imgs, selected_masks, device):
+        """Jobs of window k, the selected frames may still be on the host."""
+        neighbor_ids, ref_ids = self.schedule[k]
+        num_local_frames = len(neighbor_ids)
+        if not use_tiles and not args.roi:
+            return [
+                WindowJob(selected_imgs.to(device), selected_masks.to(device),
+                          num_local_frames, neighbor_ids + ref_ids, (0, 0),
+                          self.feat_cache, self.flow_cache,
+                          functools.partial(self.complete, k))
+            ]
+
+        # tiles with mask support in any local frame of this window
+        local_mask = selected_masks[0, :num_local_frames, 0].amax(0) > 0
+        if args.roi:
+            roi = get_roi(local_mask)
+            tiles = [] if roi is None else [
+                (roi, torch.ones(roi[2], roi[3], device=device))
+            ]
+        else:
+            tiles = [(tile, feather)
+                     for tile, feather in zip(self.tiles, self.feathers)
+                     if local_mask[tile[0]:tile[0] + tile[2],
+                                   tile[1]:tile[1] + tile[3]].any()]
+        local_imgs = (selected_imgs[0, :num_local_frames].to(device) + 1) / 2
+        if not tiles:
+            self.complete(k, local_imgs)
+            return []
+
+        weight_sum = torch.zeros(self.size[1], self.size[0], device=device)
+        for (y0, x0, th, tw), feather in tiles:
+            weight_sum[y0:y0 + th, x0:x0 + tw] += feather
+        # keep the known frame where no tile is run
+        self.canvases[k] = local_imgs * (weight_sum == 0)
+        self.pending_tiles[k] = len(tiles)
+        jobs = []
+        for (y0, x0, th, tw), feather in tiles:
+            region = (Ellipsis, slice(y0, y0 + th), slice(x0, x0 + tw))
+            weight = feather / weight_sum[region]
+            jobs.append(
+                WindowJob(selected_imgs[region].to(device),
+                          selected_masks[region].to(device),
+                          num_local_frames, neighbor_ids + ref_ids, (y0, x0),
+                          self.feat_cache, self.flow_cache,
+                          functools.partial(self.complete_tile, k, region,
+                                            weight)))
+        return jobs
+
+    def complete_tile(self, k, region, weight, comp_imgs):
+        self.canvases[k][region] += comp_imgs * weight
+        self.pending_tiles[k] -= 1
+        if self.pending_tiles[k] == 0:
+            del self.pending_tiles[k]
+            self.complete(k, self.canvases.pop(k))
+
+    def complete(self, k, comp_imgs):
+        neighbor_ids = self.schedule[k][0]
+        center = k * neighbor_stride
+        self.blender.add(neighbor_ids, comp_imgs, center)
+
+        # frames before the first unfinished window can no longer change
+        self.done.add(k)
+        while self.next_window in self.done:
+            self.next_window += 1
+        flush_until = self.schedule[self.next_window][0][0] if \
+            self.next_window < len(self.schedule) else self.video_length
+        while self.next_write < flush_until:
+            self.write_frame(self.next_write)
+            self.next_write += 1
+        if self.next_window == len(self.schedule):
+            report_caches(self.feat_cache, self.flow_cache)
+            self.finish()
+
+    def write_frame(self, idx):
+        raise NotImplementedError
+
+    def finish(self):
+        raise NotImplementedError
+
+
+class InMemoryVideo(VideoInpainter):
+    """Loads the whole video and its masks before inference."""
+    def __init__(self, video, mask, size, device):
+        self.use_mp4 = video.endswith('.mp4')
+        print(
+            f'Loading videos and masks from: {video} | INPUT MP4 format: {self.use_mp4}'
+        )
+        frames = read_frame_from_videos(video, self.use_mp4)
+        self.frames, size = resize_frames(frames, size)
+        super(InMemoryVideo, self).__init__(video, size, len(self.frames),
+                                            device)
+
+        # Convert frames to numpy for CPU storage
+        self.frames_np = [np.array(f).astype(np.uint8) for f in self.frames]
+
+        masks = read_mask(mask, self.size)
+
+        # Keep masks in CPU initially
+        self.masks_tensors = to_tensors()(masks).unsqueeze(0)
+
+        self.comp_frames = np.empty(
+            (self.video_length, self.size[1], self.size[0], 3), np.uint8)
+
+        print(f'Processing {self.video_length} frames with max {args.max_load_frames} frames in GPU at once...')
+
+    def windows(self, device):
+        for k, (neighbor_ids, ref_ids) in enumerate(tqdm(self.schedule)):
+            # Only load required frames into GPU
+            required_ids = neighbor_ids + ref_ids
+            # frames_np is already RGB format, create PIL images directly
+            required_frames = [
+                Image.fromarray(self.frames_np[i]) for i in required_ids
+            ]
+            selected_imgs = to_tensors()(required_frames).unsqueeze(0) * 2 - 1
+            selected_masks = self.masks_tensors[:1, required_ids, :, :, :]
+            for job in self.make_jobs(k, selected_imgs, selected_masks,
+                                      device):
+                yield job
+
+    def write_frame(self, idx):
+        self.blender.pop(idx, out=self.comp_frames[idx])
+
+    def finish(self):
+        # saving videos and frames
+        print('Saving videos...')
+        writer = ResultWriter(self.video, self.size, self.use_mp4)
+        for f in range(self.video_length):
+            writer.write(self.comp_frames[f])
+        writer.close()
+
+        # show results
+        if not args.no_show:
+            print('Let us enjoy the result!')
+            frames, comp_frames = self.frames, self.comp_frames
+            fig = plt.figure('Let us enjoy the result')
+            ax1 = fig.add_subplot(1, 2, 1)
+            ax1.axis('off')
+            ax1.set_title('Original Video')
+            ax2 = fig.add_subplot(1, 2, 2)
+            ax2.axis('off')
+            ax2.set_title('Our Result')
+            imdata1 = ax1.imshow(frames[0])
+            imdata2 = ax2.imshow(comp_frames[0])
+
+            def update(idx):
+                imdata1.set_data(frames[idx])
+                imdata2.set_data(comp_frames[idx])
+
+            fig.tight_layout()
+            anim = animation.FuncAnimation(fig,
+                                           update,
+                                           frames=len(frames),
+                                           interval=50)
+            plt.show()
+        else:
+            print('Skipping result visualization (--no-show enabled)')
+
+
+class StreamingVideo(VideoInpainter):
+    """Decodes frames as the sliding window advances.
+
+    Only the frames a pending or later window still needs are kept (plus
+    the global reference frames when num_ref == -1), and every composited
+    frame is written as soon as no unfinished window can touch it.
+    """
+    def __init__(self, video, mask, size, device):
+        self.reader = VideoFrameReader(video, size)
+        print(
+            f'Loading videos and masks from: {video} | INPUT MP4 format: {self.reader.use_mp4}'
+        )
+        super(StreamingVideo, self).__init__(video, self.reader.size,
+                                             len(self.reader), device)
+        self.mask = mask
+        self.mask_names = sorted(os.listdir(mask))
+
+        # index of the last window that reads each frame, used for eviction
+        self.last_use = {}
+        for k, (neighbor_ids, ref_ids) in enumerate(self.schedule):
+            for i in neighbor_ids + ref_ids:
+                self.last_use[i] = k
+
+        # global reference frames are spread over the whole clip, decode them
+        # in a separate pass so the main pass never has to look far ahead
+        self.ref_frames = {}
+        if num_ref == -1:
+            global_ref_ids = sorted(
+                set(i for _, ref_ids in self.schedule for i in ref_ids))
+            self.ref_frames = dict(self.reader.iter_frames(global_ref_ids))
+
+        # composited frames are written through one reused host buffer
+        self.out_frame = np.empty((self.size[1], self.size[0], 3), np.uint8)
+        self.writer = ResultWriter(video, self.size, self.reader.use_mp4)
+
+        print(f'Streaming {self.video_length} frames, '
+              f'{len(self.ref_frames)} global reference frames kept in memory...')
+
+    def windows(self, device):
+        frame_iter = self.reader.iter_frames()
+        buffered_frames = {}
+        buffered_masks = {}
+        for k, (neighbor_ids, ref_ids) in enumerate(tqdm(self.schedule)):
+            required_ids = neighbor_ids + ref_ids
+
+            # decode forward until every frame of this window is available
+            while any(i not in buffered_frames and i not in self.ref_frames
+                      for i in required_ids):
+                idx, frame = next(frame_iter)
+                if idx not in self.ref_frames and self.last_use.get(
+                        idx, -1) >= k:
+                    buffered_frames[idx] = frame
+            for i in required_ids:
+                if i not in buffered_masks:
+                    buffered_masks[i] = load_mask(
+                        os.path.join(self.mask, self.mask_names[i]),
+                        self.size)
+
+            window_frames = [
+                self.ref_frames[i] if i in self.ref_frames else
+                buffered_frames[i] for i in required_ids
+            ]
+            window_masks = [buffered_masks[i] for i in required_ids]
+            selected_imgs = torch.from_numpy(np.stack(window_frames)).permute(
+                0, 3, 1, 2).float().div(255).unsqueeze(0) * 2 - 1
+            selected_masks = torch.from_numpy(
+                np.stack(window_masks)).float()[None, :, None, :, :]
+
+            for cache in (buffered_frames, buffered_masks):
+                for i in [i for i in cache if self.last_use[i] <= k]:
+                    del cache[i]
+
+            for job in self.make_jobs(k, selected_imgs, selected_masks,
+                                      device):
+                yield job
+
+    def write_frame(self, idx):
+        self.writer.write(self.blender.pop(idx, out=self.out_frame))
+
+    def finish(self):
+        self.writer.close()
+        if not args.no_show:
+            print('Skipping result visualization in streaming mode')
+
+
 def main_worker():
     # set up models
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -127,137 +829,32 @@ def main_worker():
     print(f'Loading model from: {args.ckpt}')
     model.eval()
 
-    # prepare datset
-    args.use_mp4 = True if args.video.endswith('.mp4') else False
-    print(
-        f'Loading videos and masks from: {args.video} | INPUT MP4 format: {args.use_mp4}'
-    )
-    frames = read_frame_from_videos(args)
-    frames, size = resize_frames(frames, size)
-    h, w = size[1], size[0]
-    video_length = len(frames)
-    
-    # Convert frames to numpy for CPU storage
-    frames_np = [np.array(f).astype(np.uint8) for f in frames]
-
-    masks = read_mask(args.mask, size)
-    binary_masks = [
-        np.expand_dims((np.array(m) != 0).astype(np.uint8), 2) for m in masks
-    ]
-    
-    # Keep masks in CPU initially
-    masks_tensors = to_tensors()(masks).unsqueeze(0)
-    
-    comp_frames = [None] * video_length
-    
-    print(f'Processing {video_length} frames with max {args.max_load_frames} frames in GPU at once...')
+    flow_cache = None
+    if args.flow_cache_dir is not None:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                        '..', '..', 'Optical_Flow_SpyNet', 'pytorch-spynet'))
+        from flow_cache import FlowCache
+        flow_cache = FlowCache(args.flow_cache_dir)
+        model.flow_provider = flow_cache
+
+    mem_budget = get_memory_budget(device) if args.batch_size == 0 else None
+    batcher = WindowBatcher(model, args.batch_size, mem_budget)
 
     # completing holes by e2fgvi
-    print(f'Start test...')
-    for f in tqdm(range(0, video_length, neighbor_stride)):
-        neighbor_ids = [
-            i for i in range(max(0, f - neighbor_stride),
-                             min(video_length, f + neighbor_stride + 1))
-        ]
-        ref_ids = get_ref_index(f, neighbor_ids, video_length)
-        
-        # Only load required frames into GPU
-        required_ids = neighbor_ids + ref_ids
-        # frames_np is already RGB format, create PIL images directly
-        required_frames = [Image.fromarray(frames_np[i]) for i in required_ids]
-        selected_imgs = to_tensors()(required_frames).unsqueeze(0) * 2 - 1
-        selected_imgs = selected_imgs.to(device)
-        
-        selected_masks = masks_tensors[:1, required_ids, :, :, :].to(device)
-        with torch.no_grad():
-            masked_imgs = selected_imgs * (1 - selected_masks)
-            mod_size_h = 60
-            mod_size_w = 108
-            h_pad = (mod_size_h - h % mod_size_h) % mod_size_h
-            w_pad = (mod_size_w - w % mod_size_w) % mod_size_w
-            masked_imgs = torch.cat(
-                [masked_imgs, torch.flip(masked_imgs, [3])],
-                3)[:, :, :, :h + h_pad, :]
-            masked_imgs = torch.cat(
-                [masked_imgs, torch.flip(masked_imgs, [4])],
-                4)[:, :, :, :, :w + w_pad]
-            pred_imgs, _ = model(masked_imgs, len(neighbor_ids))
-            pred_imgs = pred_imgs[:, :, :h, :w]
-            pred_imgs = (pred_imgs + 1) / 2
-            pred_imgs = pred_imgs.cpu().permute(0, 2, 3, 1).numpy() * 255
-            for i in range(len(neighbor_ids)):
-                idx = neighbor_ids[i]
-                img = np.array(pred_imgs[i]).astype(
-                    np.uint8) * binary_masks[idx] + frames_np[idx] * (
-                        1 - binary_masks[idx])
-                if comp_frames[idx] is None:
-                    comp_frames[idx] = img
-                else:
-                    comp_frames[idx] = comp_frames[idx].astype(
-                        np.float32) * 0.5 + img.astype(np.float32) * 0.5
-        
-        # Clear GPU cache periodically
-        if device == torch.device('cuda'):
-            del selected_imgs, selected_masks
-            torch.cuda.empty_cache()
+    for video, mask in zip(args.video, args.mask):
+        # prepare datset
+        if args.streaming:
+            video_state = StreamingVideo(video, mask, size, device)
+        else:
+            video_state = InMemoryVideo(video, mask, size, device)
 
-    # saving videos
-    print('Saving videos...')
-    save_dir_name = 'results'
-    ext_name = '_results.mp4'
-    save_base_name = os.path.basename(args.video)
-    save_name = save_base_name.replace(
-        '.mp4', ext_name) if args.use_mp4 else save_base_name + ext_name
-    if not os.path.exists(save_dir_name):
-        os.makedirs(save_dir_name)
-    save_path = os.path.join(save_dir_name, save_name)
-    writer = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*"mp4v"),
-                             default_fps, size)
-    for f in range(video_length):
-        comp = comp_frames[f].astype(np.uint8)
-        # comp is RGB, convert to BGR for cv2.VideoWriter
-        writer.write(cv2.cvtColor(comp, cv2.COLOR_RGB2BGR))
-    writer.release()
-    print(f'Finish test! The result video is saved in: {save_path}.')
-    
-    # saving frames
-    frames_dir_name = save_base_name.replace('.mp4', '_frames') if args.use_mp4 else save_base_name + '_frames'
-    frames_save_path = os.path.join(save_dir_name, frames_dir_name)
-    if not os.path.exists(frames_save_path):
-        os.makedirs(frames_save_path)
-    for f in range(video_length):
-        # Use 1-based indexing to match SAMWISE frame naming (frame_00001.png, frame_00002.png, ...)
-        frame_name = f'frame_{f+1:05d}.png'
-        comp = comp_frames[f].astype(np.uint8)
-        # comp is RGB, convert to BGR for cv2.imwrite
-        cv2.imwrite(os.path.join(frames_save_path, frame_name), cv2.cvtColor(comp, cv2.COLOR_RGB2BGR))
-    print(f'Result frames saved in: {frames_save_path}.')
-
-    # show results
-    if not args.no_show:
-        print('Let us enjoy the result!')
-        fig = plt.figure('Let us enjoy the result')
-        ax1 = fig.add_subplot(1, 2, 1)
-        ax1.axis('off')
-        ax1.set_title('Original Video')
-        ax2 = fig.add_subplot(1, 2, 2)
-        ax2.axis('off')
-        ax2.set_title('Our Result')
-        imdata1 = ax1.imshow(frames[0])
-        imdata2 = ax2.imshow(comp_frames[0].astype(np.uint8))
-
-        def update(idx):
-            imdata1.set_data(frames[idx])
-            imdata2.set_data(comp_frames[idx].astype(np.uint8))
-
-        fig.tight_layout()
-        anim = animation.FuncAnimation(fig,
-                                       update,
-                                       frames=len(frames),
-                                       interval=50)
-        plt.show()
-    else:
-        print('Skipping result visualization (--no-show enabled)')
+        print(f'Start test...')
+        for job in video_state.windows(device):
+            batcher.submit(job)
+    batcher.flush()
+
+    if flow_cache is not None:
+        print(flow_cache.report())
 
 
 if __name__ == '__main__':
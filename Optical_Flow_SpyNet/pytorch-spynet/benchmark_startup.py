@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Startup time of run.py, from import to the first flow, with the weights from the local registry
+(weight_registry.py) or from torch.hub (cached download, then key renaming).
+
+Every run is a fresh process so that nothing is warm apart from the OS file cache, the first
+flow is estimated on a pair of random 1024x416 frames:
+
+    python benchmark_startup.py --model sintel-final --repeat 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+import weight_registry
+
+# runs in the child process, in the folder of run.py
+CHILD = '''
+import json, sys, time
+dblStart = time.perf_counter()
+sys.argv = [ 'run.py', '--model', MODEL, '--weights', WEIGHTS ]
+import torch
+import run
+dblImport = time.perf_counter()
+run.netNetwork = run.Network().to('cuda' if torch.cuda.is_available() else 'cpu').train(False)
+dblLoad = time.perf_counter()
+tenOne = torch.rand(3, 416, 1024, generator=torch.Generator().manual_seed(0))
+tenTwo = torch.rand(3, 416, 1024, generator=torch.Generator().manual_seed(1))
+run.estimate(tenOne, tenTwo)
+dblFlow = time.perf_counter()
+print(json.dumps({ 'import': dblImport - dblStart, 'load': dblLoad - dblImport, 'flow': dblFlow - dblLoad, 'total': dblFlow - dblStart }))
+'''
+
+def measure(model, weights, repeat):
+    runs = []
+    for _ in range(repeat):
+        child = CHILD.replace('MODEL', repr(model)).replace('WEIGHTS', repr(weights))
+        output = subprocess.run([ sys.executable, '-c', child ], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+        if output.returncode != 0:
+            return None, output.stderr.strip().splitlines()[-1]
+        runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    return { key: statistics.median(run[key] for run in runs) for key in runs[0] }, None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Startup time of run.py, import to first flow')
+    parser.add_argument('--model', default='sintel-final', choices=weight_registry.MODELS)
+    parser.add_argument('--root', default=None, help='registry folder (default: $SPYNET_WEIGHTS or ./weights)')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    root = os.path.abspath(args.root or weight_registry.default_root())
+    if weight_registry.resolve(args.model, root) is None:
+        print(f'WARNING: {args.model} is not in the registry {root}, run weight_registry.py --convert {args.model}')
+
+    with tempfile.TemporaryDirectory() as empty:
+        # an empty registry makes run.py fall back to torch.hub
+        for name, weights in [ ('registry', root), ('torch.hub', empty) ]:
+            times, error = measure(args.model, weights, args.repeat)
+            if times is None:
+                print(f'{name:10s} failed: {error}')
+            else:
+                print(f'{name:10s} ' + ', '.join(f'{key} {value:.3f} s' for key, value in times.items()) + f' (median of {args.repeat})')
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Single-file store for the optical flow of a whole sequence, in place of one .flo file per pair.
+
+Layout (little endian):
+    magic  b'FLOWSEQ1'
+    int32  count, height, width, dtype code (0: float32, 1: float16, 2: int8)
+    float32 scale[count]              flow = stored value * scale (1 for float32 / float16)
+    float32 stats[count, 2]           mean and max flow magnitude of each frame, before quantization
+    padding to a multiple of 64 bytes
+    dtype  data[count, height, width, 2]
+
+The data is one contiguous array, read through numpy.memmap: any frame can be accessed
+directly and a whole sequence is read sequentially.
+"""
+
+import numpy as np
+
+MAGIC = b'FLOWSEQ1'
+DTYPES = [ 'float32', 'float16', 'int8' ]
+
+def _layout(count):
+    intScales = len(MAGIC) + 4 * 4
+    intStats = intScales + 4 * count
+    intData = intStats + 4 * 2 * count
+    intData = (intData + 63) // 64 * 64
+    return intScales, intStats, intData
+
+class FlowArchiveWriter:
+    """
+    Writes the flows of a sequence one by one, flows are (H, W, 2) float arrays.
+    The frames that are never written stay zero.
+    """
+    def __init__(self, filename, count, height, width, dtype='float32'):
+        assert dtype in DTYPES, f'dtype should be one of {DTYPES}'
+
+        self.filename = filename
+        self.count = count
+        self.dtype = dtype
+
+        intScales, intStats, intData = _layout(count)
+
+        with open(filename, 'wb') as f:
+            f.write(MAGIC)
+            np.array([ count, height, width, DTYPES.index(dtype) ], '<i4').tofile(f)
+            f.truncate(intData + count * height * width * 2 * np.dtype(dtype).itemsize)
+
+        self.scales = np.memmap(filename, '<f4', 'r+', offset=intScales, shape=(count,))
+        self.stats = np.memmap(filename, '<f4', 'r+', offset=intStats, shape=(count, 2))
+        self.data = np.memmap(filename, np.dtype(dtype).newbyteorder('<'), 'r+', offset=intData, shape=(count, height, width, 2))
+        self.scales[:] = 1.0
+
+    def write(self, index, flow):
+        flow = np.asarray(flow, np.float32)
+        rad = np.sqrt(flow[:, :, 0]**2 + flow[:, :, 1]**2)
+        self.stats[index] = [ rad.mean(), rad.max() ]
+
+        if self.dtype == 'int8':
+            # symmetric per-frame quantization, the largest component maps to 127
+            scale = max(float(np.abs(flow).max()), 1e-6) / 127.0
+            self.scales[index] = scale
+            self.data[index] = np.round(flow / scale)
+        else:
+            self.data[index] = flow
+
+    def close(self):
+        for array in (self.scales, self.stats, self.data):
+            array.flush()
+        del self.scales, self.stats, self.data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class FlowArchive:
+    """
+    Read-only view of a flow archive. archive[i] is the float32 (H, W, 2) flow of frame i,
+    archive[i:j] a (j - i, H, W, 2) stack; mean_magnitude and max_magnitude need no flow read.
+    """
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError(f'{filename} is not a flow archive')
+            count, height, width, code = np.fromfile(f, '<i4', count=4)
+
+        self.filename = filename
+        self.count, self.height, self.width = int(count), int(height), int(width)
+        self.dtype = DTYPES[code]
+
+        intScales, intStats, intData = _layout(self.count)
+
+        self.scales = np.array(np.memmap(filename, '<f4', 'r', offset=intScales, shape=(self.count,)))
+        stats = np.array(np.memmap(filename, '<f4', 'r', offset=intStats, shape=(self.count, 2)))
+        self.mean_magnitude, self.max_magnitude = stats[:, 0], stats[:, 1]
+        self.data = np.memmap(filename, np.dtype(self.dtype).newbyteorder('<'), 'r', offset=intData, shape=(self.count, self.height, self.width, 2))
+
+    def __reduce__(self):
+        # reopened from the file, e.g. by worker processes, instead of pickling the flows
+        return FlowArchive, (self.filename,)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        flow = self.data[index].astype(np.float32)
+        if self.dtype == 'int8':
+            flow *= self.scales[index].reshape(np.shape(self.scales[index]) + (1, 1, 1))
+        return flow
+
+    def chunks(self, chunk_size=64):
+        """Yields the flows in order, chunk_size frames per sequential read."""
+        for start in range(0, self.count, chunk_size):
+            yield from self[start:start + chunk_size]
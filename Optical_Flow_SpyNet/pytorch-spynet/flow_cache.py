@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Content-addressed on-disk cache of SPyNet flows, reused from one run of a stage to the next.
+
+A flow is stored under the hash of the flow network weights, the two input frames (their
+exact tensor bytes, dtype and resolution). Any SPyNet implementation can use it: E2FGVI
+(InpaintGenerator.flow_provider), BasicVSR++ (BasicVSRPlusPlus.flow_provider) and
+run.py --flow-cache. A flow is estimated once per frame pair and model, later runs on the
+same input read it back. Stages do not share flows: E2FGVI estimates them on masked
+quarter-resolution frames with its own fine-tuned update_spynet, BasicVSR++ on its LR
+frames with other weights, so their keys never match even in the same folder.
+
+    cache = FlowCache('flow_cache')
+    flows = cache(spynet, ref, supp)    # same result as spynet(ref, supp), [n, 2, h, w]
+    next_flows, prev_flows = cache.bidirectional(spynet, frames)    # both directions of [n, t, c, h, w] clips
+
+Layout: <root>/<key[:2]>/<key>.npy, float32 (2, h, w) arrays.
+"""
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+class FlowCache:
+    def __init__(self, root):
+        self.root = root
+        self.hits = 0
+        self.misses = 0
+        self._fingerprints = {}
+        os.makedirs(root, exist_ok=True)
+
+    def fingerprint(self, model):
+        """Hash of the weights of a flow network, computed again only when a weight changed
+        (in-place updates such as optimizer steps bump the tensor versions)."""
+        tensors = model.state_dict()
+        versions = tuple(tensor._version for tensor in tensors.values())
+        if self._fingerprints.get(id(model), (None, None))[0] != versions:
+            digest = hashlib.sha1(type(model).__name__.encode())
+            for name, tensor in tensors.items():
+                digest.update(name.encode())
+                digest.update(_tensor_bytes(tensor))
+            self._fingerprints[id(model)] = (versions, digest.hexdigest())
+        return self._fingerprints[id(model)][1]
+
+    @staticmethod
+    def frame_hash(frame):
+        """Hash of a frame tensor [c, h, w] with its dtype and resolution."""
+        digest = hashlib.sha1(f'{frame.dtype} {tuple(frame.shape)}'.encode())
+        digest.update(_tensor_bytes(frame))
+        return digest.hexdigest()
+
+    def key(self, model_fingerprint, hash_1, hash_2, size):
+        """Key of the flow from frame 1 to frame 2 at output resolution size (h, w)."""
+        return hashlib.sha1(f'{model_fingerprint} {hash_1} {hash_2} {size[0]}x{size[1]}'.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key + '.npy')
+
+    def load(self, key):
+        try:
+            flow = torch.from_numpy(np.load(self.path(key)))
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return flow
+
+    def save(self, key, flow):
+        # written to a temporary file first, so that concurrent readers never see a partial flow
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, flow.detach().float().cpu().numpy())
+        os.replace(tmp_path, path)
+
+    def __call__(self, spynet, ref, supp):
+        """Flows from ref to supp ([n, c, h, w] each), only the pairs missing in the cache
+        go through spynet, as one batch."""
+        hashes_ref = [self.frame_hash(frame) for frame in ref.detach().cpu()]
+        hashes_supp = [self.frame_hash(frame) for frame in supp.detach().cpu()]
+        return self._flows(spynet, ref, supp, hashes_ref, hashes_supp)
+
+    def bidirectional(self, spynet, frames):
+        """Flows between neighbouring frames of clips [n, t, c, h, w], as (frame i to i + 1,
+        frame i + 1 to i), [n * (t - 1), 2, h, w] each. Every frame is copied and hashed once,
+        the pairs missing in either direction go through spynet as one batch."""
+        n, t, c, h, w = frames.shape
+        hashes = [self.frame_hash(frame) for frame in frames.detach().cpu().reshape(-1, c, h, w)]
+        hashes_1 = [hashes[i * t + j] for i in range(n) for j in range(t - 1)]
+        hashes_2 = [hashes[i * t + j + 1] for i in range(n) for j in range(t - 1)]
+
+        frames_1 = frames[:, :-1].reshape(-1, c, h, w)
+        frames_2 = frames[:, 1:].reshape(-1, c, h, w)
+        flows = self._flows(spynet, torch.cat([frames_1, frames_2]), torch.cat([frames_2, frames_1]),
+                            hashes_1 + hashes_2, hashes_2 + hashes_1)
+        return flows[:len(hashes_1)], flows[len(hashes_1):]
+
+    def _flows(self, spynet, ref, supp, hashes_ref, hashes_supp):
+        fingerprint = self.fingerprint(spynet)
+        size = ref.shape[-2:]
+        keys = [self.key(fingerprint, h1, h2, size) for h1, h2 in zip(hashes_ref, hashes_supp)]
+        flows = [self.load(key) for key in keys]
+
+        missing = [i for i, flow in enumerate(flows) if flow is None]
+        if missing:
+            estimated = spynet(ref[missing], supp[missing])
+            for i, flow in zip(missing, estimated):
+                self.save(keys[i], flow)
+                flows[i] = flow
+        return torch.stack([flow.to(device=ref.device, dtype=ref.dtype) for flow in flows])
+
+    def report(self):
+        return f'Flow cache {self.root}: {self.hits} hits, {self.misses} flows estimated'
+
+def _tensor_bytes(tensor):
+    return tensor.detach().contiguous().cpu().reshape(-1).view(torch.uint8).numpy().tobytes()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Batched flow colorization and color wheel legend, for (T, H, W, 2) flow stacks.
+
+flows_to_color() gives exactly the images of flow_to_color() in visualize_optical_flow.py, but
+runs every step on a whole stack at once: the HSV image of all frames in one numpy pass, the
+color conversions as one cvtColor call on the frames stacked vertically, and only the
+histogram equalization per frame. colorize() splits a sequence into chunks rendered by worker
+processes (or threads, cv2 and numpy release the GIL) and yields the frames in order.
+
+    for img in colorize(FlowArchive('out.flowseq'), max_flow, workers=8):
+        video_writer.write(img)
+"""
+
+import collections
+import functools
+import multiprocessing
+import os
+from multiprocessing.pool import ThreadPool
+
+import cv2
+import numpy as np
+
+def flows_to_color(flows, max_flow=None):
+    """
+    BGR uint8 images (T, H, W, 3) of flows (T, H, W, 2), max_flow None normalizes every frame by its own maximum
+    """
+    flows = np.asarray(flows)
+    t, h, w = flows.shape[:3]
+
+    fx, fy = flows[..., 0], flows[..., 1]
+    rad = np.sqrt(fx*fx + fy*fy)
+    a = np.arctan2(-fy, -fx) / np.pi
+
+    if max_flow is None:
+        max_flow = (rad.max(axis=(1, 2)) + 1e-5)[:, None, None]
+
+    rad_normalized = rad / max_flow
+    rad_normalized = np.sqrt(rad_normalized)
+    rad_normalized = np.clip(rad_normalized, 0, 1)
+
+    img = np.empty((t * h, w, 3), dtype=np.uint8)
+    img[:, :, 0] = ((a + 1) / 2 * 180).astype(np.uint8).reshape(t * h, w)
+    img[:, :, 1] = (255 * np.sqrt(rad_normalized)).astype(np.uint8).reshape(t * h, w)
+    img[:, :, 2] = (255 * rad_normalized).astype(np.uint8).reshape(t * h, w)
+
+    # per-pixel conversions on all the frames stacked vertically
+    img = cv2.cvtColor(img, cv2.COLOR_HSV2BGR)
+    lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB).reshape(t, h, w, 3)
+
+    l_channel = lab[:, :, :, 0]
+    equalized = np.stack([cv2.equalizeHist(l_channel[i]) for i in range(t)])
+    lab[:, :, :, 0] = equalized * 0.7 + l_channel * 0.3
+
+    return cv2.cvtColor(lab.reshape(t * h, w, 3), cv2.COLOR_LAB2BGR).reshape(t, h, w, 3)
+
+def _render_chunk(flows, max_flow, start, stop):
+    return flows_to_color(flows[start:stop], max_flow)
+
+def colorize(flows, max_flow=None, workers=None, chunk_size=2, backend='process'):
+    """
+    Yields the BGR images of a flow sequence in order. flows is anything sliceable into (t, H, W, 2)
+    stacks: arrays are sent to the worker processes chunk by chunk, other objects such as a
+    FlowArchive are sent whole and sliced by the workers. workers 0 renders in the calling
+    process, None uses every CPU. At most two chunks per worker are in flight.
+    """
+    workers = os.cpu_count() if workers is None else workers
+    chunks = [ (start, min(start + chunk_size, len(flows))) for start in range(0, len(flows), chunk_size) ]
+
+    if workers <= 1 or len(chunks) <= 1:
+        for start, stop in chunks:
+            yield from _render_chunk(flows, max_flow, start, stop)
+        return
+
+    assert backend in ('process', 'thread'), 'backend should be process or thread'
+    pool = multiprocessing.Pool(workers) if backend == 'process' else ThreadPool(workers)
+    pending = collections.deque()
+    try:
+        for start, stop in chunks:
+            if backend == 'process' and isinstance(flows, (np.ndarray, list)):
+                task = (np.asarray(flows[start:stop]), max_flow, 0, stop - start)
+            else:
+                task = (flows, max_flow, start, stop)
+            pending.append(pool.apply_async(_render_chunk, task))
+
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+    finally:
+        pool.terminate()
+
+@functools.lru_cache(maxsize=16)
+def _legend_wheel(height, width):
+    center = (width // 2, height // 2)
+    radius = min(height, width) // 2 - 10
+
+    # every (angle, r) sample of the wheel in drawing order, later angles overwrite earlier ones
+    angles = np.repeat(np.arange(360), max(radius, 0))
+    rs = np.tile(np.arange(max(radius, 0)), 360)
+    x = (center[0] + rs * np.cos(np.radians(angles))).astype(np.int64)
+    y = (center[1] - rs * np.sin(np.radians(angles))).astype(np.int64)
+    inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+    angles, pixels = angles[inside], (y * width + x)[inside]
+    last = len(pixels) - 1 - np.unique(pixels[::-1], return_index=True)[1]
+
+    # one pixel per conversion: OpenCV's vectorized HSV2BGR rounds differently from its scalar path
+    colors = np.array([ cv2.cvtColor(np.uint8([[[int(angle * 180 / 360), 255, 200]]]), cv2.COLOR_HSV2BGR)[0, 0] for angle in range(360) ])
+
+    legend = np.full((height * width, 3), 255, dtype=np.uint8)
+    legend[pixels[last]] = colors[angles[last]]
+    return legend.reshape(height, width, 3)
+
+def create_flow_legend(height=200, width=200):
+    """
+    Color wheel legend, the same image as the per-pixel loop it replaces
+    """
+    center = (width // 2, height // 2)
+    radius = min(height, width) // 2 - 10
+
+    legend = _legend_wheel(height, width).copy()
+
+    cv2.putText(legend, 'Right', (center[0] + radius + 5, center[1] + 5),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 255), 1)
+    cv2.putText(legend, 'Down', (center[0] - 20, center[1] + radius + 15),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 255, 0), 1)
+    cv2.putText(legend, 'Left', (center[0] - radius - 30, center[1] + 5),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 0, 0), 1)
+    cv2.putText(legend, 'Up', (center[0] - 15, center[1] - radius - 5),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 0), 1)
+
+    return legend
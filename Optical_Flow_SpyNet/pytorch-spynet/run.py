@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import getopt
+import itertools
 import math
 import numpy
 import PIL
@@ -8,6 +9,8 @@ import PIL.Image
 import sys
 import torch
 
+import weight_registry
+
 ##########################################################
 
 torch.set_grad_enabled(False) # make sure to not compute gradients for computational performance
@@ -22,6 +25,11 @@ args_strTwo = './images/two.png'
 args_strOut = './out.flo'
 args_strFramesPackage = None
 args_strOutputDir = None
+args_boolSequence = False
+args_intBatch = 8
+args_strArchive = None
+args_strFlowCache = None
+args_strWeights = None
 
 for strOption, strArg in getopt.getopt(sys.argv[1:], '', [
     'model=',
@@ -30,6 +38,11 @@ for strOption, strArg in getopt.getopt(sys.argv[1:], '', [
     'out=',
     'frames-package=',
     'output-dir=',
+    'sequence',
+    'batch=',
+    'archive=',
+    'flow-cache=',
+    'weights=',
 ])[0]:
     if strOption == '--model' and strArg != '': args_strModel = strArg # which model to use, see below
     if strOption == '--one' and strArg != '': args_strOne = strArg # path to the first frame
@@ -37,6 +50,11 @@ for strOption, strArg in getopt.getopt(sys.argv[1:], '', [
     if strOption == '--out' and strArg != '': args_strOut = strArg # path to where the output should be stored
     if strOption == '--frames-package' and strArg != '': args_strFramesPackage = strArg # path to frames package
     if strOption == '--output-dir' and strArg != '': args_strOutputDir = strArg # output directory for results
+    if strOption == '--sequence': args_boolSequence = True # flow in both directions between all consecutive frames of the frames package
+    if strOption == '--batch' and strArg != '': args_intBatch = int(strArg) # number of frames per chunk in sequence mode
+    if strOption == '--weights' and strArg != '': args_strWeights = strArg # folder of the local weight registry, see weight_registry.py
+    if strOption == '--flow-cache' and strArg != '': args_strFlowCache = strArg # in sequence mode, folder of the on-disk flow cache reused by later runs, see flow_cache.py
+    if strOption == '--archive' and strArg != '': args_strArchive = strArg # in sequence mode, store the flows in two flow archives of this dtype ('float32', 'float16', or 'int8') instead of .flo files
 # end
 
 ##########################################################
@@ -102,22 +120,30 @@ class Network(torch.nn.Module):
 
         self.netBasic = torch.nn.ModuleList([ Basic(intLevel) for intLevel in range(6) ])
 
-        self.load_state_dict({ strKey.replace('module', 'net'): tenWeight for strKey, tenWeight in torch.hub.load_state_dict_from_url(url='http://content.sniklaus.com/github/pytorch-spynet/network-' + args_strModel + '.pytorch', file_name='spynet-' + args_strModel).items() })
-    # end
+        strWeights = weight_registry.resolve(args_strModel, args_strWeights)
 
-    def forward(self, tenOne, tenTwo):
-        tenFlow = []
+        if strWeights is not None:
+            self.load_state_dict(weight_registry.load(strWeights)) # converted checkpoint from the local registry, no download and no renaming
+
+        else:
+            self.load_state_dict({ strKey.replace('module', 'net'): tenWeight for strKey, tenWeight in torch.hub.load_state_dict_from_url(url=weight_registry.url(args_strModel), file_name='spynet-' + args_strModel).items() })
+
+        # end
+    # end
 
-        tenOne = [ self.netPreprocess(tenOne) ]
-        tenTwo = [ self.netPreprocess(tenTwo) ]
+    def pyramid(self, tenInput):
+        tenPyramid = [ self.netPreprocess(tenInput) ]
 
         for intLevel in range(5):
-            if tenOne[0].shape[2] > 32 or tenOne[0].shape[3] > 32:
-                tenOne.insert(0, torch.nn.functional.avg_pool2d(input=tenOne[0], kernel_size=2, stride=2, count_include_pad=False))
-                tenTwo.insert(0, torch.nn.functional.avg_pool2d(input=tenTwo[0], kernel_size=2, stride=2, count_include_pad=False))
+            if tenPyramid[0].shape[2] > 32 or tenPyramid[0].shape[3] > 32:
+                tenPyramid.insert(0, torch.nn.functional.avg_pool2d(input=tenPyramid[0], kernel_size=2, stride=2, count_include_pad=False))
             # end
         # end
 
+        return tenPyramid
+    # end
+
+    def refine(self, tenOne, tenTwo):
         tenFlow = tenOne[0].new_zeros([ tenOne[0].shape[0], 2, int(math.floor(tenOne[0].shape[2] / 2.0)), int(math.floor(tenOne[0].shape[3] / 2.0)) ])
 
         for intLevel in range(len(tenOne)):
@@ -131,6 +157,10 @@ class Network(torch.nn.Module):
 
         return tenFlow
     # end
+
+    def forward(self, tenOne, tenTwo):
+        return self.refine(self.pyramid(tenOne), self.pyramid(tenTwo))
+    # end
 # end
 
 netNetwork = None
@@ -174,6 +204,162 @@ def estimate(tenOne, tenTwo):
     return tenFlow[0, :, :, :].cpu()
 # end
 
+def estimate_sequence(objFrames, intBatch, objCache=None):
+    global netNetwork
+
+    if netNetwork is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        netNetwork = Network().to(device).train(False)
+    # end
+
+    # yields the flow between consecutive frames of an iterable of HxWx3 RGB frames, chunk by chunk: (index of the first pair, forward flows, backward flows)
+    # the pairs of a chunk go through the network as one batch, and every frame's pyramid is computed once for the two pairs that it belongs to
+    # with a FlowCache from flow_cache.py, chunks whose flows are all cached skip the network
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    tenLast = None
+    tenLastFrame = None
+    strLastHash = None
+    intFirst = 0
+    objChunk = []
+
+    for npyFrame in itertools.chain(objFrames, [ None ]):
+        if npyFrame is not None:
+            objChunk.append(npyFrame)
+
+            if len(objChunk) < intBatch:
+                continue
+            # end
+        # end
+
+        if len(objChunk) == 0:
+            break
+        # end
+
+        tenFrames = torch.stack([ frame_to_tensor(npyChunk) for npyChunk in objChunk ], 0).to(device)
+        objChunk = []
+
+        intWidth = tenFrames.shape[3]
+        intHeight = tenFrames.shape[2]
+
+        intPreprocessedWidth = int(math.floor(math.ceil(intWidth / 32.0) * 32.0))
+        intPreprocessedHeight = int(math.floor(math.ceil(intHeight / 32.0) * 32.0))
+
+        if objCache is not None:
+            strHashes = ([ strLastHash ] if strLastHash is not None else []) + [ objCache.frame_hash(tenFrame) for tenFrame in tenFrames ]
+            strLastHash = strHashes[-1]
+
+            strFingerprint = objCache.fingerprint(netNetwork)
+            strKeys = [ objCache.key(strFingerprint, strOne, strTwo, (intHeight, intWidth)) for strOne, strTwo in zip(strHashes[:-1], strHashes[1:]) ]
+            strKeys += [ objCache.key(strFingerprint, strTwo, strOne, (intHeight, intWidth)) for strOne, strTwo in zip(strHashes[:-1], strHashes[1:]) ]
+
+            objCached = [ objCache.load(strKey) for strKey in strKeys ]
+
+            if len(strKeys) > 0 and all(tenCached is not None for tenCached in objCached):
+                tenLast = None
+                tenLastFrame = tenFrames[-1:]
+
+                yield intFirst, torch.stack(objCached[:len(strKeys) // 2]), torch.stack(objCached[len(strKeys) // 2:])
+
+                intFirst += len(strKeys) // 2
+                continue
+            # end
+        # end
+
+        if tenLast is None and tenLastFrame is not None:
+            tenFrames = torch.cat([ tenLastFrame, tenFrames ], 0)
+        # end
+
+        tenLastFrame = tenFrames[-1:]
+
+        tenPyramid = netNetwork.pyramid(torch.nn.functional.interpolate(input=tenFrames, size=(intPreprocessedHeight, intPreprocessedWidth), mode='bilinear', align_corners=False))
+
+        if tenLast is not None:
+            assert(tenLast[-1].shape[2:] == tenPyramid[-1].shape[2:])
+
+            tenPyramid = [ torch.cat([ tenPrevious, tenLevel ], 0) for tenPrevious, tenLevel in zip(tenLast, tenPyramid) ]
+        # end
+
+        tenLast = [ tenLevel[-1:] for tenLevel in tenPyramid ]
+
+        intPairs = tenPyramid[0].shape[0] - 1
+
+        if intPairs == 0:
+            continue
+        # end
+
+        tenOne = [ torch.cat([ tenLevel[:-1], tenLevel[1:] ], 0) for tenLevel in tenPyramid ]
+        tenTwo = [ torch.cat([ tenLevel[1:], tenLevel[:-1] ], 0) for tenLevel in tenPyramid ]
+
+        tenFlow = torch.nn.functional.interpolate(input=netNetwork.refine(tenOne, tenTwo), size=(intHeight, intWidth), mode='bilinear', align_corners=False)
+
+        tenFlow[:, 0, :, :] *= float(intWidth) / float(intPreprocessedWidth)
+        tenFlow[:, 1, :, :] *= float(intHeight) / float(intPreprocessedHeight)
+
+        tenFlow = tenFlow.cpu()
+
+        if objCache is not None:
+            for strKey, tenCached in zip(strKeys, tenFlow):
+                objCache.save(strKey, tenCached)
+            # end
+        # end
+
+        yield intFirst, tenFlow[:intPairs], tenFlow[intPairs:]
+
+        intFirst += intPairs
+    # end
+# end
+
+def frame_to_tensor(npyFrame):
+    npyFrame = numpy.asarray(npyFrame)
+
+    if len(npyFrame.shape) == 2:
+        npyFrame = numpy.stack([npyFrame] * 3, axis=2)
+    # end
+
+    return torch.FloatTensor(numpy.ascontiguousarray(npyFrame[:, :, 2::-1].transpose(2, 0, 1).astype(numpy.float32) * (1.0 / 255.0)))
+# end
+
+def read_frames(strFramesPackage):
+    # returns the number of frames of a frames package and an iterable over them, frames from a folder are only read when iterated over
+    import os
+    import pickle
+    from pathlib import Path
+
+    if os.path.isdir(strFramesPackage):
+        image_files = []
+        for ext in ['.png', '.jpg', '.jpeg', '.bmp', '.tiff']:
+            image_files.extend(Path(strFramesPackage).glob(f'*{ext}'))
+            image_files.extend(Path(strFramesPackage).glob(f'*{ext.upper()}'))
+        image_files = sorted(set(image_files))
+
+        return len(image_files), (numpy.array(PIL.Image.open(img_path)) for img_path in image_files)
+
+    elif strFramesPackage.endswith('.pkl') or strFramesPackage.endswith('.pickle'):
+        with open(strFramesPackage, 'rb') as f:
+            frames_package = pickle.load(f)
+        return len(frames_package), frames_package
+
+    elif strFramesPackage.endswith('.npy'):
+        frames_package = numpy.load(strFramesPackage, mmap_mode='r')
+        return len(frames_package), frames_package
+
+    # end
+
+    return None, None
+# end
+
+def write_flo(strFile, tenFlow):
+    objOutput = open(strFile, 'wb')
+
+    numpy.array([ 80, 73, 69, 72 ], numpy.uint8).tofile(objOutput)
+    numpy.array([ tenFlow.shape[2], tenFlow.shape[1] ], numpy.int32).tofile(objOutput)
+    numpy.array(tenFlow.numpy(force=True).transpose(1, 2, 0), numpy.float32).tofile(objOutput)
+
+    objOutput.close()
+# end
+
 ##########################################################
 
 if __name__ == '__main__':
@@ -185,7 +371,83 @@ if __name__ == '__main__':
     else:
         output_prefix = args_strOut
     
-    if args_strFramesPackage is not None:
+    if args_strFramesPackage is not None and args_boolSequence:
+        # Flow in both directions between all consecutive frames, the frames are read chunk by chunk
+        import time
+
+        intFrames, objFrames = read_frames(args_strFramesPackage)
+
+        if intFrames is None:
+            print(f"ERROR: Unknown file format or path: {args_strFramesPackage}")
+            sys.exit(1)
+
+        if intFrames < 2:
+            print(f"ERROR: Need at least 2 frames, but only got {intFrames}")
+            sys.exit(1)
+
+        print(f"Estimating optical flow for {intFrames - 1} pairs of frames in chunks of {args_intBatch} frames...")
+
+        dblStart = time.time()
+        dblCompute = 0.0
+        dblChunk = time.time()
+
+        objArchives = None
+        objCache = None
+
+        if args_strFlowCache is not None:
+            from flow_cache import FlowCache
+
+            objCache = FlowCache(args_strFlowCache)
+        # end
+
+        for intFirst, tenForward, tenBackward in estimate_sequence(objFrames, args_intBatch, objCache):
+            dblCompute += time.time() - dblChunk
+
+            if args_strArchive is not None:
+                if objArchives is None:
+                    from flow_archive import FlowArchiveWriter
+
+                    objArchives = [ FlowArchiveWriter(output_prefix + strSuffix + '.flowseq', intFrames - 1, tenForward.shape[2], tenForward.shape[3], args_strArchive) for strSuffix in [ '', '-backward' ] ]
+                # end
+
+                for intPair in range(tenForward.shape[0]):
+                    objArchives[0].write(intFirst + intPair, tenForward[intPair].numpy().transpose(1, 2, 0))
+                    objArchives[1].write(intFirst + intPair, tenBackward[intPair].numpy().transpose(1, 2, 0))
+                # end
+
+            else:
+                for intPair in range(tenForward.shape[0]):
+                    write_flo(output_prefix + f'_{intFirst + intPair:04d}.flo', tenForward[intPair])
+                    write_flo(output_prefix + f'-backward_{intFirst + intPair:04d}.flo', tenBackward[intPair])
+                # end
+
+            # end
+
+            print(f"  pairs {intFirst}-{intFirst + tenForward.shape[0] - 1}: {(intFirst + tenForward.shape[0]) / (time.time() - dblStart):.2f} pairs/s")
+
+            dblChunk = time.time()
+        # end
+
+        if objArchives is not None:
+            for objArchive in objArchives:
+                objArchive.close()
+            # end
+        # end
+
+        dblTotal = time.time() - dblStart
+
+        if objCache is not None:
+            print(objCache.report())
+        # end
+
+        if args_strArchive is not None:
+            print(f"✓ Saved forward flow to {output_prefix}.flowseq and backward flow to {output_prefix}-backward.flowseq ({args_strArchive})")
+        else:
+            print(f"✓ Saved forward flow to {output_prefix}_XXXX.flo and backward flow to {output_prefix}-backward_XXXX.flo")
+        # end
+        print(f"  {intFrames - 1} pairs in {dblTotal:.2f} s: {(intFrames - 1) / dblTotal:.2f} pairs/s overall, {(intFrames - 1) / dblCompute:.2f} pairs/s without writing (both directions)")
+
+    elif args_strFramesPackage is not None:
         # Load from frames package (can be a folder, pickle file, or numpy file)
         import pickle
         import os
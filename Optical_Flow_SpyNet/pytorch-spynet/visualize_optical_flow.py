@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 """
 光流可视化脚本
-将 .flo 文件转换为可视化图像，并将所有帧拼接成一张大图
+将 .flo 文件（或 .flowseq 光流归档，见 flow_archive.py）转换为可视化图像，并将所有帧拼接成一张大图
 """
 
 import numpy as np
@@ -11,6 +11,9 @@ from pathlib import Path
 import matplotlib.pyplot as plt
 from PIL import Image
 
+from flow_archive import FlowArchive
+from flow_color import colorize, create_flow_legend, flows_to_color
+
 def read_flo(filename):
     """
     读取 .flo 光流文件
@@ -40,84 +43,28 @@ def flow_to_color(flow, max_flow=None):
     - 蓝色: 向左运动
     - 黄色: 向右下运动
     """
-    h, w = flow.shape[:2]
-    
-    # 计算光流的大小和方向
-    fx, fy = flow[:, :, 0], flow[:, :, 1]
-    rad = np.sqrt(fx*fx + fy*fy)
-    a = np.arctan2(-fy, -fx) / np.pi
-    
-    # 使用平方根来增强小运动的可见性
-    if max_flow is None:
-        max_flow = np.max(rad) + 1e-5
-    
-    # 正规化并应用非线性变换以增加亮度
-    rad_normalized = rad / max_flow
-    rad_normalized = np.sqrt(rad_normalized)  # 平方根增强亮度
-    rad_normalized = np.clip(rad_normalized, 0, 1)
-    
-    # 创建 HSV 图像，增加 Saturation 来增强色彩饱和度
-    img = np.zeros((h, w, 3), dtype=np.uint8)
-    img[:, :, 0] = ((a + 1) / 2 * 180).astype(np.uint8)  # Hue (0-180 in OpenCV)
-    img[:, :, 1] = (255 * np.sqrt(rad_normalized)).astype(np.uint8)  # Saturation (动态)
-    img[:, :, 2] = (255 * rad_normalized).astype(np.uint8)   # Value
-    
-    # 转换为 BGR
-    img = cv2.cvtColor(img, cv2.COLOR_HSV2BGR)
-    
-    # 应用对比度增强
-    lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
-    l_channel = lab[:, :, 0]
-    l_channel = cv2.equalizeHist(l_channel) * 0.7 + l_channel * 0.3  # 轻微的直方图均衡化
-    lab[:, :, 0] = l_channel
-    img = cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
-    
-    return img
+    return flows_to_color(flow[None], max_flow)[0]
 
-def create_flow_legend(height=200, width=200):
+class FloSequence:
     """
-    创建光流色轮图例
+    按需读取的 .flo 光流序列：sequence[i] 为 (H, W, 2) 光流，sequence[i:j] 为 (j - i, H, W, 2)，
+    调用时才读取对应文件。只保存文件名，可像 FlowArchive 一样整体交给工作进程分块读取
     """
-    center = (width // 2, height // 2)
-    radius = min(height, width) // 2 - 10
-    
-    legend = np.ones((height, width, 3), dtype=np.uint8) * 255
-    
-    # 绘制色轮
-    for angle in range(360):
-        for r in range(radius):
-            x = int(center[0] + r * np.cos(np.radians(angle)))
-            y = int(center[1] - r * np.sin(np.radians(angle)))
-            
-            if 0 <= x < width and 0 <= y < height:
-                # HSV 颜色
-                h_val = int(angle * 180 / 360)  # OpenCV HSV H is 0-180
-                s_val = 255
-                v_val = 200
-                hsv = np.uint8([[[h_val, s_val, v_val]]])
-                bgr = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)[0, 0]
-                legend[y, x] = bgr
-    
-    # 添加标签
-    cv2.putText(legend, 'Right', (center[0] + radius + 5, center[1] + 5), 
-                cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 255), 1)
-    cv2.putText(legend, 'Down', (center[0] - 20, center[1] + radius + 15), 
-                cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 255, 0), 1)
-    cv2.putText(legend, 'Left', (center[0] - radius - 30, center[1] + 5), 
-                cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 0, 0), 1)
-    cv2.putText(legend, 'Up', (center[0] - 15, center[1] - radius - 5), 
-                cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 0), 1)
-    
-    return legend
+    def __init__(self, flo_files):
+        self.flo_files = [ str(flo_file) for flo_file in flo_files ]
 
-def visualize_flow_sequence(flow_dir_pattern, output_file, max_flow=None):
+    def __len__(self):
+        return len(self.flo_files)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return np.stack([ read_flo(flo_file) for flo_file in self.flo_files[index] ])
+        return read_flo(self.flo_files[index])
+
+def read_flo_sequence(flow_dir_pattern, keep=None):
     """
-    可视化一系列光流文件并拼接成一张大图
-    
-    Args:
-        flow_dir_pattern: 光流文件的前缀或目录，如 './output_frames'
-        output_file: 输出图像文件路径
-        max_flow: 光流的最大值（用于颜色标准化）
+    逐个读取前缀为 flow_dir_pattern 的 .flo 文件，返回 FloSequence、前 keep 个光流（None 为全部）和最大光流幅度
+    其余光流读取后即丢弃，内存占用与序列长度无关；读取错误直接抛出
     """
     
     # 查找所有 .flo 文件
@@ -125,27 +72,49 @@ def visualize_flow_sequence(flow_dir_pattern, output_file, max_flow=None):
     
     if not flo_files:
         print(f"ERROR: No .flo files found matching pattern: {flow_dir_pattern}_*.flo")
-        return
+        return FloSequence([]), [], 0
     
     print(f"Found {len(flo_files)} optical flow files")
     
-    # 读取所有光流文件并转换为彩色图像
     flow_images = []
     max_rad = 0
     
-    for i, flo_file in enumerate(flo_files):
+    for flo_file in flo_files:
         print(f"  Reading {flo_file.name}...", end=' ')
-        try:
-            flow = read_flo(str(flo_file))
-            
-            # 计算最大光流幅度（用于归一化）
-            rad = np.sqrt(flow[:, :, 0]**2 + flow[:, :, 1]**2)
-            max_rad = max(max_rad, np.max(rad))
-            
+        flow = read_flo(str(flo_file))
+        
+        # 计算最大光流幅度（用于归一化）
+        rad = np.sqrt(flow[:, :, 0]**2 + flow[:, :, 1]**2)
+        max_rad = max(max_rad, np.max(rad))
+        
+        if keep is None or len(flow_images) < keep:
             flow_images.append(flow)
-            print("✓")
-        except Exception as e:
-            print(f"ERROR: {e}")
+        print("✓")
+    
+    return FloSequence(flo_files), flow_images, max_rad
+
+def visualize_flow_sequence(flow_dir_pattern, output_file, max_flow=None, workers=None):
+    """
+    可视化一系列光流文件并拼接成一张大图
+    
+    Args:
+        flow_dir_pattern: 光流文件的前缀或目录，如 './output_frames'
+        output_file: 输出图像文件路径
+        max_flow: 光流的最大值（用于颜色标准化）
+        workers: 上色的进程数（None 为全部 CPU，0 为当前进程）
+    """
+    
+    if flow_dir_pattern.endswith('.flowseq'):
+        # 光流归档：最大幅度已预先计算，只读取要显示的帧
+        archive = FlowArchive(flow_dir_pattern)
+        print(f"Found {len(archive)} optical flows in {flow_dir_pattern} ({archive.dtype})")
+        max_rad = float(archive.max_magnitude.max()) if len(archive) else 0
+        flow_images = list(archive[:24])
+        num_flows = len(archive)
+    else:
+        # 遍历全部文件求最大幅度，只保留要显示的帧
+        sequence, flow_images, max_rad = read_flo_sequence(flow_dir_pattern, keep=24)
+        num_flows = len(sequence)
     
     if not flow_images:
         print("ERROR: No flow images were successfully loaded")
@@ -153,16 +122,13 @@ def visualize_flow_sequence(flow_dir_pattern, output_file, max_flow=None):
     
     print(f"\nMax optical flow magnitude: {max_rad:.2f}")
     
-    # 转换为彩色图像
-    color_images = []
-    for i, flow in enumerate(flow_images):
-        print(f"  Converting {i+1}/{len(flow_images)} to color...", end=' ')
-        color_img = flow_to_color(flow, max_flow=max_rad)
-        color_images.append(color_img)
-        print("✓")
+    # 转换为彩色图像（多进程批量上色）
+    print(f"  Converting {len(flow_images)} flows to color...", end=' ')
+    color_images = list(colorize(flow_images, max_flow=max_rad, workers=workers))
+    print("✓")
     
     # 计算拼接布局
-    num_images = len(color_images)
+    num_images = num_flows
     
     # 只显示前 24 帧
     num_images_to_show = min(24, num_images)
@@ -236,48 +202,52 @@ def visualize_flow_sequence(flow_dir_pattern, output_file, max_flow=None):
     
     return canvas
 
-def create_flow_video(flow_dir_pattern, output_video, fps=30):
+def create_flow_video(flow_dir_pattern, output_video, fps=30, workers=None):
     """
     从光流序列创建视频
     
     Args:
-        flow_dir_pattern: 光流文件的前缀
+        flow_dir_pattern: 光流文件的前缀，或 .flowseq 光流归档
         output_video: 输出视频文件路径
         fps: 视频帧率
+        workers: 上色的进程数（None 为全部 CPU，0 为当前进程）
     """
     
-    # 查找所有 .flo 文件
-    flo_files = sorted(Path('.').glob(f'{flow_dir_pattern}_*.flo'))
-    
-    if not flo_files:
-        print(f"ERROR: No .flo files found matching pattern: {flow_dir_pattern}_*.flo")
+    if flow_dir_pattern.endswith('.flowseq'):
+        # 光流归档：最大幅度来自预先计算的统计，光流按顺序只读取一次
+        archive = FlowArchive(flow_dir_pattern)
+        print(f"Creating video from {len(archive)} frames...")
+        
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        out = cv2.VideoWriter(output_video, fourcc, fps, (archive.width, archive.height))
+        max_rad = float(archive.max_magnitude.max()) if len(archive) else 0
+        
+        # 工作进程各自从归档读取并上色，主进程只负责编码
+        print("  Writing frames...", end=' ')
+        for color_img in colorize(archive, max_flow=max_rad, workers=workers):
+            out.write(color_img)
+        print("✓")
+        
+        out.release()
+        print(f"✓ Video saved to {output_video}")
         return
     
-    print(f"Creating video from {len(flo_files)} frames...")
+    # 第一遍只计算最大光流幅度，光流不驻留内存
+    sequence, flow_images, max_rad = read_flo_sequence(flow_dir_pattern, keep=1)
+    
+    if not flow_images:
+        return
     
-    # 读取第一帧以获取尺寸
-    flow = read_flo(str(flo_files[0]))
-    h, w = flow.shape[:2]
+    print(f"Creating video from {len(sequence)} frames...")
     
     # 创建视频写入器
+    h, w = flow_images[0].shape[:2]
     fourcc = cv2.VideoWriter_fourcc(*'mp4v')
     out = cv2.VideoWriter(output_video, fourcc, fps, (w, h))
     
-    max_rad = 0
-    
-    # 先计算最大光流幅度
-    print("  Calculating max flow magnitude...", end=' ')
-    for flo_file in flo_files:
-        flow = read_flo(str(flo_file))
-        rad = np.sqrt(flow[:, :, 0]**2 + flow[:, :, 1]**2)
-        max_rad = max(max_rad, np.max(rad))
-    print("✓")
-    
-    # 写入帧
+    # 工作进程各自分块读取 .flo 文件并上色，主进程只负责编码
     print("  Writing frames...", end=' ')
-    for flo_file in flo_files:
-        flow = read_flo(str(flo_file))
-        color_img = flow_to_color(flow, max_flow=max_rad)
+    for color_img in colorize(sequence, max_flow=max_rad, workers=workers):
         out.write(color_img)
     print("✓")
     
@@ -296,6 +266,7 @@ if __name__ == '__main__':
         flow_pattern = sys.argv[1]
     if len(sys.argv) > 2:
         output_dir = sys.argv[2]
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
     
     # 创建输出文件夹
     os.makedirs(output_dir, exist_ok=True)
@@ -309,14 +280,14 @@ if __name__ == '__main__':
     print(f"Output directory: {output_dir}\n")
     
     # 可视化为拼接图
-    canvas = visualize_flow_sequence(flow_pattern, output_image)
+    canvas = visualize_flow_sequence(flow_pattern, output_image, workers=workers)
     
     print("\n" + "="*60)
     print("Creating video from optical flow sequence...")
     print("="*60)
     
     # 创建视频
-    create_flow_video(flow_pattern, output_video, fps=10)
+    create_flow_video(flow_pattern, output_video, fps=10, workers=workers)
     
     print("\n✓ All visualizations complete!")
     print(f"  - Image: {output_image}")
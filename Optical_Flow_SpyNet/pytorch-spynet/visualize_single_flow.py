@@ -8,6 +8,8 @@ import cv2
 import os
 from pathlib import Path
 
+from flow_color import create_flow_legend, flows_to_color
+
 def read_flo(filename):
     """
     读取 .flo 光流文件
@@ -27,73 +29,7 @@ def flow_to_color(flow, max_flow=None):
     """
     将光流转换为可视化的彩色图像
     """
-    h, w = flow.shape[:2]
-    
-    # 计算光流的大小和方向
-    fx, fy = flow[:, :, 0], flow[:, :, 1]
-    rad = np.sqrt(fx*fx + fy*fy)
-    a = np.arctan2(-fy, -fx) / np.pi
-    
-    # 使用平方根来增强小运动的可见性
-    if max_flow is None:
-        max_flow = np.max(rad) + 1e-5
-    
-    rad_normalized = rad / max_flow
-    rad_normalized = np.sqrt(rad_normalized)  # 平方根增强亮度
-    rad_normalized = np.clip(rad_normalized, 0, 1)
-    
-    # 创建 HSV 图像，增加 Saturation 来增强色彩饱和度
-    img = np.zeros((h, w, 3), dtype=np.uint8)
-    img[:, :, 0] = ((a + 1) / 2 * 180).astype(np.uint8)  # Hue (0-180 in OpenCV)
-    img[:, :, 1] = (255 * np.sqrt(rad_normalized)).astype(np.uint8)  # Saturation (动态)
-    img[:, :, 2] = (255 * rad_normalized).astype(np.uint8)   # Value
-    
-    # 转换为 BGR
-    img = cv2.cvtColor(img, cv2.COLOR_HSV2BGR)
-    
-    # 应用对比度增强
-    lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
-    l_channel = lab[:, :, 0]
-    l_channel = cv2.equalizeHist(l_channel) * 0.7 + l_channel * 0.3
-    lab[:, :, 0] = l_channel
-    img = cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
-    
-    return img
-
-def create_flow_legend(height=200, width=200):
-    """
-    创建光流色轮图例
-    """
-    center = (width // 2, height // 2)
-    radius = min(height, width) // 2 - 10
-    
-    legend = np.ones((height, width, 3), dtype=np.uint8) * 255
-    
-    # 绘制色轮
-    for angle in range(360):
-        for r in range(radius):
-            x = int(center[0] + r * np.cos(np.radians(angle)))
-            y = int(center[1] - r * np.sin(np.radians(angle)))
-            
-            if 0 <= x < width and 0 <= y < height:
-                h_val = int(angle * 180 / 360)
-                s_val = 255
-                v_val = 200
-                hsv = np.uint8([[[h_val, s_val, v_val]]])
-                bgr = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)[0, 0]
-                legend[y, x] = bgr
-    
-    # 添加标签
-    cv2.putText(legend, 'Right', (center[0] + radius + 5, center[1] + 5), 
-                cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 255), 1)
-    cv2.putText(legend, 'Down', (center[0] - 20, center[1] + radius + 15), 
-                cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 255, 0), 1)
-    cv2.putText(legend, 'Left', (center[0] - radius - 30, center[1] + 5), 
-                cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 0, 0), 1)
-    cv2.putText(legend, 'Up', (center[0] - 15, center[1] - radius - 5), 
-                cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 0), 1)
-    
-    return legend
+    return flows_to_color(flow[None], max_flow)[0]
 
 if __name__ == '__main__':
     import sys
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Local registry of SPyNet weights, so that run.py starts without network access.
+
+The registry is a folder (default: ./weights next to this file, or $SPYNET_WEIGHTS) holding one
+pre-converted checkpoint per model, spynet-<model>.pt: the state dict of run.Network with its
+final key names, saved in the zip format so that it loads through torch.load(mmap=True,
+weights_only=True) without copying or renaming anything.
+
+    python weight_registry.py --convert sintel-final                    # from the torch.hub cache or the download url
+    python weight_registry.py --convert kitti-final --source network-kitti-final.pytorch
+    python weight_registry.py --list
+"""
+
+import argparse
+import os
+
+import torch
+
+MODELS = [ 'sintel-final', 'sintel-clean', 'chairs-final', 'chairs-clean', 'kitti-final' ]
+
+def default_root():
+    return os.environ.get('SPYNET_WEIGHTS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'weights'))
+
+def url(model):
+    return 'http://content.sniklaus.com/github/pytorch-spynet/network-' + model + '.pytorch'
+
+def resolve(model, root=None):
+    """Path of the converted checkpoint of a model, None when the registry does not have it."""
+    path = os.path.join(root or default_root(), 'spynet-' + model + '.pt')
+    return path if os.path.isfile(path) else None
+
+def load(path):
+    """State dict of a converted checkpoint, memory-mapped where torch supports it."""
+    # mmap needs torch >= 2.1, weights_only torch >= 1.13
+    for kwargs in [ { 'mmap': True, 'weights_only': True }, { 'weights_only': True }, {} ]:
+        try:
+            return torch.load(path, map_location='cpu', **kwargs)
+        except TypeError:
+            continue
+
+def convert(model, root=None, source=None):
+    """Renames the keys of an original checkpoint (a file, or the download url through the
+    torch.hub cache when source is None) and stores it in the registry."""
+    if source is None:
+        state_dict = torch.hub.load_state_dict_from_url(url=url(model), file_name='spynet-' + model, map_location='cpu')
+    else:
+        state_dict = torch.load(source, map_location='cpu')
+
+    state_dict = { key.replace('module', 'net'): tensor.contiguous() for key, tensor in state_dict.items() }
+
+    root = root or default_root()
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, 'spynet-' + model + '.pt')
+    torch.save(state_dict, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    return path
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local registry of SPyNet weights')
+    parser.add_argument('--root', default=None, help='registry folder (default: $SPYNET_WEIGHTS or ./weights)')
+    parser.add_argument('--convert', nargs='+', choices=MODELS, default=[], help='models to add to the registry')
+    parser.add_argument('--source', default=None, help='original checkpoint file to convert instead of downloading it (one model)')
+    parser.add_argument('--list', action='store_true', help='list the models of the registry')
+    args = parser.parse_args()
+
+    assert args.source is None or len(args.convert) == 1, '--source converts a single model'
+
+    for model in args.convert:
+        print(f'✓ {model}: {convert(model, args.root, args.source)}')
+
+    if args.list or not args.convert:
+        for model in MODELS:
+            print(f'{model:14s} {resolve(model, args.root) or "-"}')
@@ -0,0 +1,58 @@
+'''
+Frames/s of SAMWISE video inference on the demo input, for several thread counts and dtypes.
+Meant for sizing CPU batch workers, e.g.
+    python benchmark_inference.py --device cpu --input_path demo.mp4 --text_prompts "the dog" \
+        --threads 1 4 8 --dtypes float32 bfloat16
+'''
+import argparse
+import time
+import torch
+import util.misc as utils
+import opts
+from inference_demo import check_args, load_model, load_frames, compute_masks
+
+
+def main(args):
+    check_args(args)
+    model = load_model(args)
+    model.eval()
+    frames_folder, frames_list, ext = load_frames(args, args.input_path, args.fps)
+    if args.max_frames > 0:
+        frames_list = frames_list[:args.max_frames]
+
+    threads = args.threads or [torch.get_num_threads()]
+    dtypes = args.dtypes
+    if 'bfloat16' in dtypes and torch.device(args.device).type == 'cpu' and not utils.cpu_supports_bf16():
+        print('This CPU has no native bfloat16 support, skipping bfloat16')
+        dtypes = [d for d in dtypes if d != 'bfloat16']
+
+    results = []
+    for dtype in dtypes:
+        args.bf16 = dtype == 'bfloat16'
+        for num_threads in threads:
+            torch.set_num_threads(num_threads)
+            # the first clip pays for allocations and kernel selection
+            compute_masks(args, model, args.text_prompts, frames_folder, frames_list[:args.eval_clip_window], ext)
+            start = time.time()
+            compute_masks(args, model, args.text_prompts, frames_folder, frames_list, ext)
+            elapsed = time.time() - start
+            results.append((dtype, num_threads, elapsed))
+
+    print(f'{len(frames_list)} frames, {len(args.text_prompts)} prompt(s), device {args.device}')
+    print(f'{"dtype":>9} {"threads":>7} {"time (s)":>9} {"frames/s":>9}')
+    for dtype, num_threads, elapsed in results:
+        print(f'{dtype:>9} {num_threads:>7} {elapsed:>9.2f} {len(frames_list) / elapsed:>9.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('SAMWISE inference benchmark', parents=[opts.get_args_parser()])
+    parser.add_argument('--input_path', default=None, type=str, required=True, help='path to mp4 video or frames folder')
+    parser.add_argument('--text_prompts', default=[''], type=str, required=True, nargs='+', help="List of referring expressions, separated by whitespace")
+    opts.add_demo_args(parser)
+    parser.add_argument('--threads', default=[], type=int, nargs='+', help='Intra-op thread counts to benchmark (default: current)')
+    parser.add_argument('--dtypes', default=['float32'], nargs='+', choices=['float32', 'bfloat16'], help='Autocast dtypes to benchmark')
+    parser.add_argument('--max_frames', default=0, type=int, help='Only use the first frames of the video (0: all)')
+
+    args = parser.parse_args()
+    utils.setup_inference_device(args)
+    main(args)
@@ -33,6 +33,12 @@ def denormalize(tens):
     return (tens*std)+mean
 
 
+def normalize_frames(imgs):
+    """uint8 frames [..., 3, h, w] from VideoEvalDataset(normalize=False) as the model input,
+    on their device: the same values as ToTensor and Normalize."""
+    return TF.functional.normalize(imgs.float().div(255), [0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+
+
 def make_coco_transforms(image_set, max_size=1024, resize=False):
     normalize = TV.Compose([
         TV.ToTensor(),
@@ -136,7 +142,8 @@ class FrameSampler:
 
 
 class VideoEvalDataset(Dataset):
-    def __init__(self, vid_folder, frames, ext='.jpg', max_size=1024):
+    def __init__(self, vid_folder, frames, ext='.jpg', max_size=1024, normalize=True):
+        """With normalize=False frames are resized uint8 tensors, 4x smaller to keep, see normalize_frames."""
         super().__init__()
         self.vid_folder = vid_folder
         self.frames = frames
@@ -147,6 +154,9 @@ class VideoEvalDataset(Dataset):
             TF.Resize(max_size-4, max_size=max_size), #T.Resize(360),
             TF.ToTensor(),
             TF.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+        ] if normalize else [
+            TF.Resize(max_size-4, max_size=max_size),
+            TF.PILToTensor(),
         ])
             
     def __len__(self):
@@ -1,11 +1,13 @@
 import sys
 from tqdm import tqdm
 import warnings
+from functools import partial
+from multiprocessing import Pool
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 
 import numpy as np
 from davis2017.davis import DAVIS
-from davis2017.metrics import db_eval_boundary, db_eval_iou
+from tools.metrics import db_eval_boundary, db_eval_iou
 from davis2017 import utils
 from davis2017.results import Results
 from scipy.optimize import linear_sum_assignment
@@ -63,7 +65,19 @@ class DAVISEvaluation(object):
         row_ind, col_ind = linear_sum_assignment(-all_metrics)
         return j_metrics_res[row_ind, col_ind, :], f_metrics_res[row_ind, col_ind, :]
 
-    def evaluate(self, res_path, metric=('J', 'F'), debug=False):
+    def _evaluate_sequence(self, seq, results, metric):
+        all_gt_masks, all_void_masks, all_masks_id = self.dataset.get_all_masks(seq, True)
+        if self.task == 'semi-supervised':
+            all_gt_masks, all_masks_id = all_gt_masks[:, 1:-1, :, :], all_masks_id[1:-1]
+        all_res_masks = results.read_masks(seq, all_masks_id)
+        if self.task == 'unsupervised':
+            return self._evaluate_unsupervised(all_gt_masks, all_res_masks, all_void_masks, metric)
+        return self._evaluate_semisupervised(all_gt_masks, all_res_masks, None, metric)
+
+    def evaluate(self, res_path, metric=('J', 'F'), debug=False, num_workers=0):
+        """
+        :param num_workers: Processes evaluating the sequences, 0 to evaluate them in this process.
+        """
         metric = metric if isinstance(metric, tuple) or isinstance(metric, list) else [metric]
         if 'T' in metric:
             raise ValueError('Temporal metric not supported!')
@@ -79,16 +93,12 @@ class DAVISEvaluation(object):
 
         # Sweep all sequences
         results = Results(root_dir=res_path)
-        for seq in tqdm(list(self.dataset.get_sequences())):
-            all_gt_masks, all_void_masks, all_masks_id = self.dataset.get_all_masks(seq, True)
-            if self.task == 'semi-supervised':
-                all_gt_masks, all_masks_id = all_gt_masks[:, 1:-1, :, :], all_masks_id[1:-1]
-            all_res_masks = results.read_masks(seq, all_masks_id)
-            if self.task == 'unsupervised':
-                j_metrics_res, f_metrics_res = self._evaluate_unsupervised(all_gt_masks, all_res_masks, all_void_masks, metric)
-            elif self.task == 'semi-supervised':
-                j_metrics_res, f_metrics_res = self._evaluate_semisupervised(all_gt_masks, all_res_masks, None, metric)
-            for ii in range(all_gt_masks.shape[0]):
+        sequences = list(self.dataset.get_sequences())
+        evaluate_sequence = partial(self._evaluate_sequence, results=results, metric=metric)
+        pool = Pool(num_workers) if num_workers > 0 else None
+        seq_metrics = pool.imap(evaluate_sequence, sequences) if pool is not None else map(evaluate_sequence, sequences)
+        for seq, (j_metrics_res, f_metrics_res) in tqdm(zip(sequences, seq_metrics), total=len(sequences)):
+            for ii in range(j_metrics_res.shape[0]):
                 seq_name = f'{seq}_{ii+1}'
                 if 'J' in metric:
                     [JM, JR, JD] = utils.db_statistics(j_metrics_res[ii])
@@ -107,4 +117,6 @@ class DAVISEvaluation(object):
             if debug:
                 sys.stdout.write(seq + '\n')
                 sys.stdout.flush()
+        if pool is not None:
+            pool.close()
         return metrics_res
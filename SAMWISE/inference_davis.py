@@ -15,7 +15,9 @@ import time
 from pathlib import Path
 import numpy as np
 import torch
-from datasets.transform_utils import VideoEvalDataset
+from datasets.transform_utils import VideoEvalDataset, normalize_frames
+from models.model_utils import upsample_low_res_masks
+from util.keyframes import make_thumbnails, select_keyframes, estimate_flow, warp_masks
 from torch.utils.data import DataLoader
 from os.path import join
 import util.misc as utils
@@ -116,7 +118,15 @@ def eval_davis(args, model, save_path_prefix):
     print('Start inference')
     sub_video_list = video_list
 
-    sub_processor(args, model, data, save_path_prefix, img_folder, sub_video_list)
+    stats = sub_processor(args, model, data, save_path_prefix, img_folder, sub_video_list)
+    speed = (f"Segmented {stats['frames']} frames in {stats['seconds']:.1f} s ({stats['frames'] / stats['seconds']:.2f} frames/s), "
+             f"the model ran on {stats['keyframes']} keyframes ({100 * stats['keyframes'] / stats['frames']:.1f}%, "
+             f"keyframe_stride {args.keyframe_stride}, keyframe_threshold {args.keyframe_threshold}, "
+             f"propagation {args.propagation})")
+    print(speed)
+    if utils.get_rank() == 0:
+        with open(join(args.output_dir, 'log.txt'), 'a') as fp:
+            fp.write(speed + '\n\n')
 
     for annotator in range(4):
         args.results_path = os.path.join(save_path_prefix, f"anno_{annotator}")
@@ -128,6 +138,16 @@ def eval_davis(args, model, save_path_prefix):
     print(f"Total inference time: {total_time:.2f} s")
 
 
+def decode_video(args, img_folder, video_name, frames):
+    """Decode every clip of a video once, shared by all its expressions. Clips are kept as
+    uint8 and normalized on the device when they are run."""
+    vd = VideoEvalDataset(join(img_folder, video_name), frames, max_size=args.max_size, normalize=False)
+    dl = DataLoader(vd, batch_size=args.eval_clip_window,
+                    num_workers=args.num_workers, shuffle=False)
+    clips = [(imgs, clip_frames_ids.tolist()) for imgs, clip_frames_ids in dl]
+    return clips, (vd.origin_h, vd.origin_w)
+
+
 def sub_processor(args, model, data, save_path_prefix, img_folder, video_list):
     progress = tqdm(
             total=len(video_list),
@@ -140,9 +160,12 @@ def sub_processor(args, model, data, save_path_prefix, img_folder, video_list):
 
     # start inference
     model.eval()
+    image_size = getattr(model, 'module', model).image_size
+    stats = {'frames': 0, 'keyframes': 0, 'seconds': 0.}
 
     # 1. for each video
     for video in video_list:
+        video_start_time = time.time()
         metas = []
 
         expressions = data[video]["expressions"]
@@ -159,68 +182,85 @@ def sub_processor(args, model, data, save_path_prefix, img_folder, video_list):
             metas.append(meta)
         meta = metas
 
-        # since there are 4 annotations
+        # since there are 4 annotations, expression i is object i // 4 of annotator i % 4
         num_obj = num_expressions // 4
-
-        # 2. for each annotator
-        for anno_id in range(4):  # 4 annotators
-            anno_masks = []  # [num_obj+1, video_len, h, w], +1 for background
-
-            for obj_id in range(num_obj):
-                i = obj_id * 4 + anno_id
-                video_name = meta[i]["video"]
-                exp = meta[i]["exp"]
-                frames = meta[i]["frames"]
-
-                all_pred_masks = []
-
-                vd = VideoEvalDataset(join(img_folder, video_name), frames, max_size=args.max_size)
-                dl = DataLoader(vd, batch_size=args.eval_clip_window,
-                                num_workers=args.num_workers, shuffle=False)
-                origin_w, origin_h = vd.origin_w, vd.origin_h
-                # 3. for each clip
-                for imgs, clip_frames_ids in dl:
-                    clip_frames_ids = clip_frames_ids.tolist()
-                    img_h, img_w = imgs.shape[-2:]
-                    imgs = imgs.to(args.device)
-                    size = torch.as_tensor([int(img_h), int(img_w)]).to(args.device)
-                    target = {"size": size, 'frame_ids': clip_frames_ids}
-                    with torch.no_grad():
-                        outputs = model([imgs], [exp], [target])
-
-                    pred_masks = outputs["pred_masks"]  # [t, q, h, w]
-                    pred_masks = pred_masks.unsqueeze(0)
-
-                    pred_masks = F.interpolate(pred_masks, size=(origin_h, origin_w), mode='bilinear',
-                                               align_corners=False)
-                    pred_masks = pred_masks.sigmoid()[0]  # [t, h, w], NOTE: here mask is score
-                    all_pred_masks.append(pred_masks)
-
-                all_pred_masks = torch.cat(all_pred_masks, dim=0)  # (video_len, h, w)
-                anno_masks.append(all_pred_masks)
-
-            # handle a complete image (all objects of a annotator)
-            anno_masks = torch.stack(anno_masks)  # [num_obj, video_len, h, w]
-            t, h, w = anno_masks.shape[-3:]
-            anno_masks[anno_masks < 0.5] = 0.0
-            background = 0.1 * torch.ones(1, t, h, w).to(args.device)
-            anno_masks = torch.cat([background, anno_masks], dim=0)  # [num_obj+1, video_len, h, w]
-            out_masks = torch.argmax(anno_masks, dim=0)  # int, the value indicate which object, [video_len, h, w]
-
-            out_masks = out_masks.detach().cpu().numpy().astype(np.uint8)  # [video_len, h, w]
-
-            # save results
-            anno_save_path = os.path.join(save_path_prefix, f"anno_{anno_id}", video)
-            torch.cuda.empty_cache()
-            import gc
-            gc.collect()
+        exp_ids = list(range(num_obj * 4))
+
+        # 2. decode the video once for all its expressions
+        clips, (origin_h, origin_w) = decode_video(args, img_folder, video, data[video]["frames"])
+        video_len = len(data[video]["frames"])
+        keyframes, thumbnails = list(range(video_len)), None
+        if args.keyframe_stride > 1:
+            # the model only runs on the keyframes, as a video with a lower frame rate
+            frames = torch.cat([imgs for imgs, _ in clips])
+            thumbnails = make_thumbnails(frames)
+            keyframes = select_keyframes(thumbnails, args.keyframe_stride, args.keyframe_threshold)
+            frames = frames[keyframes]
+            clips = [(frames[i:i + args.eval_clip_window], list(range(i, min(i + args.eval_clip_window, len(keyframes)))))
+                     for i in range(0, len(keyframes), args.eval_clip_window)]
+            del frames
+        # index of the last keyframe at or before every frame
+        last_keyframe = np.searchsorted(keyframes, np.arange(video_len), side='right') - 1
+
+        # only the low resolution logits of the mask decoder are kept for the whole video,
+        # they are upsampled frame by frame when the masks are written
+        low_res_masks = None
+
+        # 3. for each batch of expressions
+        prompt_batch_size = args.prompt_batch_size or len(exp_ids)
+        for start in range(0, len(exp_ids), prompt_batch_size):
+            batch_ids = exp_ids[start:start + prompt_batch_size]
+            exps = [meta[i]["exp"] for i in batch_ids]
+
+            # 4. for each clip
+            for imgs, clip_frames_ids in clips:
+                img_h, img_w = imgs.shape[-2:]
+                imgs = normalize_frames(imgs.to(args.device))
+                size = torch.as_tensor([int(img_h), int(img_w)]).to(args.device)
+                target = {"size": size, 'frame_ids': clip_frames_ids}
+                with torch.no_grad(), utils.inference_autocast(args):
+                    outputs = model([imgs], exps, [target])
+
+                pred_masks = outputs["pred_low_res_masks"]  # [e*t, 256, 256]
+                pred_masks = pred_masks.view(len(exps), -1, *pred_masks.shape[-2:])
+                if low_res_masks is None:
+                    low_res_masks = pred_masks.new_empty((len(exp_ids), len(keyframes), *pred_masks.shape[-2:]))
+                frames_slice = slice(clip_frames_ids[0], clip_frames_ids[-1] + 1)
+                low_res_masks[start:start + len(exps), frames_slice] = pred_masks
+                input_size = (int(img_h), int(img_w))
+
+        del clips
+        torch.cuda.empty_cache()
+
+        # save results: argmax over [background, objects] of every annotator, objects are
+        # scored by their probability, zeroed below 0.5 so that the background (0.1) wins there.
+        # Frames between keyframes get the logits of the last keyframe, warped by the flow
+        anno_save_paths = [os.path.join(save_path_prefix, f"anno_{anno_id}", video) for anno_id in range(4)]
+        for anno_save_path in anno_save_paths:
             os.makedirs(anno_save_path, exist_ok=True)
-            for f in range(out_masks.shape[0]):
-                img_E = Image.fromarray(out_masks[f])
+        for f in range(video_len):
+            if num_obj > 0:
+                k = last_keyframe[f]
+                logits = upsample_low_res_masks(low_res_masks[:, k], image_size, input_size, (origin_h, origin_w))
+                if keyframes[k] != f and args.propagation == 'flow':
+                    logits = warp_masks(logits, estimate_flow(thumbnails[f], thumbnails[keyframes[k]]))
+                scores = logits.sigmoid()
+                scores[scores < 0.5] = 0.0
+                scores = scores.view(num_obj, 4, origin_h, origin_w)
+                background = torch.full_like(scores[:1], 0.1)
+                out_masks = torch.cat([background, scores]).argmax(dim=0).to(torch.uint8).cpu().numpy()
+            else:
+                out_masks = np.zeros((4, origin_h, origin_w), dtype=np.uint8)
+            for anno_save_path, out_mask in zip(anno_save_paths, out_masks):
+                img_E = Image.fromarray(out_mask)
                 img_E.putpalette(palette)
                 if utils.is_main_process():
                     img_E.save(os.path.join(anno_save_path, '{:05d}.png'.format(f)))
+        stats['frames'] += video_len
+        stats['keyframes'] += len(keyframes)
+        stats['seconds'] += time.time() - video_start_time
         progress.update(1)
+    return stats
 
 def eval_davis_compute_metrics(args):
     time_start = time.time()
@@ -239,7 +279,7 @@ def eval_davis_compute_metrics(args):
         print(f'Evaluating sequences for the {args.task} task...')
         # Create dataset and evaluate
         dataset_eval = DAVISEvaluation(davis_root=args.davis_path + "/DAVIS", task=args.task, gt_set=args.set)
-        metrics_res = dataset_eval.evaluate(args.results_path)
+        metrics_res = dataset_eval.evaluate(args.results_path, num_workers=args.metric_workers)
         J, F = metrics_res['J'], metrics_res['F']
 
         # Generate dataframe for the general results
@@ -280,13 +320,9 @@ def eval_davis_compute_metrics(args):
 
 
 if __name__ == '__main__':
-    if torch.cuda.get_device_properties(0).major >= 8:
-        # turn on tfloat32 for Ampere GPUs (https://pytorch.org/docs/stable/notes/cuda.html#tensorfloat-32-tf32-on-ampere-devices)
-        torch.backends.cuda.matmul.allow_tf32 = True
-        torch.backends.cudnn.allow_tf32 = True
-
     parser = argparse.ArgumentParser('SAMWISE evaluation script', parents=[opts.get_args_parser()])
     args = parser.parse_args()
+    utils.setup_inference_device(args)
     name_exp = args.name_exp
     args.output_dir = os.path.join(args.output_dir, name_exp)
 
@@ -16,6 +16,9 @@ import json
 from tqdm import tqdm
 import sys
 import subprocess
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pycocotools import mask as cocomask
 from tools.colormap import colormap
 import opts
@@ -51,6 +54,19 @@ def main(args):
 
     start_time = time.time()
     # model
+    model = load_model(args)
+
+    print('Start inference')
+    timings = {}
+    inference(args, model, save_path_prefix, input_path, args.text_prompts, args.fps, timings)
+
+    end_time = time.time()
+    total_time = end_time - start_time
+    print("Total inference time: %.4f s (decode %.2f s, model %.2f s, write %.2f s)"
+          % (total_time, timings['decode'], timings['model'], timings['write']))
+
+
+def load_model(args):
     model = build_samwise(args)
     device = torch.device(args.device)
     model.to(device)
@@ -61,13 +77,7 @@ def main(args):
             checkpoint['model'] = {k.replace('module.', ''): v for k, v in checkpoint['model'].items()}        
         checkpoint = on_load_checkpoint(model, checkpoint)
         model.load_state_dict(checkpoint['model'], strict=False)
-
-    print('Start inference')
-    inference(args, model, save_path_prefix, input_path, args.text_prompts, args.fps)
-
-    end_time = time.time()
-    total_time = end_time - start_time
-    print("Total inference time: %.4f s" %(total_time))
+    return model
 
 
 def extract_frames_from_mp4(video_path, fps=10):
@@ -105,38 +115,159 @@ def extract_frames_from_mp4(video_path, fps=10):
     return extract_folder, frames_list, '.png'
 
 
-def compute_masks(model, text_prompt, frames_folder, frames_list, ext):
-    all_pred_masks = []
+def iter_masks(args, model, text_prompts, frames_folder, frames_list, ext, timings=None):
+    """Yields (frame ids, masks [prompts, t, h, ceil(w / 8)]) clip by clip, each clip is decoded once and run for all prompts
+    as a batch. Masks are bit-packed along the width, see utils.unpack_masks. Seconds spent decoding and in the model are
+    added to timings['decode'] and timings['model'] when a dict is given."""
+    timings = {} if timings is None else timings
+    timings.setdefault('decode', 0.)
+    timings.setdefault('model', 0.)
     vd = VideoEvalDataset(frames_folder, frames_list, ext=ext)
     # Use a separate chunk size to control memory even if eval_clip_window is large
     chunk_size = getattr(args, "chunk_size", args.eval_clip_window)
     dl = DataLoader(vd, batch_size=chunk_size, num_workers=args.num_workers, shuffle=False)
     origin_w, origin_h = vd.origin_w, vd.origin_h
     # 3. for each clip
+    tic = time.perf_counter()
     for imgs, clip_frames_ids in tqdm(dl):
+        toc = time.perf_counter()
+        timings['decode'] += toc - tic
         clip_frames_ids = clip_frames_ids.tolist()
         imgs = imgs.to(args.device)  # [eval_clip_window, 3, h, w]
         img_h, img_w = imgs.shape[-2:]
         size = torch.as_tensor([int(img_h), int(img_w)]).to(args.device)
         target = {"size": size, 'frame_ids': clip_frames_ids}
 
-        with torch.no_grad():
-            outputs = model([imgs], [text_prompt], [target])
+        with torch.no_grad(), utils.inference_autocast(args):
+            outputs = model([imgs], text_prompts, [target])
 
-        pred_masks = outputs["pred_masks"]  # [t, q, h, w]
-        pred_masks = pred_masks.unsqueeze(0)
+        pred_masks = outputs["pred_masks"].float()  # [p*t, h, w]
+        pred_masks = pred_masks.view(len(text_prompts), -1, *pred_masks.shape[-2:])
         pred_masks = F.interpolate(pred_masks, size=(origin_h, origin_w), mode='bilinear', align_corners=False) 
-        pred_masks = (pred_masks.sigmoid() > args.threshold)[0].cpu() 
-        all_pred_masks.append(pred_masks)
-
-    # store the video results
-    all_pred_masks = torch.cat(all_pred_masks, dim=0).numpy()  # (video_len, h, w)
-
-    return all_pred_masks
+        pred_masks = utils.pack_masks(pred_masks.sigmoid() > args.threshold).cpu()
+        timings['model'] += time.perf_counter() - toc
+        yield clip_frames_ids, pred_masks.numpy()
+        tic = time.perf_counter()
+
+    print(f'Memory bank footprint: {len(text_prompts)} x {model.memory_bank}')
+
+
+def compute_masks(args, model, text_prompts, frames_folder, frames_list, ext):
+    """Masks of every prompt over the whole video."""
+    all_pred_masks = [masks for _, masks in iter_masks(args, model, text_prompts, frames_folder, frames_list, ext)]
+    all_pred_masks = np.concatenate(all_pred_masks, axis=1)  # (prompts, video_len, h, ceil(w / 8))
+    width = Image.open(join(frames_folder, frames_list[0] + ext)).width
+    return list(utils.unpack_masks(all_pred_masks, width))
+
+
+class FFmpegPipe:
+    """libx264 encoder fed with raw frames through stdin."""
+    def __init__(self, path, width, height, pix_fmt, fps):
+        self.path = path
+        cmd = [get_ffmpeg_exe(), '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', pix_fmt, '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+               # yuv420p needs even sizes
+               '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-c:v', 'libx264', '-pix_fmt', 'yuv420p', path]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.failed = False
+
+    def write(self, frame):
+        if self.failed:
+            return
+        try:
+            self.proc.stdin.write(np.ascontiguousarray(frame).tobytes())
+        except (BrokenPipeError, OSError):
+            # ffmpeg exited, its error is reported by close()
+            self.failed = True
+
+    def close(self):
+        try:
+            _, stderr = self.proc.communicate()
+        except (BrokenPipeError, OSError):
+            self.proc.wait()
+            stderr = self.proc.stderr.read()
+        if self.proc.returncode != 0:
+            print(f'Failed to create video {self.path}: {stderr.decode(errors="replace").strip()}')
+            return False
+        return True
+
+
+class MaskWriter:
+    """Writes the demo outputs of a batch of prompts while the model keeps running.
+
+    Frames are submitted in order as their masks come out of the model. A thread pool
+    draws the overlays and saves them with the single-channel masks, and an encoder
+    thread pipes the finished frames, in order, to one ffmpeg process per video. At
+    most write_queue_size frames are in flight, then put() blocks the model.
+    """
+    def __init__(self, args, save_path_prefix, text_prompts, colors, frames_folder, ext, fps=10):
+        self.frames_folder, self.ext, self.fps = frames_folder, ext, fps
+        self.colors = colors
+        self.mask_bits = args.mask_bits
+        self.write_videos = not args.image_level
+        self.names = [join(save_path_prefix, text_prompt.replace(' ', '_')) for text_prompt in text_prompts]
+        for name in self.names:
+            print(f'Saving output to disk in {name}')
+            os.makedirs(name, exist_ok=True)
+            os.makedirs(name + '_binary_masks', exist_ok=True)
+        self.pipes = None  # opened on the first frame, once the size is known
+        self.error = None
+        self.pool = ThreadPoolExecutor(args.write_workers)
+        self.pending = queue.Queue(maxsize=args.write_queue_size)
+        self.encoder = threading.Thread(target=self._encode, daemon=True)
+        self.encoder.start()
+
+    def put(self, frame, masks):
+        """Queue a frame name with its bit-packed masks [prompts, h, ceil(w / 8)]."""
+        if self.error is not None:
+            raise self.error
+        self.pending.put(self.pool.submit(self._write_frame, frame, masks))
+
+    def _write_frame(self, frame, masks):
+        # the source frame is decoded once for all the prompts
+        source_img = Image.open(join(self.frames_folder, frame + self.ext)).convert('RGBA')
+        masks = utils.unpack_masks(masks, source_img.width)
+        outputs = []
+        for name, mask, color in zip(self.names, masks, self.colors):
+            overlay = vis_add_mask(source_img, mask, color)
+            overlay.save(join(name, frame + '.png'))
+            # white object on black, 1-bit or 8-bit single channel
+            mask_img = Image.fromarray(mask) if self.mask_bits == 1 else Image.fromarray(mask.astype(np.uint8) * 255)
+            mask_img.save(join(name + '_binary_masks', frame + '_mask.png'))
+            outputs.append((np.asarray(overlay), mask))
+        return outputs
+
+    def _encode(self):
+        # keeps draining after an error so that put() never blocks forever
+        for future in iter(self.pending.get, None):
+            try:
+                outputs = future.result()
+                if not self.write_videos:
+                    continue
+                if self.pipes is None:
+                    height, width = outputs[0][1].shape
+                    self.pipes = [(FFmpegPipe(name + '.mp4', width, height, 'rgb24', self.fps),
+                                   FFmpegPipe(name + '_mask.mp4', width, height, 'gray', self.fps)) for name in self.names]
+                for (overlay, mask), (overlay_pipe, mask_pipe) in zip(outputs, self.pipes):
+                    overlay_pipe.write(overlay)
+                    mask_pipe.write(mask.astype(np.uint8) * 255)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+
+    def close(self):
+        self.pending.put(None)
+        self.encoder.join()
+        self.pool.shutdown()
+        for overlay_pipe, mask_pipe in self.pipes or []:
+            overlay_pipe.close()
+            if mask_pipe.close():
+                print(f'Mask-only video ready at {mask_pipe.path}')
+        if self.error is not None:
+            raise self.error
 
     
-def inference(args, model, save_path_prefix, in_path, text_prompts, fps=10):
-    # load data
+def load_frames(args, in_path, fps=10):
     if os.path.isfile(in_path) and not args.image_level:
         frames_folder, frames_list, ext = extract_frames_from_mp4(in_path, fps)
     elif os.path.isfile(in_path) and args.image_level:
@@ -148,64 +279,37 @@ def inference(args, model, save_path_prefix, in_path, text_prompts, fps=10):
         frames_list = sorted(os.listdir(frames_folder))
         ext = os.path.splitext(frames_list[0])[1]
         frames_list = [os.path.splitext(frame)[0] for frame in frames_list if os.path.splitext(frame)[1] == ext]
-        
+    return frames_folder, frames_list, ext
+
+
+def inference(args, model, save_path_prefix, in_path, text_prompts, fps=10, timings=None):
+    """Segments the prompts on a video and writes the outputs. When a dict is given, timings gets the seconds
+    spent decoding (frame extraction included), in the model and waiting for the writers."""
+    timings = {} if timings is None else timings
+    timings.update(decode=0., model=0., write=0.)
+    # load data
+    tic = time.perf_counter()
+    frames_folder, frames_list, ext = load_frames(args, in_path, fps)
+    timings['decode'] += time.perf_counter() - tic
+
     model.eval()
     print(f'Begin inference on {len(frames_list)} frames')
-    # For each expression
-    for i in range(len(text_prompts)):
-        text_prompt = text_prompts[i]
-
-        all_pred_masks = compute_masks(model, text_prompt, frames_folder, frames_list, ext)
-            
-        save_visualize_path_dir = join(save_path_prefix, text_prompt.replace(' ', '_'))
-        os.makedirs(save_visualize_path_dir, exist_ok=True)
-        
-        # 创建二值掩码文件夹
-        save_binary_mask_dir = join(save_path_prefix, text_prompt.replace(' ', '_') + '_binary_masks')
-        os.makedirs(save_binary_mask_dir, exist_ok=True)
-        
-        print(f'Saving output to disk in {save_visualize_path_dir}')
-        out_files_w_mask = []
-        out_files_binary = []
-        for t, frame in enumerate(frames_list):
-            # original
-            img_path = join(frames_folder, frame + ext)
-            source_img = Image.open(img_path).convert('RGBA') # PIL image
-
-            # draw mask
-            source_img = vis_add_mask(source_img, all_pred_masks[t], color_list[i%len(color_list)])
-            # save
-            save_visualize_path = join(save_visualize_path_dir, frame + '.png')
-            source_img.save(save_visualize_path)
-            out_files_w_mask.append(save_visualize_path)
-            
-            # 保存二值掩码（黑白图）。为避免某些 MoviePy 版本不支持单通道，保存为三通道 RGB
-            binary_mask = (all_pred_masks[t] * 255).astype(np.uint8)  # True->255(白色), False->0(黑色)
-            rgb_mask = np.stack([binary_mask, binary_mask, binary_mask], axis=-1)  # (H,W,3)
-            binary_mask_img = Image.fromarray(rgb_mask, mode='RGB')
-            save_binary_mask_path = join(save_binary_mask_dir, frame + '_mask.png')
-            binary_mask_img.save(save_binary_mask_path)
-            out_files_binary.append(save_binary_mask_path)
-        
-        if not args.image_level:
-            # Create the video clip from images
-            try:
-                from moviepy.editor import ImageSequenceClip
-            except Exception:
-                # fallback for environments packaging moviepy differently
-                from moviepy import ImageSequenceClip
-            clip = ImageSequenceClip(out_files_w_mask, fps=10)
-            # Write the video file
-            clip.write_videofile(join(save_path_prefix, text_prompt.replace(' ', '_')+'.mp4'), codec='libx264')
-
-            # 生成二值掩码视频
-            try:
-                bin_clip = ImageSequenceClip(out_files_binary, fps=10)
-                bin_video_path = join(save_path_prefix, text_prompt.replace(' ', '_') + '_mask.mp4')
-                bin_clip.write_videofile(bin_video_path, codec='libx264', audio=False)
-                print(f'Mask-only video ready at {bin_video_path}')
-            except Exception as e:
-                print(f'Failed to create binary mask video: {e}')
+    prompt_batch_size = args.prompt_batch_size or len(text_prompts)
+    # For each batch of expressions, the outputs are written while the next clips are segmented
+    for start in range(0, len(text_prompts), prompt_batch_size):
+        prompts = text_prompts[start:start + prompt_batch_size]
+        colors = [color_list[i % len(color_list)] for i in range(start, start + len(prompts))]
+        writer = MaskWriter(args, save_path_prefix, prompts, colors, frames_folder, ext, fps)
+        try:
+            for clip_frames_ids, masks in iter_masks(args, model, prompts, frames_folder, frames_list, ext, timings):
+                tic = time.perf_counter()
+                for t, frame_id in enumerate(clip_frames_ids):
+                    writer.put(frames_list[frame_id], masks[:, t])
+                timings['write'] += time.perf_counter() - tic
+        finally:
+            tic = time.perf_counter()
+            writer.close()
+            timings['write'] += time.perf_counter() - tic
 
     print(f'Output masks and videos can be found in {save_path_prefix}')
     print(f'Binary masks (black/white) saved in folders ending with "_binary_masks"')
@@ -221,11 +325,16 @@ def check_args(args):
         assert ext in ['.jpg', '.png', '.mp4', '.jpeg'], f"Provided file extension should be one of ['.jpg', '.png', '.mp4']"
         if ext in ['.jpg', '.png', '.jpeg']: 
             args.image_level = True
-            pretrained_model = 'pretrain/pretrained_model.pth'
-            pretrained_model_link = 'https://drive.google.com/file/d/1gRGzARDjIisZ3PnCW77Y9TMM_SbV8aaa/view?usp=drive_link'
-            print(f'Specified path is an image, using image-level configuration')
+    configure_model(args)
+
 
-    if not args.image_level: # it's video inference
+def configure_model(args):
+    """Model options and default checkpoint of the image-level (args.image_level) or the video-level configuration."""
+    if args.image_level:
+        pretrained_model = 'pretrain/pretrained_model.pth'
+        pretrained_model_link = 'https://drive.google.com/file/d/1gRGzARDjIisZ3PnCW77Y9TMM_SbV8aaa/view?usp=drive_link'
+        print(f'Specified path is an image, using image-level configuration')
+    else: # it's video inference
         # set default args
         args.HSA = True
         args.use_cme_head = False
@@ -244,16 +353,12 @@ def check_args(args):
 
 
 if __name__ == '__main__':
-    if torch.cuda.get_device_properties(0).major >= 8:
-        # turn on tfloat32 for Ampere GPUs (https://pytorch.org/docs/stable/notes/cuda.html#tensorfloat-32-tf32-on-ampere-devices)
-        torch.backends.cuda.matmul.allow_tf32 = True
-        torch.backends.cudnn.allow_tf32 = True
-
     parser = argparse.ArgumentParser('SAMWISE evaluation script', parents=[opts.get_args_parser()])
     parser.add_argument('--input_path', default=None, type=str, required=True, help='path to mp4 video or frames folder')
     parser.add_argument('--text_prompts', default=[''], type=str, required=True, nargs='+', help="List of referring expressions, separated by whitespace")
-    parser.add_argument('--chunk_size', default=None, type=int, help='Override mini-batch size to reduce memory usage (default: eval_clip_window)')
+    opts.add_demo_args(parser)
 
     args = parser.parse_args()
+    utils.setup_inference_device(args)
     check_args(args)
     main(args)
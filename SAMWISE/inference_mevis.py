@@ -20,7 +20,7 @@ from tools.colormap import colormap
 import opts
 from models.samwise import build_samwise
 from util.misc import on_load_checkpoint
-from tools.metrics import db_eval_boundary, db_eval_iou
+from tools.metrics import JFEvaluator
 from datasets.transform_utils import VideoEvalDataset
 from torch.utils.data import DataLoader
 from os.path import join
@@ -128,6 +128,8 @@ def eval_mevis(args, model, save_path_prefix, save_visualize_path_prefix, split=
     f_log = join(args.output_dir, 'log_metrics.txt')
     model.eval()
     out_dict = {}
+    # J&F of an expression are computed by the workers while the next ones are segmented
+    evaluator = JFEvaluator(args.metric_workers) if args.split == 'valid_u' else None
     # 1. For each video
     for i_v, video in enumerate(video_list):
         metas = [] # list[dict], length is number of expressions
@@ -135,6 +137,7 @@ def eval_mevis(args, model, save_path_prefix, save_visualize_path_prefix, split=
         expression_list = list(expressions.keys()) 
         num_expressions = len(expression_list)
         out_dict_per_vid = {}
+        pending = []
         # read all the anno meta
         for i in range(num_expressions):
             meta = {}
@@ -167,22 +170,22 @@ def eval_mevis(args, model, save_path_prefix, save_visualize_path_prefix, split=
                 size = torch.as_tensor([int(img_h), int(img_w)]).to(args.device)
                 target = {"size": size, 'frame_ids': clip_frames_ids}
 
-                with torch.no_grad():
+                with torch.no_grad(), utils.inference_autocast(args):
                     outputs = model([imgs], [exp], [target])
 
-                pred_masks = outputs["pred_masks"]  # [t, q, h, w]
+                pred_masks = outputs["pred_masks"].float()  # [t, q, h, w]
                 pred_masks = pred_masks.unsqueeze(0)
                 pred_masks = F.interpolate(pred_masks, size=(origin_h, origin_w), mode='bilinear', align_corners=False) 
-                pred_masks = (pred_masks.sigmoid() > args.threshold)[0].cpu() 
+                # thresholded and bit-packed on the device, 1 bit per pixel is kept for the video
+                pred_masks = utils.pack_masks(pred_masks.sigmoid() > args.threshold)[0].cpu()
                 all_pred_masks.append(pred_masks)
 
             # store the video results
-            all_pred_masks = torch.cat(all_pred_masks, dim=0).numpy()  # (video_len, h, w)
+            all_pred_masks = torch.cat(all_pred_masks, dim=0).numpy()  # (video_len, h, ceil(w / 8))
                         
             # load GTs
             if args.split == 'valid_u':
-                h, w = all_pred_masks.shape[-2:]
-                gt_masks = np.zeros((video_len, h, w), dtype=np.uint8)
+                gt_masks = np.zeros((video_len, origin_h, origin_w), dtype=np.uint8)
                 anno_ids = data[video]['expressions'][exp_id]['anno_id']
                 for frame_idx, frame_name in enumerate(data[video]['frames']):
                     for anno_id in anno_ids:
@@ -190,18 +193,14 @@ def eval_mevis(args, model, save_path_prefix, save_visualize_path_prefix, split=
                         if mask_rle:
                             gt_masks[frame_idx] += cocomask.decode(mask_rle)
 
-                j = db_eval_iou(gt_masks, all_pred_masks).mean()
-                f = db_eval_boundary(gt_masks, all_pred_masks).mean()
-                # print(f'J {j} & F {f}')
-                out_dict[exp] = [j, f]
-                out_dict_per_vid[exp] = [j, f]
+                pending.append((exp, evaluator.submit(gt_masks, utils.unpack_masks(all_pred_masks, origin_w))))
             else:
                 # save binary image
                 save_path = join(save_path_prefix, video_name, exp_id)
                 os.makedirs(save_path, exist_ok=True)
                 for j in range(video_len):
                     frame_name = frames[j]
-                    mask = all_pred_masks[j].astype(np.float32) 
+                    mask = utils.unpack_masks(all_pred_masks[j], origin_w).astype(np.float32)
                     mask = Image.fromarray(mask * 255).convert('L')
                     save_file = os.path.join(save_path, frame_name + ".png")
                     mask.save(save_file)
@@ -213,7 +212,7 @@ def eval_mevis(args, model, save_path_prefix, save_visualize_path_prefix, split=
                     source_img = Image.open(img_path).convert('RGBA') # PIL image
 
                     # draw mask
-                    source_img = vis_add_mask(source_img, all_pred_masks[t], color_list[i%len(color_list)])
+                    source_img = vis_add_mask(source_img, utils.unpack_masks(all_pred_masks[t], origin_w), color_list[i%len(color_list)])
 
                     # save
                     save_visualize_path_dir = os.path.join(save_visualize_path_prefix, video, str(i))
@@ -222,6 +221,10 @@ def eval_mevis(args, model, save_path_prefix, save_visualize_path_prefix, split=
                     source_img.save(save_visualize_path)
                     
         if args.split == 'valid_u':
+            for exp, future in pending:
+                j, f = future.result()
+                out_dict[exp] = [j.mean(), f.mean()]
+                out_dict_per_vid[exp] = [j.mean(), f.mean()]
             J_score, F_score, JF = get_current_metrics(out_dict)
             J_score_vid, F_score_vid, JF_vid = get_current_metrics(out_dict_per_vid)
             out_str = f'{i_v}/{len(video_list)} J&F: {JF}\tJ: {J_score}\tF: {F_score}'
@@ -236,6 +239,7 @@ def eval_mevis(args, model, save_path_prefix, save_visualize_path_prefix, split=
         progress.update(1)
 
     if args.split == 'valid_u':
+        evaluator.close()
         J_score, F_score, JF = get_current_metrics(out_dict)
         print(f'J: {J_score}')
         print(f'F: {F_score}')
@@ -256,13 +260,9 @@ def get_current_metrics(out_dict):
 
 
 if __name__ == '__main__':
-    if torch.cuda.get_device_properties(0).major >= 8:
-        # turn on tfloat32 for Ampere GPUs (https://pytorch.org/docs/stable/notes/cuda.html#tensorfloat-32-tf32-on-ampere-devices)
-        torch.backends.cuda.matmul.allow_tf32 = True
-        torch.backends.cudnn.allow_tf32 = True
-
     parser = argparse.ArgumentParser('SAMWISE evaluation script', parents=[opts.get_args_parser()])
     args = parser.parse_args()
+    utils.setup_inference_device(args)
     name_exp = args.name_exp
     args.output_dir = os.path.join(args.output_dir, name_exp)
 
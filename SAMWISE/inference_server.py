@@ -0,0 +1,219 @@
+'''
+Long-lived SAMWISE inference service, so that pipeline runs do not pay the model startup.
+
+The model is built, loaded and moved to the device once. Jobs (a video or frames folder and
+its prompts) are posted to a localhost HTTP endpoint and run one at a time from a bounded
+queue, with the same outputs as inference_demo.py.
+
+    python inference_server.py --port 8765
+    python inference_server.py --submit --port 8765 --input_path video.mp4 --text_prompts "a dog"
+
+Endpoints:
+    POST /jobs       {"input_path", "text_prompts", "output_dir" (default demo_output), "fps", "wait"}
+                     202 with the queued job, 503 with Retry-After when the queue is full,
+                     200 with the finished job when "wait" is true
+    GET  /jobs/<id>  status, outputs and latency (queue, decode, model, write, total) of a job
+    GET  /health     queued and running jobs
+'''
+import argparse
+import copy
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+import opts
+
+
+class InferenceService:
+    """Runs the jobs on a warm model in a single worker thread.
+
+    submit() returns None instead of blocking when queue_size jobs are already
+    waiting, so that clients back off. The last keep_jobs jobs stay queryable.
+    """
+    def __init__(self, args, model, run_inference, queue_size, keep_jobs=1000):
+        self.args, self.model, self.run_inference = args, model, run_inference
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.keep_jobs = keep_jobs
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.num_jobs = 0
+        self.running = None
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, request):
+        input_path = request['input_path']
+        text_prompts = request['text_prompts']
+        if isinstance(text_prompts, str):
+            text_prompts = [text_prompts]
+        if not (os.path.isdir(input_path) or os.path.splitext(input_path)[1] == '.mp4' and os.path.isfile(input_path)):
+            raise ValueError(f'{input_path} is not a .mp4 video or a frames folder')
+        if not text_prompts or not all(isinstance(p, str) for p in text_prompts):
+            raise ValueError('text_prompts should be a non-empty list of strings')
+        job = {'id': None, 'status': 'queued', 'input_path': input_path, 'text_prompts': text_prompts,
+               'output_dir': request.get('output_dir', 'demo_output'), 'fps': int(request.get('fps', self.args.fps)),
+               'error': None, 'timings': {}, 'submitted': time.time(), 'done': threading.Event()}
+        with self.lock:
+            job['id'] = str(self.num_jobs + 1)
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                return None
+            self.num_jobs += 1
+            self.jobs[job['id']] = job
+            while len(self.jobs) > self.keep_jobs:
+                self.jobs.popitem(last=False)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def health(self):
+        return {'queued': self.queue.qsize(), 'queue_size': self.queue.maxsize,
+                'running': None if self.running is None else self.running['id']}
+
+    @staticmethod
+    def describe(job):
+        """JSON view of a job, times in seconds."""
+        view = {k: v for k, v in job.items() if k not in ('done', 'timings')}
+        view['timings'] = {k: round(v, 3) for k, v in dict(job['timings']).items()}
+        return view
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            self.running = job
+            job['status'] = 'running'
+            job['timings']['queue'] = time.time() - job['submitted']
+            print(f"Job {job['id']}: {job['input_path']} {job['text_prompts']}")
+            try:
+                os.makedirs(job['output_dir'], exist_ok=True)
+                self.run_inference(copy.copy(self.args), self.model, job['output_dir'], job['input_path'],
+                                   job['text_prompts'], job['fps'], job['timings'])
+                job['status'] = 'done'
+            # frame extraction exits on ffmpeg errors, which must not end the worker
+            except (Exception, SystemExit) as e:
+                job['status'], job['error'] = 'failed', repr(e)
+            job['timings']['total'] = time.time() - job['submitted']
+            print(f"Job {job['id']} {job['status']}: {self.describe(job)['timings']}")
+            self.running = None
+            job['done'].set()
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, code, body, headers=()):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for key, value in headers:
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/health':
+                return self.reply(200, service.health())
+            job = service.get(self.path[len('/jobs/'):]) if self.path.startswith('/jobs/') else None
+            if job is None:
+                return self.reply(404, {'error': f'{self.path} not found'})
+            self.reply(200, service.describe(job))
+
+        def do_POST(self):
+            if self.path != '/jobs':
+                return self.reply(404, {'error': f'{self.path} not found'})
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                job = service.submit(request)
+            except (ValueError, KeyError, TypeError) as e:
+                return self.reply(400, {'error': repr(e)})
+            if job is None:
+                return self.reply(503, {'error': 'queue full'}, [('Retry-After', '5')])
+            if request.get('wait', False):
+                job['done'].wait()
+                return self.reply(200, service.describe(job))
+            self.reply(202, service.describe(job))
+
+    return Handler
+
+
+def serve(args):
+    # the model code is only needed by the server, not by --submit
+    import util.misc as utils
+    from inference_demo import configure_model, inference, load_model
+
+    utils.setup_inference_device(args)
+    torch.manual_seed(0)
+    np.random.seed(0)
+    random.seed(0)
+    torch.backends.cudnn.deterministic = True
+    torch.backends.cudnn.benchmark = False
+
+    start_time = time.time()
+    # the server runs the video-level configuration
+    args.image_level = False
+    configure_model(args)
+    model = load_model(args)
+    model.eval()
+    print(f'Model ready in {time.time() - start_time:.1f} s')
+
+    service = InferenceService(args, model, inference, args.queue_size)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    print(f'Serving SAMWISE on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+def submit(args):
+    """Posts a job, waits for it and prints its latency. Retries while the server queue is full."""
+    body = json.dumps({'input_path': os.path.abspath(args.input_path), 'text_prompts': args.text_prompts,
+                       'output_dir': os.path.abspath(args.job_output_dir), 'fps': args.fps, 'wait': True}).encode()
+    url = f'http://{args.host}:{args.port}/jobs'
+    while True:
+        request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request) as response:
+                job = json.loads(response.read())
+            break
+        except urllib.error.HTTPError as e:
+            if e.code != 503:
+                sys.exit(f'Job rejected: {e.read().decode()}')
+            time.sleep(int(e.headers.get('Retry-After', 5)))
+    print(json.dumps(job, indent=2))
+    if job['status'] != 'done':
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('SAMWISE inference server', parents=[opts.get_args_parser()])
+    opts.add_demo_args(parser)
+    parser.add_argument('--host', default='127.0.0.1', type=str, help='Address to listen on (or to submit to)')
+    parser.add_argument('--port', default=8765, type=int, help='Port to listen on (or to submit to)')
+    parser.add_argument('--queue_size', default=8, type=int, help='Jobs waiting before new submissions are refused')
+    parser.add_argument('--submit', action='store_true', help='Send a job to a running server instead of serving')
+    parser.add_argument('--input_path', default=None, type=str, help='With --submit: path to mp4 video or frames folder')
+    parser.add_argument('--text_prompts', default=None, type=str, nargs='+', help='With --submit: referring expressions')
+    parser.add_argument('--job_output_dir', default='demo_output', type=str, help='With --submit: where the outputs go')
+
+    args = parser.parse_args()
+    if args.submit:
+        assert args.input_path and args.text_prompts, '--submit needs --input_path and --text_prompts'
+        submit(args)
+    else:
+        serve(args)
@@ -172,17 +172,18 @@ def sub_processor(args, data, save_path_prefix, save_visualize_path_prefix, img_
                 size = torch.as_tensor([int(img_h), int(img_w)]).to(args.device)
                 target = {"size": size, 'frame_ids': clip_frames_ids}
 
-                with torch.no_grad():
+                with torch.no_grad(), utils.inference_autocast(args):
                     outputs = model([imgs], [exp], [target])
 
-                pred_masks = outputs["pred_masks"]  # [t, q, h, w]
+                pred_masks = outputs["pred_masks"].float()  # [t, q, h, w]
                 pred_masks = pred_masks.unsqueeze(0)
                 pred_masks = F.interpolate(pred_masks, size=(origin_h, origin_w), mode='bilinear', align_corners=False) 
-                pred_masks = (pred_masks.sigmoid() > args.threshold)[0].cpu() 
+                # thresholded and bit-packed on the device, 1 bit per pixel is kept for the video
+                pred_masks = utils.pack_masks(pred_masks.sigmoid() > args.threshold)[0].cpu()
                 all_pred_masks.append(pred_masks)
 
             # store the video results
-            all_pred_masks = torch.cat(all_pred_masks, dim=0).numpy()  # (video_len, h, w)
+            all_pred_masks = torch.cat(all_pred_masks, dim=0).numpy()  # (video_len, h, ceil(w / 8))
 
             if args.visualize:
                 for t, frame in enumerate(frames):
@@ -191,7 +192,7 @@ def sub_processor(args, data, save_path_prefix, save_visualize_path_prefix, img_
                     source_img = Image.open(img_path).convert('RGBA') # PIL image
 
                     # draw mask
-                    source_img = vis_add_mask(source_img, all_pred_masks[t], color_list[i%len(color_list)])
+                    source_img = vis_add_mask(source_img, utils.unpack_masks(all_pred_masks[t], origin_w), color_list[i%len(color_list)])
 
                     # save
                     save_visualize_path_dir = os.path.join(save_visualize_path_prefix, video, str(i))
@@ -205,7 +206,7 @@ def sub_processor(args, data, save_path_prefix, save_visualize_path_prefix, img_
             os.makedirs(save_path, exist_ok=True)
             for j in range(video_len):
                 frame_name = frames[j]
-                mask = all_pred_masks[j].astype(np.float32) 
+                mask = utils.unpack_masks(all_pred_masks[j], origin_w).astype(np.float32)
                 mask = Image.fromarray(mask * 255).convert('L')
                 save_file = os.path.join(save_path, frame_name + ".png")
                 mask.save(save_file)
@@ -264,13 +265,9 @@ def vis_add_mask(img, mask, color):
 
 
 if __name__ == '__main__':
-    if torch.cuda.get_device_properties(0).major >= 8:
-        # turn on tfloat32 for Ampere GPUs (https://pytorch.org/docs/stable/notes/cuda.html#tensorfloat-32-tf32-on-ampere-devices)
-        torch.backends.cuda.matmul.allow_tf32 = True
-        torch.backends.cudnn.allow_tf32 = True
-
     parser = argparse.ArgumentParser('SAMWISE evaluation script', parents=[opts.get_args_parser()])
     args = parser.parse_args()
+    utils.setup_inference_device(args)
     name_exp = args.name_exp
     args.output_dir = os.path.join(args.output_dir, name_exp)
 
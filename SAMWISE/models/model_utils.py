@@ -1,6 +1,7 @@
 from dataclasses import dataclass
 from torch import Tensor
 import torch
+import torch.nn.functional as F
 from models.sam2.modeling.sam2_utils import postprocess_masks
 
 @dataclass
@@ -67,6 +68,104 @@ class BackboneOutput:
         return self
 
 
+def upsample_low_res_masks(low_res_masks, image_size, input_size, original_size):
+    """Logits [N, h, w] of the mask decoder at the original frame size.
+
+    Same ops as pred_masks (decoder masks at the input size) followed by the
+    bilinear resize of the inference scripts, so only the low resolution
+    logits need to be kept until the frame is written.
+    """
+    masks = postprocess_masks(low_res_masks.float()[:, None], image_size, input_size, input_size)
+    return F.interpolate(masks, size=original_size, mode='bilinear', align_corners=False)[:, 0]
+
+
+def _as_list(v):
+    return list(v) if isinstance(v, (list, tuple)) else [v]
+
+
+class MemoryBank:
+    """Fixed-capacity ring buffer of per-frame memories, keyed by frame id.
+
+    Frame t lives in slot t % capacity, so storing a frame evicts the one
+    `capacity` frames before it. With capacity covering the memory attention
+    horizon (num_maskmem - 1 mask memories, max_obj_ptrs_in_encoder - 1
+    object pointers) no later frame can reference an evicted entry.
+    Without grad, tensors are copied into slots preallocated on the first
+    store, so the footprint is constant in the video length. Entries that
+    require grad (training) are kept by reference to preserve autograd.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffers = None
+        self.clear()
+
+    def clear(self):
+        self.frame_ids = [None] * self.capacity
+        self.entries = [None] * self.capacity
+        self.by_reference = [False] * self.capacity
+
+    def _fits(self, memory_dict):
+        if self.buffers is None or self.buffers.keys() != memory_dict.keys():
+            return False
+        for k, v in memory_dict.items():
+            bufs, xs = self.buffers[k], _as_list(v)
+            if len(bufs) != len(xs):
+                return False
+            for b, x in zip(bufs, xs):
+                if b.shape[1:] != x.shape or b.dtype != x.dtype or b.device != x.device:
+                    return False
+        return True
+
+    def __setitem__(self, frame_idx, memory_dict):
+        slot = frame_idx % self.capacity
+        self.frame_ids[slot] = frame_idx
+        self.by_reference[slot] = any(x.requires_grad for v in memory_dict.values() for x in _as_list(v))
+        if self.by_reference[slot]:
+            self.entries[slot] = memory_dict
+            return
+        if not self._fits(memory_dict):
+            self.buffers = {k: [x.new_empty((self.capacity, ) + x.shape) for x in _as_list(v)]
+                            for k, v in memory_dict.items()}
+            # slots written before the reallocation are gone
+            for i in range(self.capacity):
+                if i != slot and not self.by_reference[i]:
+                    self.frame_ids[i], self.entries[i] = None, None
+        entry = {}
+        for k, v in memory_dict.items():
+            views = [buf[slot].copy_(x) for buf, x in zip(self.buffers[k], _as_list(v))]
+            entry[k] = views if isinstance(v, (list, tuple)) else views[0]
+        self.entries[slot] = entry
+
+    def get(self, frame_idx, default=None):
+        slot = frame_idx % self.capacity
+        if self.frame_ids[slot] != frame_idx:
+            return default
+        return self.entries[slot]
+
+    def __getitem__(self, frame_idx):
+        entry = self.get(frame_idx)
+        if entry is None:
+            raise KeyError(frame_idx)
+        return entry
+
+    def __contains__(self, frame_idx):
+        return self.get(frame_idx) is not None
+
+    def __len__(self):
+        return sum(i is not None for i in self.frame_ids)
+
+    def nbytes(self):
+        """Bytes held by the preallocated slots and the referenced entries."""
+        tensors = [] if self.buffers is None else [b for bufs in self.buffers.values() for b in bufs]
+        for entry, by_reference in zip(self.entries, self.by_reference):
+            if entry is not None and by_reference:
+                tensors += [x for v in entry.values() for x in _as_list(v)]
+        return sum(x.numel() * x.element_size() for x in tensors)
+
+    def __repr__(self):
+        return f'MemoryBank(entries={len(self)}/{self.capacity}, {self.nbytes() / 2**20:.2f} MB)'
+
+
 def get_same_object_labels(masks, counterpart_masks, counter_logits=None):
     """
         masks (_type_): BT, H, W of torch.float32
@@ -1,5 +1,7 @@
+from collections import OrderedDict
 import torch
 from torch import nn
+from torch.nn.utils.rnn import pad_sequence
 from util.misc import nested_tensor_from_videos_list, NestedTensor
 from models.CMT_adapter import CMT_adapter
 from hydra import compose, initialize
@@ -11,7 +13,7 @@ import os
 import py3_wget
 from models.conditional_memory_encoder import ConditionalMemoryEncoder
 from fairseq.models.roberta import RobertaModel
-from models.model_utils import BackboneOutput, DecoderOutput, get_same_object_labels
+from models.model_utils import BackboneOutput, DecoderOutput, MemoryBank, get_same_object_labels
 from transformers import RobertaTokenizerFast
 
 
@@ -31,6 +33,9 @@ class SAMWISE(nn.Module):
 
         self.text_encoder = text_encoder
         self.tokenizer = RobertaTokenizerFast.from_pretrained('roberta-base')
+        # per caption: token ids, motion map and (at inference) input embedding, see encode_caption
+        self.text_cache = OrderedDict()
+        self.text_cache_size = args.text_cache_size
         self.sam = sam
         self.conditional_memory_encoder = conditional_memory_encoder
         if args.motion_prompt:
@@ -48,7 +53,14 @@ class SAMWISE(nn.Module):
                                         HSA_patch_size=args.HSA_patch_size[i] if len(args.HSA_patch_size)>1 else args.HSA_patch_size[0],
                                         args=args))
 
-        self.memory_bank = {} # to store all frames memory
+        # to store the memory of the frames the memory attention can still reach,
+        # one bank (and CME state) per video record, e.g. per prompt of a clip
+        memory_horizon = sam.num_maskmem - 1
+        if sam.use_obj_ptrs_in_encoder:
+            memory_horizon = max(memory_horizon, sam.max_obj_ptrs_in_encoder - 1)
+        self.memory_horizon = max(memory_horizon, 1)
+        self.memory_banks = [MemoryBank(self.memory_horizon)]
+        self.last_frames_cme_applied = [0]
 
         self.fusion_stages_txt = fusion_stages_txt
         self.fusion_stages_vis = sam.image_encoder.trunk.stage_ends
@@ -60,12 +72,18 @@ class SAMWISE(nn.Module):
         self.switch_mem = args.switch_mem
 
 
+    @property
+    def memory_bank(self):
+        return self.memory_banks[0]
+
     def forward(self, samples, captions, targets):
         """ The forward expects a NestedTensor, which consists of:
                - samples.tensors: image sequences, of shape [num_frames x 3 x H x W]
                - samples.mask: a binary mask of shape [num_frames x H x W], containing 1 on padded pixels
                - captions: list[str]
                - targets:  list[dict]; during training contains masks, during inference frame Id info
+            A single clip with N captions is segmented for every caption: the prompt-independent
+            part of the backbone runs once and every caption gets its own memory bank.
             It returns a dict with the following elements:
                - "pred_masks": Shape = [batch_size x num_queries x out_h x out_w]
         """
@@ -73,13 +91,20 @@ class SAMWISE(nn.Module):
         # samples: tensor B*T, C, H, W
         backbone_output: BackboneOutput = self.compute_backbone_output(samples, captions)
         B, T = backbone_output.B, backbone_output.T
-        outputs = {"masks": []}
+        outputs = {"masks": [], "low_res_masks": []}
+
+        while len(self.memory_banks) < B:
+            self.memory_banks.append(MemoryBank(self.memory_horizon))
+            self.last_frames_cme_applied.append(0)
 
         for video_record in range(B):
+            memory_bank = self.memory_banks[video_record]
             if self.training or T==1: # T == 1 for pre-training, no propagation from memory bank
-                self.memory_bank, self.last_frame_cme_applied = {}, 0
+                memory_bank.clear()
+                self.last_frames_cme_applied[video_record] = 0
             elif targets[0]['frame_ids'][0] == 0:  # it's the first frame of a new video
-                self.memory_bank, self.last_frame_cme_applied = {}, 0
+                memory_bank.clear()
+                self.last_frames_cme_applied[video_record] = 0
 
             for frame_idx in range(T):
                 idx = video_record * T + frame_idx
@@ -92,11 +117,11 @@ class SAMWISE(nn.Module):
 
                 current_vision_feats = backbone_output.get_current_feats(idx)
                 decoder_out_w_mem: DecoderOutput = self.compute_decoder_out_w_mem(backbone_output, idx, memory_idx,
-                                                                                  self.memory_bank)
+                                                                                  memory_bank)
 
                 if self.use_cme_head:
                     # wait at least cme_decision_window frames between 2 CME applications
-                    if memory_idx - self.last_frame_cme_applied >= self.cme_decision_window-1 and memory_idx>self.cme_decision_window:
+                    if memory_idx - self.last_frames_cme_applied[video_record] >= self.cme_decision_window-1 and memory_idx>self.cme_decision_window:
                         # memory-less prediction
                         decoder_out_no_mem_cme: DecoderOutput = self.compute_decoder_out_no_mem(backbone_output, idx)
                         pred_cme_logits = self.conditional_memory_encoder(decoder_out_w_mem.obj_ptr.detach(),
@@ -104,7 +129,7 @@ class SAMWISE(nn.Module):
 
                         if pred_cme_logits.argmax().item() == 1 and not self.training:  # not training and switch
                             decoder_out_w_mem = self.apply_decision(decoder_out_w_mem, decoder_out_no_mem_cme)
-                            self.last_frame_cme_applied = memory_idx
+                            self.last_frames_cme_applied[video_record] = memory_idx
 
                         if self.training:
                             # cme_label indicates whether memory features and memory-less features point to same object
@@ -119,14 +144,16 @@ class SAMWISE(nn.Module):
                             outputs["cme_label"].append(cme_label)
 
                 mem_dict_w_mem = self.compute_memory_bank_dict(decoder_out_w_mem, current_vision_feats, backbone_output.feat_sizes)
-                self.memory_bank[memory_idx] = mem_dict_w_mem
+                memory_bank[memory_idx] = mem_dict_w_mem
                 outputs["masks"].append(decoder_out_w_mem.masks)
+                outputs["low_res_masks"].append(decoder_out_w_mem.low_res_masks)
 
         masks = torch.cat(outputs["masks"])
         if self.training:
             return outputs
         else:
-            return {"pred_masks": masks.squeeze(1)}
+            return {"pred_masks": masks.squeeze(1),
+                    "pred_low_res_masks": torch.cat(outputs["low_res_masks"]).squeeze(1)}
 
 
     @staticmethod
@@ -141,14 +168,59 @@ class SAMWISE(nn.Module):
         BT = (B, T)
         return samples, BT, orig_size
 
+    def encode_caption(self, caption):
+        """Token ids, motion map and input embedding of a caption.
+
+        A caption is the same for every clip of a video, and often across videos, so the
+        entries are kept in an LRU cache of text_cache_size captions. The embedding is
+        filled in lazily at inference and dropped whenever the weights may change.
+        """
+        entry = self.text_cache.get(caption)
+        if entry is not None:
+            self.text_cache.move_to_end(caption)
+            return entry
+        encoding = self.tokenizer(caption, add_special_tokens=True, return_offsets_mapping=True,
+                                  return_special_tokens_mask=True)
+        entry = {'input_ids': encoding['input_ids'], 'motion_map': None, 'embedding': None}
+        if self.motion_prompt:
+            entry['motion_map'] = self.caption_motion_map(caption, encoding['offset_mapping'],
+                                                          encoding['special_tokens_mask'])
+        self.text_cache[caption] = entry
+        if len(self.text_cache) > self.text_cache_size:
+            self.text_cache.popitem(last=False)
+        return entry
+
+    def drop_text_embeddings(self):
+        for entry in self.text_cache.values():
+            entry['embedding'] = None
+
+    def train(self, mode=True):
+        if mode:
+            # the text encoder may be updated from now on
+            self.drop_text_embeddings()
+        return super().train(mode)
+
+    def load_state_dict(self, *args, **kwargs):
+        self.drop_text_embeddings()
+        return super().load_state_dict(*args, **kwargs)
+
     def preprocess_text_features(self, captions):
-        batch_encoding_text = self.tokenizer(captions, add_special_tokens=True, padding=True)
-        input_ids = torch.tensor(batch_encoding_text['input_ids']).cuda()
-        attention_mask = torch.tensor(batch_encoding_text['attention_mask']).eq(0).cuda()
+        entries = [self.encode_caption(c) for c in captions]
+        batch_encoding_text = self.tokenizer.pad({'input_ids': [e['input_ids'] for e in entries]})
         text_encoder = self.text_encoder.model.encoder.sentence_encoder
-        has_pads = (torch.tensor(input_ids.device.type == "xla") or attention_mask.any())
-        x, encoder_embedding = text_encoder.forward_embedding(input_ids, None)
-        x = x * (1 - attention_mask.unsqueeze(-1).type_as(x) * has_pads.type_as(x))
+        device = text_encoder.embed_tokens.weight.device
+        input_ids = torch.tensor(batch_encoding_text['input_ids'], device=device)
+        attention_mask = torch.tensor(batch_encoding_text['attention_mask'], device=device).eq(0)
+        if self.training or torch.is_grad_enabled():
+            has_pads = (torch.tensor(input_ids.device.type == "xla") or attention_mask.any())
+            x, encoder_embedding = text_encoder.forward_embedding(input_ids, None)
+            x = x * (1 - attention_mask.unsqueeze(-1).type_as(x) * has_pads.type_as(x))
+        else:
+            # with right padding the embedding of a caption does not depend on the batch, pads are zeros
+            for e in entries:
+                if e['embedding'] is None:
+                    e['embedding'] = text_encoder.forward_embedding(torch.tensor([e['input_ids']], device=device), None)[0][0]
+            x = pad_sequence([e['embedding'].to(device) for e in entries], batch_first=True)
         txt = x.transpose(0, 1)  # B x T x C -> T x B x C
         return txt, attention_mask, input_ids
     
@@ -157,6 +229,11 @@ class SAMWISE(nn.Module):
         txt, attention_mask, input_ids = self.preprocess_text_features(captions)
 
         B, T = BT
+        if len(captions) != B:
+            # one clip, several captions: the visual features are fanned out in the early fusion
+            assert B == 1, 'several captions per clip need a single clip'
+            B = len(captions)
+            orig_size = orig_size * B
 
         if self.motion_prompt:
             vis_outs, state, txt = self._early_fusion_stage(T, samples, txt, attention_mask)
@@ -173,7 +250,7 @@ class SAMWISE(nn.Module):
         out = BackboneOutput(B, T, orig_size, vision_feats, vision_pos_embeds, feat_sizes, state, motion_state)
         return out
 
-    def compute_decoder_out_w_mem(self, backbone_out: BackboneOutput, idx: int, memory_idx: int, memory_bank: dict):
+    def compute_decoder_out_w_mem(self, backbone_out: BackboneOutput, idx: int, memory_idx: int, memory_bank: MemoryBank):
         current_vision_feats = backbone_out.get_current_feats(idx)
         current_vision_pos_embeds = backbone_out.get_current_pos_embeds(idx)
         # take only the highest res feature map
@@ -226,21 +303,29 @@ class SAMWISE(nn.Module):
         }
         return memory_dict
 
-    def extract_motion_prompts(self, captions, input_ids):
-        docs = [self.nlp_dict(x) for x in captions]
-        motion_map = torch.zeros(size=input_ids.shape).to(input_ids.device)
-        encoded_input = self.tokenizer(captions, return_tensors="pt", add_special_tokens=True, return_offsets_mapping=True, padding=True)
-        for caption_index, doc in enumerate(docs):
-            roberta_tokens = self.tokenizer.convert_ids_to_tokens(encoded_input.input_ids[caption_index])
-            roberta_offsets = encoded_input['offset_mapping'][caption_index]
-            for index, (rt, offset) in enumerate(zip(roberta_tokens, roberta_offsets)):
-                start, end = offset
-                if rt != '<s>' and rt != '</s>':
-                    for token in doc:
-                        if token.idx <= start and (token.idx + len(token.text)) >= end:
-                            if token.pos_ == 'VERB':
-                                motion_map[caption_index][index] = 1
+    def caption_motion_map(self, caption, offsets, special_tokens_mask):
+        """1 for the RoBERTa tokens lying inside a spaCy VERB, 0 elsewhere."""
+        doc = self.nlp_dict(caption)
+        # char -> index of the spaCy token covering it, so every RoBERTa token is a single lookup
+        char_to_word = [-1] * (len(caption) + 1)
+        for token in doc:
+            char_to_word[token.idx:token.idx + len(token.text)] = [token.i] * len(token.text)
+        motion_map = torch.zeros(len(offsets))
+        for index, ((start, end), special) in enumerate(zip(offsets, special_tokens_mask)):
+            if special:
+                continue
+            # an empty span is also inside the word ending right before it
+            chars = (start, ) if start < end else (start, start - 1)
+            for c in chars:
+                word = char_to_word[c] if c >= 0 else -1
+                if word >= 0 and doc[word].pos_ == 'VERB' and doc[word].idx + len(doc[word].text) >= end:
+                    motion_map[index] = 1
         return motion_map
+
+    def extract_motion_prompts(self, captions, input_ids):
+        # pads are never motion tokens
+        motion_map = pad_sequence([self.encode_caption(c)['motion_map'] for c in captions], batch_first=True)
+        return motion_map.to(input_ids.device)
     
     def apply_decision(self, decoder_out_w_mem: DecoderOutput, decoder_out_no_mem: DecoderOutput):
         high_res_masks = decoder_out_w_mem.high_res_masks
@@ -267,6 +352,8 @@ class SAMWISE(nn.Module):
         vis = self.sam.image_encoder.trunk.patch_embed(samples)
         vis = vis + self.sam.image_encoder.trunk._get_pos_embed(vis.shape[1:3])
         vis_outs = []
+        # captions per clip, the visual stages before the first adapter do not depend on them
+        num_prompts = txt.shape[1] * T // samples.shape[0]
         fusion_stages_vis = [x+1 for x in self.fusion_stages_vis]
 
         fusion_vis = fusion_stages_vis.copy()
@@ -278,6 +365,10 @@ class SAMWISE(nn.Module):
             vis = self.forw_layer_list(i_v, fusion_vis[i+1], self.sam.image_encoder.trunk.blocks, vis)
             txt = self.forw_layer_list(i_t, fusion_txt[i+1], self.text_encoder.model.encoder.sentence_encoder.layers, txt, attention_mask)
             if i in self.fusion_stages:
+                if num_prompts > 1:
+                    vis = vis.repeat(num_prompts, 1, 1, 1)
+                    vis_outs = [x.repeat(num_prompts, 1, 1, 1) for x in vis_outs]
+                    num_prompts = 1
                 v = vis.clone()
                 t = txt.clone()
                 v, t = self.cmt_adapters[self.fusion_stages.index(i)](v.permute(0, 3, 1, 2), T, t)
@@ -286,6 +377,8 @@ class SAMWISE(nn.Module):
 
             vis_outs.append(vis.permute(0, 3, 1, 2))
 
+        if num_prompts > 1:  # no adapter at all
+            vis_outs = [x.repeat(num_prompts, 1, 1, 1) for x in vis_outs]
         txt = txt.permute(1, 0, 2)  # LND -> NLD
         state = txt[:,0]
         if T > 1:
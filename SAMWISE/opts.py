@@ -79,6 +79,14 @@ def get_args_parser():
                         help="Experiment name for logging/saving")
     parser.add_argument('--device', default='cuda', type=str,
                         help="Device for computation ('cuda' or 'cpu')")
+    parser.add_argument('--num_threads', default=0, type=int,
+                        help="Intra-op threads for CPU inference (0: PyTorch default)")
+    parser.add_argument('--num_interop_threads', default=0, type=int,
+                        help="Inter-op threads for CPU inference (0: PyTorch default)")
+    parser.add_argument('--text_cache_size', default=1024, type=int,
+                        help="Captions whose tokenization, embedding and motion map are kept across clips and videos")
+    parser.add_argument('--bf16', default=False, action='store_true',
+                        help="Run inference under bfloat16 autocast (CPU: only where natively supported)")
     parser.add_argument('--seed', default=0, type=int,
                         help="Random seed for reproducibility")
     parser.add_argument('--resume', default='', type=str,
@@ -103,6 +111,18 @@ def get_args_parser():
                         help="Enable mask visualization during inference")
     parser.add_argument('--eval_clip_window', default=8, type=int,
                         help="Frame window size for evaluation")
+    parser.add_argument('--prompt_batch_size', default=1, type=int,
+                        help="Expressions segmented together on a decoded clip, sharing the pre-fusion backbone (0: all)")
+    parser.add_argument('--keyframe_stride', default=1, type=int,
+                        help="Ref-DAVIS: run the model at least every N frames, the frames in between get the masks "
+                             "of the last keyframe propagated (1: every frame)")
+    parser.add_argument('--keyframe_threshold', default=0., type=float,
+                        help="Mean absolute change (0-1) from the last keyframe that makes a frame a keyframe before "
+                             "the stride (0: fixed stride)")
+    parser.add_argument('--propagation', default='flow', type=str, choices=['flow', 'hold'],
+                        help="Propagate keyframe masks warped by the optical flow, or hold them unchanged")
+    parser.add_argument('--metric_workers', default=4, type=int,
+                        help="Processes computing J&F while inference goes on (0: in the main process)")
     parser.add_argument('--set', type=str, default='val',
                         help="Subset to evaluate ('val' or other subsets)")
     parser.add_argument('--task', type=str, default='unsupervised',
@@ -116,3 +136,10 @@ def get_args_parser():
     return parser
 
 
+def add_demo_args(parser):
+    """Options of the demo outputs, shared by inference_demo.py and inference_server.py."""
+    parser.add_argument('--chunk_size', default=None, type=int, help='Override mini-batch size to reduce memory usage (default: eval_clip_window)')
+    parser.add_argument('--write_workers', default=4, type=int, help='Threads drawing and saving the output frames')
+    parser.add_argument('--write_queue_size', default=32, type=int, help='Output frames in flight before the model waits for the writers')
+    parser.add_argument('--mask_bits', default=8, type=int, choices=[1, 8], help='Bit depth of the single-channel binary mask PNGs')
+    return parser
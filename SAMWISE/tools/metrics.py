@@ -1,6 +1,8 @@
-import math
+import functools
+from concurrent.futures import Future, ProcessPoolExecutor
 import cv2
 import torch
+import torch.nn.functional as F
 from tqdm import tqdm
 from pycocotools.coco import COCO
 from pycocotools.mask import decode
@@ -67,11 +69,7 @@ def db_eval_boundary(annotation, segmentation, void_pixels=None, bound_th=0.008)
     if void_pixels is not None:
         assert annotation.shape == void_pixels.shape
     if annotation.ndim == 3:
-        n_frames = annotation.shape[0]
-        f_res = np.zeros(n_frames)
-        for frame_id in range(n_frames):
-            void_pixels_frame = None if void_pixels is None else void_pixels[frame_id, :, :, ]
-            f_res[frame_id] = f_measure(segmentation[frame_id, :, :, ], annotation[frame_id, :, :], void_pixels_frame, bound_th=bound_th)
+        f_res = db_eval_boundary_batch(annotation, segmentation, void_pixels, bound_th=bound_th)
     elif annotation.ndim == 2:
         f_res = f_measure(segmentation, annotation, void_pixels, bound_th=bound_th)
     else:
@@ -106,12 +104,10 @@ def f_measure(foreground_mask, gt_mask, void_pixels=None, bound_th=0.008):
     fg_boundary = _seg2bmap(foreground_mask * np.logical_not(void_pixels))
     gt_boundary = _seg2bmap(gt_mask * np.logical_not(void_pixels))
 
-    from skimage.morphology import disk
-
     # fg_dil = binary_dilation(fg_boundary, disk(bound_pix))
-    fg_dil = cv2.dilate(fg_boundary.astype(np.uint8), disk(bound_pix).astype(np.uint8))
+    fg_dil = cv2.dilate(fg_boundary.astype(np.uint8), get_disk(bound_pix))
     # gt_dil = binary_dilation(gt_boundary, disk(bound_pix))
-    gt_dil = cv2.dilate(gt_boundary.astype(np.uint8), disk(bound_pix).astype(np.uint8))
+    gt_dil = cv2.dilate(gt_boundary.astype(np.uint8), get_disk(bound_pix))
 
     # Get the intersection
     gt_match = gt_boundary * fg_dil
@@ -193,15 +189,130 @@ def _seg2bmap(seg, width=None, height=None):
         bmap = b
     else:
         bmap = np.zeros((height, width))
-        for x in range(w):
-            for y in range(h):
-                if b[y, x]:
-                    j = 1 + math.floor((y - 1) + height / h)
-                    i = 1 + math.floor((x - 1) + width / h)
-                    bmap[j, i] = 1
+        y, x = np.nonzero(b)
+        j = 1 + np.floor((y - 1) + height / h).astype(int)
+        i = 1 + np.floor((x - 1) + width / h).astype(int)
+        bmap[j, i] = 1
 
     return bmap
 
+
+@functools.lru_cache(maxsize=None)
+def get_disk(radius):
+    """Disk structuring element, same as skimage.morphology.disk(radius) as uint8."""
+    L = np.arange(-radius, radius + 1)
+    X, Y = np.meshgrid(L, L)
+    return ((X ** 2 + Y ** 2) <= radius ** 2).astype(np.uint8)
+
+
+def seg2bmap_batch(seg):
+    """Boundary maps of a [..., H, W] stack as uint8, the full size case of _seg2bmap.
+
+    A pixel is on the boundary when it differs from its east, south or south-east
+    neighbour, the last row (column) only looks east (south).
+    """
+    seg = seg.astype(np.uint8)
+    b = np.zeros_like(seg)
+    a = seg[..., :-1, :-1]
+    b[..., :-1, :-1] = (a ^ seg[..., :-1, 1:]) | (a ^ seg[..., 1:, :-1]) | (a ^ seg[..., 1:, 1:])
+    b[..., -1, :-1] = seg[..., -1, :-1] ^ seg[..., -1, 1:]
+    b[..., :-1, -1] = seg[..., :-1, -1] ^ seg[..., 1:, -1]
+    return b
+
+
+def dilate_batch(masks, radius, device=None):
+    """Binary dilation of a [T, H, W] uint8 stack by get_disk(radius).
+
+    With a device the dilation is a convolution in torch. Otherwise the frames are
+    stacked into one tall cv2 image, separated by `radius` empty rows so that they
+    cannot reach each other.
+    """
+    kernel = get_disk(radius)
+    if device is not None:
+        weight = torch.from_numpy(kernel).to(device, torch.float32)[None, None]
+        x = torch.from_numpy(masks).to(device, torch.float32)[:, None]
+        return (F.conv2d(x, weight, padding=kernel.shape[-1] // 2) > 0)[:, 0].to(torch.uint8).cpu().numpy()
+    T, H, W = masks.shape
+    r = kernel.shape[0] // 2
+    tall = np.zeros((T, H + r, W), np.uint8)
+    tall[:, :H] = masks
+    tall = cv2.dilate(tall.reshape(T * (H + r), W), kernel)
+    return tall.reshape(T, H + r, W)[:, :H]
+
+
+def db_eval_boundary_batch(annotation, segmentation, void_pixels=None, bound_th=0.008, device=None):
+    """Boundary F-measure of every frame of [T, H, W] stacks, same values as f_measure."""
+    assert annotation.shape == segmentation.shape and annotation.ndim == 3
+    segmentation, annotation = segmentation != 0, annotation != 0
+    if void_pixels is not None:
+        assert annotation.shape == void_pixels.shape
+        keep = void_pixels == 0
+        segmentation, annotation = segmentation & keep, annotation & keep
+
+    bound_pix = bound_th if bound_th >= 1 else \
+        np.ceil(bound_th * np.linalg.norm(annotation.shape[-2:]))
+
+    # boundary pixels lie within 1 pixel of the objects and the dilations are only read
+    # at boundary pixels, so everything can be computed on the box around the objects
+    foreground = np.any(segmentation | annotation, axis=0)
+    rows, cols = np.nonzero(foreground.any(axis=1))[0], np.nonzero(foreground.any(axis=0))[0]
+    if len(rows) > 0:
+        y0, y1 = max(rows[0] - 1, 0), min(rows[-1] + 2, foreground.shape[0])
+        x0, x1 = max(cols[0] - 1, 0), min(cols[-1] + 2, foreground.shape[1])
+        segmentation, annotation = segmentation[:, y0:y1, x0:x1], annotation[:, y0:y1, x0:x1]
+    else:
+        segmentation, annotation = segmentation[:, :0, :0], annotation[:, :0, :0]
+
+    n_fg = np.zeros(len(annotation), dtype=int)
+    n_gt, fg_match, gt_match = n_fg.copy(), n_fg.copy(), n_fg.copy()
+    if annotation.size > 0:
+        # on the cpu, chunks of about a megapixel keep the temporaries in cache
+        chunk = len(annotation) if device is not None else max(1, 2**20 // annotation[0].size)
+        for t in range(0, len(annotation), chunk):
+            frames = slice(t, t + chunk)
+            fg_boundary = seg2bmap_batch(segmentation[frames])
+            gt_boundary = seg2bmap_batch(annotation[frames])
+            fg_dil = dilate_batch(fg_boundary, bound_pix, device)
+            gt_dil = dilate_batch(gt_boundary, bound_pix, device)
+
+            n_fg[frames] = np.count_nonzero(fg_boundary, axis=(-2, -1))
+            n_gt[frames] = np.count_nonzero(gt_boundary, axis=(-2, -1))
+            fg_match[frames] = np.count_nonzero(fg_boundary & gt_dil, axis=(-2, -1))
+            gt_match[frames] = np.count_nonzero(gt_boundary & fg_dil, axis=(-2, -1))
+
+    # an empty boundary has precision (recall) 1, matching nothing gives 0 to the other one
+    precision = np.where(n_fg > 0, fg_match / np.maximum(n_fg, 1), 1.)
+    recall = np.where(n_gt > 0, gt_match / np.maximum(n_gt, 1), 1.)
+    denominator = precision + recall
+    return np.where(denominator > 0, 2 * precision * recall / np.where(denominator > 0, denominator, 1), 0.)
+
+
+def eval_jf(annotation, segmentation, void_pixels=None):
+    """Per-frame J and F of [T, H, W] stacks."""
+    return db_eval_iou(annotation, segmentation, void_pixels), db_eval_boundary(annotation, segmentation, void_pixels)
+
+
+class JFEvaluator:
+    """Computes J and F of sequences in worker processes.
+
+    submit() returns a future right away, so the metrics of a sequence are
+    computed while the next ones are segmented. With no workers they are
+    computed in the calling process.
+    """
+    def __init__(self, num_workers):
+        self.pool = ProcessPoolExecutor(num_workers) if num_workers > 0 else None
+
+    def submit(self, annotation, segmentation, void_pixels=None):
+        if self.pool is not None:
+            return self.pool.submit(eval_jf, annotation, segmentation, void_pixels)
+        future = Future()
+        future.set_result(eval_jf(annotation, segmentation, void_pixels))
+        return future
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
 def compute_bbox_iou(boxes1: torch.Tensor, boxes2: torch.Tensor):
     # both boxes: xyxy
     area1 = box_area(boxes1)
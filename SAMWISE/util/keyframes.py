@@ -0,0 +1,64 @@
+"""
+Keyframe selection and mask propagation, to run SAMWISE on part of the frames of a video.
+
+Keyframes are segmented by the model as if they were a lower frame rate video, the
+other frames get the masks of the last keyframe warped by the optical flow between
+the two frames (OpenCV's DIS flow on small grayscale thumbnails).
+"""
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def make_thumbnails(frames, width=320):
+    """uint8 grayscale thumbnails [T, h, w], at most `width` wide, of uint8 frames [T, 3, H, W]."""
+    frames = frames.float()
+    gray = (0.299 * frames[:, 0] + 0.587 * frames[:, 1] + 0.114 * frames[:, 2])[:, None]
+    H, W = gray.shape[-2:]
+    if W > width:
+        gray = F.interpolate(gray, size=(max(1, round(H * width / W)), width), mode='area')
+    return gray[:, 0].round().clamp(0, 255).to(torch.uint8).cpu().numpy()
+
+
+def select_keyframes(thumbnails, stride, threshold=0.):
+    """Indices of the frames to segment with the model, the first frame always is one.
+
+    A frame becomes a keyframe `stride` frames after the last one, or earlier when its mean
+    absolute difference to the last keyframe (on a 0-1 scale) exceeds threshold. With
+    threshold 0 keyframes are every `stride` frames.
+    """
+    keyframes = [0]
+    last = thumbnails[0].astype(np.float32)
+    for t in range(1, len(thumbnails)):
+        current = thumbnails[t].astype(np.float32)
+        if t - keyframes[-1] >= stride or (threshold > 0 and np.abs(current - last).mean() / 255 > threshold):
+            keyframes.append(t)
+            last = current
+    return keyframes
+
+
+_dis = None
+
+
+def estimate_flow(frame, keyframe):
+    """Flow [h, w, 2] in pixels from a thumbnail to the one of its keyframe: frame(x) ~ keyframe(x + flow(x))."""
+    global _dis
+    if _dis is None:
+        _dis = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_FAST)
+    return _dis.calc(frame, keyframe, None)
+
+
+def warp_masks(masks, flow):
+    """Backward-warps masks [N, H, W] of a keyframe onto a frame, flow from estimate_flow at any resolution."""
+    N, H, W = masks.shape
+    h, w = flow.shape[:2]
+    flow = torch.from_numpy(flow).to(masks.device).permute(2, 0, 1)[None]
+    flow = F.interpolate(flow, size=(H, W), mode='bilinear', align_corners=False)[0]
+    ys, xs = torch.meshgrid(torch.arange(H, device=masks.device), torch.arange(W, device=masks.device), indexing='ij')
+    # sampling positions in grid_sample coordinates (align_corners=False)
+    grid_x = (xs + flow[0] * (W / w) + 0.5) * (2 / W) - 1
+    grid_y = (ys + flow[1] * (H / h) + 0.5) * (2 / H) - 1
+    grid = torch.stack([grid_x, grid_y], dim=-1)[None].expand(N, -1, -1, -1)
+    warped = F.grid_sample(masks[:, None].float(), grid, mode='bilinear', padding_mode='border', align_corners=False)
+    return warped[:, 0]
@@ -10,6 +10,7 @@ from collections import defaultdict, deque
 import datetime
 from typing import Optional, List, Dict, Any
 
+import numpy as np
 import torch
 import torch.distributed as dist
 from torch import Tensor
@@ -555,3 +556,45 @@ def on_load_checkpoint(model, checkpoint) -> None:
 
     checkpoint["model"] = state_dict
     return checkpoint
+
+
+def cpu_supports_bf16():
+    return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+
+def setup_inference_device(args):
+    """Backend settings for args.device: TF32 on Ampere GPUs, thread pools and bf16 support on CPU."""
+    if torch.device(args.device).type == 'cuda':
+        if torch.cuda.get_device_properties(0).major >= 8:
+            # turn on tfloat32 for Ampere GPUs (https://pytorch.org/docs/stable/notes/cuda.html#tensorfloat-32-tf32-on-ampere-devices)
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+        return
+    # inter-op threads can only be set before any parallel work has started
+    if args.num_interop_threads > 0:
+        torch.set_num_interop_threads(args.num_interop_threads)
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    if args.bf16 and not cpu_supports_bf16():
+        print('This CPU has no native bfloat16 support, running in float32')
+        args.bf16 = False
+    print(f'Running on CPU with {torch.get_num_threads()} threads '
+          f'({torch.get_num_interop_threads()} inter-op), {"bfloat16" if args.bf16 else "float32"}')
+
+
+def inference_autocast(args):
+    """Autocast context for the model forward, bfloat16 when args.bf16 is set."""
+    return torch.autocast(device_type=torch.device(args.device).type, dtype=torch.bfloat16, enabled=args.bf16)
+
+
+def pack_masks(masks):
+    """Bit-packs boolean masks [..., H, W] along the width on their device, same layout as
+    np.packbits(masks, axis=-1): the host gets 1 bit per pixel instead of a float score."""
+    bits = torch.nn.functional.pad(masks.to(torch.uint8), (0, -masks.shape[-1] % 8)).unflatten(-1, (-1, 8))
+    weights = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8, device=masks.device)
+    return (bits * weights).sum(-1, dtype=torch.uint8)
+
+
+def unpack_masks(packed, width):
+    """Boolean masks [..., H, width] from the output of pack_masks."""
+    return np.unpackbits(np.asarray(packed), axis=-1, count=width).view(bool)